@@ -1,6 +1,40 @@
 from django.apps import AppConfig
+from django.core.signals import setting_changed
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 
 
 class TagApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tag_api'
+
+    def ready(self):
+        from . import bitmaps, histograms, search, tag_lists, throttling
+        from .models import TagsModel, VM, VMTag, soft_deleted
+
+        # Keep the in-memory tag bitmap index in step with the database
+        m2m_changed.connect(bitmaps.on_tags_changed, sender=VMTag)
+        post_save.connect(bitmaps.on_vm_saved, sender=VM)
+        post_delete.connect(bitmaps.on_vm_deleted, sender=VM)
+        post_delete.connect(bitmaps.on_tag_deleted, sender=TagsModel)
+        soft_deleted.connect(bitmaps.on_vm_deleted, sender=VM)
+        soft_deleted.connect(bitmaps.on_tag_deleted, sender=TagsModel)
+
+        # Denormalized VM.tag_list, written in the same transaction as the change
+        m2m_changed.connect(tag_lists.on_tags_changed, sender=VMTag)
+        post_save.connect(tag_lists.on_tag_saved, sender=TagsModel)
+        pre_delete.connect(tag_lists.on_tag_deleting, sender=TagsModel)
+        post_delete.connect(tag_lists.on_tag_deleted, sender=TagsModel)
+
+        # Cached histogram buckets count VMs by their live tags
+        m2m_changed.connect(histograms.on_tags_changed, sender=VMTag)
+        for model in (VM, TagsModel):
+            post_delete.connect(histograms.on_deleted, sender=model)
+            soft_deleted.connect(histograms.on_deleted, sender=model)
+
+        # In-memory trigram index behind /tags/search
+        post_save.connect(search.on_tag_saved, sender=TagsModel)
+        post_delete.connect(search.on_tag_deleted, sender=TagsModel)
+        soft_deleted.connect(search.on_tag_deleted, sender=TagsModel)
+
+        # Tests changing the limits start from full buckets
+        setting_changed.connect(throttling.on_setting_changed)
@@ -0,0 +1,71 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ASSIGNMENTS = {
+    # VMs written per transaction by VMTag.assign()/unassign()
+    'CHUNK_SIZE': 500,
+    # Extra attempts after a deadlock or lock timeout
+    'RETRIES': 5,
+    # Seconds before the first retry; doubles every attempt, with jitter
+    'RETRY_BACKOFF': 0.05,
+}
+
+# MySQL: ER_LOCK_DEADLOCK, ER_LOCK_WAIT_TIMEOUT
+MYSQL_RETRY_CODES = {1213, 1205}
+# PostgreSQL: serialization_failure, deadlock_detected
+SQLSTATE_RETRY_CODES = {'40001', '40P01'}
+
+
+def assignment_setting(name):
+    return getattr(settings, 'TAG_ASSIGNMENTS', {}).get(name, DEFAULT_ASSIGNMENTS[name])
+
+
+def chunks(items):
+    size = assignment_setting('CHUNK_SIZE')
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def is_retryable(error):
+    cause = error.__cause__ or error
+    if getattr(cause, 'pgcode', None) in SQLSTATE_RETRY_CODES:
+        return True
+    args = getattr(cause, 'args', ())
+    if args and args[0] in MYSQL_RETRY_CODES:
+        return True
+    # SQLite: "database is locked" / "database table is locked"
+    return 'is locked' in str(error)
+
+
+def atomic_with_retry(func, *args, using=DEFAULT_DB_ALIAS):
+    """
+    Run func(*args) in its own transaction, retrying it after a deadlock or
+    lock timeout with exponential backoff and jitter.
+
+    Inside an outer transaction func just joins it: the deadlock rolls back
+    the caller's whole transaction, so only the caller can retry.
+    """
+    if connections[using].in_atomic_block:
+        with transaction.atomic(using=using, savepoint=False):
+            return func(*args)
+
+    attempts = assignment_setting('RETRIES') + 1
+    for attempt in range(attempts):
+        try:
+            with transaction.atomic(using=using):
+                return func(*args)
+        except OperationalError as e:
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            delay = assignment_setting('RETRY_BACKOFF') * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.info("Retrying %s in %.3fs after: %s", getattr(func, '__name__', func), delay, e)
+            metrics.incr('assignments.retries')
+            time.sleep(delay)
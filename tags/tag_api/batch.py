@@ -0,0 +1,174 @@
+import io
+import json
+import re
+import time
+from contextlib import nullcontext
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.http import HttpRequest, QueryDict
+from django.urls import Resolver404, resolve
+
+from .serializers import dumps
+
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+# Headers a sub-request inherits, so throttling and routing see the real client
+INHERITED_META = ('REMOTE_ADDR', 'HTTP_X_FORWARDED_FOR', 'SERVER_NAME', 'SERVER_PORT', 'HTTP_HOST', 'wsgi.url_scheme')
+
+REFERENCE = re.compile(r'\$\{([^}]+)\}')
+
+
+class BatchError(Exception):
+    pass
+
+
+def batch_setting(name, default):
+    return getattr(settings, 'TAG_BATCH', {}).get(name, default)
+
+
+def lookup(reference, results):
+    """
+    Value of a reference such as 'tag.data.tag_id': the `tag_id` key of the
+    `data` key of the response body of the operation with id 'tag'.
+    """
+    name, _, path = reference.partition('.')
+    if name not in results:
+        raise BatchError("Unknown reference: {0}".format(name))
+
+    value = results[name]
+    for key in path.split('.') if path else ():
+        try:
+            value = value[int(key)] if isinstance(value, list) else value[key]
+        except (KeyError, IndexError, ValueError, TypeError):
+            raise BatchError("Reference not found: {0}".format(reference))
+    return value
+
+
+def resolve_references(value, results):
+    # "${ref}" on its own keeps the referenced value's type; inside a longer
+    # string it is replaced by its text
+    if isinstance(value, str):
+        match = REFERENCE.fullmatch(value)
+        if match:
+            return lookup(match.group(1), results)
+        return REFERENCE.sub(lambda match: str(lookup(match.group(1), results)), value)
+    if isinstance(value, list):
+        return [resolve_references(item, results) for item in value]
+    if isinstance(value, dict):
+        return {key: resolve_references(item, results) for key, item in value.items()}
+    return value
+
+
+def sub_request(outer, method, path, query, body):
+    request = HttpRequest()
+    request.method = method
+    request.path = request.path_info = path
+    request.META = {key: outer.META[key] for key in INHERITED_META if key in outer.META}
+    request.META.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        # Sub-responses are embedded in the batch response as JSON
+        'HTTP_ACCEPT': 'application/json',
+    })
+    request.GET = QueryDict(query)
+
+    if body is not None:
+        content = dumps(body)
+        request.META['CONTENT_TYPE'] = 'application/json'
+        request.META['CONTENT_LENGTH'] = str(len(content))
+        request._stream = io.BytesIO(content)
+        request._read_started = False
+    return request
+
+
+def view_for(path):
+    # Only the API's own views, and never /batch itself
+    from .views import Batch
+
+    try:
+        match = resolve(path)
+    except Resolver404:
+        raise BatchError("Unknown path: {0}".format(path))
+
+    view_class = getattr(match.func, 'view_class', None)
+    if view_class is None or view_class.__module__ != Batch.__module__ or view_class is Batch:
+        raise BatchError("Path not allowed in a batch: {0}".format(path))
+    return match
+
+
+def run_operation(outer, operation, results):
+    if not isinstance(operation, dict):
+        raise BatchError("Each operation must be an object")
+
+    method = str(operation.get('method', 'GET')).upper()
+    if method not in METHODS:
+        raise BatchError("Invalid method: {0}".format(method))
+
+    url = urlsplit(resolve_references(str(operation.get('path', '')), results))
+    query = resolve_references(operation.get('query') or {}, results)
+    query = '&'.join(part for part in (url.query, urlencode(query, doseq=True)) if part)
+    body = resolve_references(operation.get('body'), results)
+
+    match = view_for(url.path)
+    response = match.func(sub_request(outer, method, url.path, query, body), *match.args, **match.kwargs)
+    if hasattr(response, 'render'):
+        # DRF's own responses (404, throttling) are rendered lazily
+        response.render()
+
+    try:
+        content = json.loads(response.content)
+    except ValueError:
+        content = response.content.decode('utf-8', 'replace')
+    return response.status_code, content
+
+
+def failed(status, content):
+    # The views report most errors with HTTP 200 and status 'error'
+    return status >= 400 or (isinstance(content, dict) and content.get('status') == 'error')
+
+
+def run(outer, operations, atomic=False):
+    """
+    Run `operations` in order through the API's views, in this process.
+
+    Returns (results, ok). An atomic batch stops at the first failed
+    operation and rolls back everything before it; otherwise every
+    operation runs and only those referencing a failed one fail with it.
+    """
+    if not isinstance(operations, list) or not operations:
+        raise ValidationError("operations must be a non-empty list")
+    max_operations = batch_setting('MAX_OPERATIONS', 100)
+    if len(operations) > max_operations:
+        raise ValidationError("A batch can hold at most {0} operations".format(max_operations))
+
+    deadline = time.monotonic() + batch_setting('MAX_SECONDS', 10)
+    bodies = {}
+    results = []
+    ok = True
+
+    with transaction.atomic() if atomic else nullcontext():
+        for index, operation in enumerate(operations):
+            name = str(operation.get('id', index)) if isinstance(operation, dict) else str(index)
+
+            if time.monotonic() > deadline:
+                status, content = 504, {'status': 'error', 'message': "Batch time limit reached"}
+            else:
+                try:
+                    status, content = run_operation(outer, operation, bodies)
+                except BatchError as e:
+                    status, content = 400, {'status': 'error', 'message': str(e)}
+
+            results.append({'id': name, 'status': status, 'body': content})
+            if failed(status, content):
+                ok = False
+                if atomic:
+                    transaction.set_rollback(True)
+                    break
+            else:
+                bodies[name] = content
+
+    return results, ok
@@ -0,0 +1,356 @@
+import logging
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from . import metrics
+from .models import VM, VMTag
+from .routers import use_primary
+
+try:
+    from pyroaring import BitMap as Bitmap
+except ImportError:
+    Bitmap = None
+
+logger = logging.getLogger(__name__)
+
+
+class IntBitmap:
+    """
+    Dense bitset on a Python int, used when pyroaring is not installed.
+
+    Supports the subset of pyroaring.BitMap the index relies on. The
+    and/or/difference operators run over whole machine words in C.
+    """
+    __slots__ = ('bits',)
+
+    def __init__(self, ordinals=(), bits=0):
+        self.bits = bits | self._from_ordinals(ordinals)
+
+    @staticmethod
+    def _from_ordinals(ordinals):
+        if isinstance(ordinals, IntBitmap):
+            return ordinals.bits
+        ordinals = list(ordinals)
+        if not ordinals:
+            return 0
+        buf = bytearray(max(ordinals) // 8 + 1)
+        for ordinal in ordinals:
+            buf[ordinal >> 3] |= 1 << (ordinal & 7)
+        return int.from_bytes(buf, 'little')
+
+    def add(self, ordinal):
+        self.bits |= 1 << ordinal
+
+    def discard(self, ordinal):
+        self.bits &= ~(1 << ordinal)
+
+    def update(self, ordinals):
+        self.bits |= self._from_ordinals(ordinals)
+
+    def difference_update(self, ordinals):
+        self.bits &= ~self._from_ordinals(ordinals)
+
+    def copy(self):
+        return IntBitmap(bits=self.bits)
+
+    def __and__(self, other):
+        return IntBitmap(bits=self.bits & other.bits)
+
+    def __or__(self, other):
+        return IntBitmap(bits=self.bits | other.bits)
+
+    def __sub__(self, other):
+        return IntBitmap(bits=self.bits & ~other.bits)
+
+    def __eq__(self, other):
+        return isinstance(other, IntBitmap) and self.bits == other.bits
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __iter__(self):
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+        for index, byte in enumerate(data):
+            while byte:
+                low = byte & -byte
+                yield index * 8 + low.bit_length() - 1
+                byte ^= low
+
+
+if Bitmap is None:
+    Bitmap = IntBitmap
+
+
+def index_setting(name, default):
+    return getattr(settings, 'TAG_BITMAP_INDEX', {}).get(name, default)
+
+
+def index_enabled():
+    return index_setting('ENABLED', False)
+
+
+def _uuid(value):
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
+
+
+class TagBitmapIndex:
+    """
+    In-memory map of tag_id -> bitmap of VM ordinals.
+
+    Each VM gets a dense integer ordinal, so "VMs with all of these tags"
+    becomes an intersection of bitmaps instead of a join per tag on the
+    vms_tags table. Updates are idempotent set operations, so an update
+    racing a rebuild cannot leave a bit in the wrong state.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built_at = None
+        self.ordinals = {}
+        self.vm_ids = []
+        self.alive = Bitmap()
+        self.bitmaps = {}
+
+    @property
+    def built(self):
+        return self.built_at is not None
+
+    def build(self):
+        # From the primary: a lagging replica's rows would be served until
+        # the next rebuild
+        with self.lock, use_primary():
+            ordinals, vm_ids = {}, []
+            for vm_id in VM.objects.order_by('vm_id').values_list('vm_id', flat=True).iterator(chunk_size=10000):
+                ordinals[vm_id] = len(vm_ids)
+                vm_ids.append(vm_id)
+
+            members = defaultdict(list)
+            # Rows of soft-deleted VMs and tags wait in vms_tags for the purger
+            live = VMTag.objects.filter(tag__deleted_at=None)
+            for vm_id, tag_id in live.values_list('vm_id', 'tag_id').iterator(chunk_size=10000):
+                if vm_id in ordinals:
+                    members[tag_id].append(ordinals[vm_id])
+
+            self.ordinals = ordinals
+            self.vm_ids = vm_ids
+            self.alive = Bitmap(range(len(vm_ids)))
+            self.bitmaps = {tag_id: Bitmap(ordinal_list) for tag_id, ordinal_list in members.items()}
+            self.built_at = time.monotonic()
+
+    def _existing(self, vm_ids):
+        # The VM ids that have an ordinal or a live row; pk_sets can name ids
+        # that were never inserted, and those must not become phantom VMs
+        vm_ids = {_uuid(vm_id) for vm_id in vm_ids}
+        with self.lock:
+            unknown = [vm_id for vm_id in vm_ids if vm_id not in self.ordinals]
+        if unknown:
+            # Called after commit, which a replica may not have seen yet
+            with use_primary():
+                vm_ids -= set(unknown) - set(VM.objects.filter(vm_id__in=unknown).values_list('vm_id', flat=True))
+        return vm_ids
+
+    def _ordinal(self, vm_id):
+        # Only for VMs known to exist: build(), add_vm() and _existing()
+        vm_id = _uuid(vm_id)
+        ordinal = self.ordinals.get(vm_id)
+        if ordinal is None:
+            ordinal = self.ordinals[vm_id] = len(self.vm_ids)
+            self.vm_ids.append(vm_id)
+            self.alive.add(ordinal)
+        return ordinal
+
+    def add_vm(self, vm_id):
+        with self.lock:
+            self._ordinal(vm_id)
+
+    def drop_vm(self, vm_id):
+        with self.lock:
+            ordinal = self.ordinals.pop(_uuid(vm_id), None)
+            if ordinal is None:
+                return
+            self.vm_ids[ordinal] = None
+            self.alive.discard(ordinal)
+            for bitmap in self.bitmaps.values():
+                bitmap.discard(ordinal)
+
+    def drop_tag(self, tag_id):
+        with self.lock:
+            self.bitmaps.pop(_uuid(tag_id), None)
+
+    def add(self, tag_id, vm_ids):
+        vm_ids = self._existing(vm_ids)
+        with self.lock:
+            bitmap = self.bitmaps.setdefault(_uuid(tag_id), Bitmap())
+            bitmap.update([self._ordinal(vm_id) for vm_id in vm_ids])
+
+    def remove(self, tag_id, vm_ids):
+        with self.lock:
+            bitmap = self.bitmaps.get(_uuid(tag_id))
+            if bitmap is not None:
+                ordinals = (self.ordinals.get(_uuid(vm_id)) for vm_id in vm_ids)
+                bitmap.difference_update(Bitmap(ordinal for ordinal in ordinals if ordinal is not None))
+
+    def add_tags(self, vm_id, tag_ids):
+        if not self._existing([vm_id]):
+            return
+        with self.lock:
+            ordinal = self._ordinal(vm_id)
+            for tag_id in tag_ids:
+                self.bitmaps.setdefault(_uuid(tag_id), Bitmap()).add(ordinal)
+
+    def remove_tags(self, vm_id, tag_ids=None):
+        # tag_ids=None removes every tag from the VM
+        with self.lock:
+            ordinal = self.ordinals.get(_uuid(vm_id))
+            if ordinal is None:
+                return
+            tag_ids = self.bitmaps.keys() if tag_ids is None else [_uuid(tag_id) for tag_id in tag_ids]
+            for tag_id in tag_ids:
+                if tag_id in self.bitmaps:
+                    self.bitmaps[tag_id].discard(ordinal)
+
+    def match(self, all_tags=(), any_tags=(), none_tags=()):
+        empty = Bitmap()
+        with self.lock:
+            result = self.alive.copy()
+            for tag_id in all_tags:
+                result = result & self.bitmaps.get(tag_id, empty)
+            if any_tags:
+                union = Bitmap()
+                for tag_id in any_tags:
+                    union = union | self.bitmaps.get(tag_id, empty)
+                result = result & union
+            for tag_id in none_tags:
+                result = result - self.bitmaps.get(tag_id, empty)
+            return result
+
+    def vm_ids_for(self, bitmap):
+        with self.lock:
+            return [self.vm_ids[ordinal] for ordinal in bitmap]
+
+    def verify(self):
+        """
+        Compare the index with the vms_tags table.
+
+        Returns a dict of tag_id -> (vm_ids missing from the index,
+        vm_ids the index has but the table does not).
+        """
+        expected = defaultdict(set)
+        live = VMTag.objects.filter(vm__deleted_at=None, tag__deleted_at=None)
+        with use_primary():
+            for vm_id, tag_id in live.values_list('vm_id', 'tag_id').iterator(chunk_size=10000):
+                expected[tag_id].add(vm_id)
+
+        with self.lock:
+            actual = {tag_id: set(self.vm_ids_for(bitmap)) for tag_id, bitmap in self.bitmaps.items()}
+
+        mismatches = {}
+        for tag_id in set(expected) | set(actual):
+            missing = expected.get(tag_id, set()) - actual.get(tag_id, set())
+            extra = actual.get(tag_id, set()) - expected.get(tag_id, set())
+            if missing or extra:
+                mismatches[tag_id] = (missing, extra)
+        return mismatches
+
+
+_index = TagBitmapIndex()
+
+
+def get_index():
+    # Built lazily on first use; rebuilt after MAX_AGE seconds so changes made
+    # by other worker processes are eventually picked up.
+    max_age = index_setting('MAX_AGE', 300)
+    with _index.lock:
+        if not _index.built:
+            _index.build()
+        elif max_age and time.monotonic() - _index.built_at > max_age:
+            rebuild(_index)
+    return _index
+
+
+def rebuild(index):
+    """
+    Rebuild an index that has been serving requests, first checking it
+    against the database when VERIFY_ON_REBUILD is set. Drift (a missed
+    signal, or writes made through another process) is logged and counted
+    in the bitmaps.drifted_tags metric.
+    """
+    if index_setting('VERIFY_ON_REBUILD', True):
+        mismatches = index.verify()
+        metrics.incr('bitmaps.verified')
+        if mismatches:
+            metrics.incr('bitmaps.drifted_tags', len(mismatches))
+            logger.warning("Tag bitmap index differed from vms_tags on %d tags before its rebuild", len(mismatches))
+    index.build()
+
+
+def tag_set_params(request):
+    """
+    Parse the tags_all, tags_any and tags_none query parameters.
+
+    Each one is a comma separated list of tag ids.
+    """
+    params = []
+    for name in ('tags_all', 'tags_any', 'tags_none'):
+        value = request.GET.get(name, '')
+        try:
+            params.append([_uuid(tag_id.strip()) for tag_id in value.split(',') if tag_id.strip()])
+        except ValueError:
+            raise ValidationError("{0} must be a comma separated list of tag ids".format(name))
+    return params
+
+
+def filter_queryset(queryset, all_tags=(), any_tags=(), none_tags=()):
+    # SQL equivalent of TagBitmapIndex.match(), used when the index is disabled
+    through = VMTag.objects
+    for tag_id in all_tags:
+        queryset = queryset.filter(vm_id__in=through.filter(tag_id=tag_id).values('vm_id'))
+    if any_tags:
+        queryset = queryset.filter(vm_id__in=through.filter(tag_id__in=any_tags).values('vm_id'))
+    if none_tags:
+        queryset = queryset.exclude(vm_id__in=through.filter(tag_id__in=none_tags).values('vm_id'))
+    return queryset
+
+
+def _defer(func, *args):
+    if index_enabled() and _index.built:
+        # Only apply changes that actually commit
+        transaction.on_commit(lambda: func(*args))
+
+
+def on_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse:
+        # tag.vms.add()/remove()/clear(): instance is the tag, pk_set holds VM ids
+        if action == 'post_add':
+            _defer(_index.add, instance.pk, pk_set)
+        elif action == 'post_remove':
+            _defer(_index.remove, instance.pk, pk_set)
+        elif action == 'post_clear':
+            _defer(_index.drop_tag, instance.pk)
+    else:
+        # vm.tags.add()/remove()/clear(): instance is the VM, pk_set holds tag ids
+        if action == 'post_add':
+            _defer(_index.add_tags, instance.pk, pk_set)
+        elif action == 'post_remove':
+            _defer(_index.remove_tags, instance.pk, pk_set)
+        elif action == 'post_clear':
+            _defer(_index.remove_tags, instance.pk)
+
+
+def on_vm_saved(sender, instance, created, **kwargs):
+    if created:
+        _defer(_index.add_vm, instance.pk)
+
+
+def on_vm_deleted(sender, instance, **kwargs):
+    _defer(_index.drop_vm, instance.pk)
+
+
+def on_tag_deleted(sender, instance, **kwargs):
+    _defer(_index.drop_tag, instance.pk)
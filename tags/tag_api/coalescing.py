@@ -0,0 +1,145 @@
+import asyncio
+import threading
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from . import metrics, routers
+
+DEFAULT_COALESCING = {
+    'ENABLED': True,
+    # Only GETs of these paths are shared between concurrent requests
+    'PATHS': ('/tags', '/tags/search', '/vms', '/vms/histogram', '/user'),
+    # Seconds a request waits for an identical one before running on its own
+    'TIMEOUT': 10,
+}
+
+
+def coalescing_setting(name):
+    return getattr(settings, 'TAG_COALESCING', {}).get(name, DEFAULT_COALESCING[name])
+
+
+def request_key(request):
+    """
+    Key under which identical reads are shared, or None if the request must
+    run on its own.
+
+    Query parameters are sorted, so ?a=1&b=2 and ?b=2&a=1 share a key. The
+    Accept header picks the response format and the primary pin decides
+    which database answers, so both are part of the key.
+    """
+    if request.method not in ('GET', 'HEAD') or not coalescing_setting('ENABLED'):
+        return None
+    if request.path not in coalescing_setting('PATHS'):
+        return None
+
+    query = tuple(sorted((name, tuple(values)) for name, values in request.GET.lists()))
+    return (request.method, request.path, query, request.META.get('HTTP_ACCEPT', ''), routers._use_primary.get())
+
+
+def freeze(response):
+    """
+    Immutable copy of a response that can be shared, or None.
+
+    Taken before outer middleware (e.g. compression) changes the leader's
+    response. Only complete 200 responses without cookies are shared.
+    """
+    if response.streaming or response.status_code != 200 or response.cookies:
+        return None
+    return (response.status_code, tuple(response.items()), response.content)
+
+
+def thaw(frozen):
+    status, headers, content = frozen
+    response = HttpResponse(content, status=status)
+    for header, value in headers:
+        response[header] = value
+    return response
+
+
+class _Call:
+    __slots__ = ('event', 'result')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+class SingleFlight:
+    """
+    Run at most one call per key at a time across threads; callers that
+    arrive while it runs wait for its result instead of repeating it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        """
+        Returns (frozen response or None, response or None): the leader gets
+        its own response back, followers get the leader's frozen copy.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+
+        if not leader:
+            metrics.incr('coalescing.followers')
+            if call.event.wait(coalescing_setting('TIMEOUT')) and call.result is not None:
+                metrics.incr('coalescing.shared')
+                return call.result, None
+            # Timed out, or the leader's response cannot be shared
+            metrics.incr('coalescing.fallbacks')
+            return None, func()
+
+        metrics.incr('coalescing.leaders')
+        try:
+            response = func()
+            call.result = freeze(response)
+            return None, response
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.event.set()
+
+
+class AsyncSingleFlight:
+    # SingleFlight for coroutines; all callers share one event loop, so no lock
+
+    def __init__(self):
+        self.calls = {}
+
+    async def do(self, key, func):
+        key = (id(asyncio.get_running_loop()),) + key
+        future = self.calls.get(key)
+
+        if future is not None:
+            metrics.incr('coalescing.followers')
+            try:
+                frozen = await asyncio.wait_for(asyncio.shield(future), coalescing_setting('TIMEOUT'))
+            except asyncio.TimeoutError:
+                frozen = None
+            if frozen is not None:
+                metrics.incr('coalescing.shared')
+                return frozen, None
+            metrics.incr('coalescing.fallbacks')
+            return None, await func()
+
+        metrics.incr('coalescing.leaders')
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        frozen = None
+        try:
+            response = await func()
+            frozen = freeze(response)
+            return None, response
+        finally:
+            del self.calls[key]
+            future.set_result(frozen)
+
+
+# One of each per process, shared by every handler instance
+flights = SingleFlight()
+async_flights = AsyncSingleFlight()
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connections
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COUNTS = {
+    # Seconds an exact count is reused by ?count=estimated
+    'CACHE_TTL': 60,
+    # Estimates below this are replaced by an exact count, which is cheap there
+    'EXACT_BELOW': 1000,
+}
+
+MODES = ('exact', 'estimated', 'none')
+
+
+def count_setting(name):
+    return getattr(settings, 'TAG_COUNTS', {}).get(name, DEFAULT_COUNTS[name])
+
+
+def count_mode(request):
+    mode = request.GET.get('count', 'none')
+    if mode not in MODES:
+        raise ValidationError("count must be one of: {0}".format(', '.join(MODES)))
+    return mode
+
+
+def _cache_key(queryset):
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    return 'tag_api:count:' + hashlib.sha1(repr((queryset.db, sql, params)).encode()).hexdigest()
+
+
+def exact(queryset):
+    # COUNT(*), kept for CACHE_TTL seconds for later estimated counts
+    total = queryset.count()
+    cache.set(_cache_key(queryset), total, count_setting('CACHE_TTL'))
+    return total
+
+
+def table_rows(connection, table):
+    # Row count the database keeps in its statistics, or None
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute(
+                "SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s", [table])
+        elif connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+        elif connection.vendor == 'sqlite':
+            # Created by ANALYZE; the first number of each row is the table's size
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table])
+        else:
+            return None
+        row = cursor.fetchone()
+
+    if row is None or row[0] is None:
+        return None
+    total = int(str(row[0]).split()[0])
+    # PostgreSQL reports -1 for a table that was never analyzed
+    return total if total >= 0 else None
+
+
+def unfiltered(queryset):
+    # Whole-table listing: no joins, and no filter beyond the default
+    # manager's (soft-deleted rows are few, so the table size still fits)
+    query = queryset.query
+    return len(query.alias_map) <= 1 and query.where == queryset.model._default_manager.all().query.where
+
+
+def explain_rows(connection, queryset):
+    # Rows the query planner expects the query to return, or None
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute('EXPLAIN ' + sql, params)
+            columns = [column[0] for column in cursor.description]
+            plan = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            # Nested-loop joins: each table's rows times its filtered percentage
+            total = 1.0
+            for step in plan:
+                if step.get('select_type') in ('SIMPLE', 'PRIMARY'):
+                    total *= (step.get('rows') or 1) * float(step.get('filtered') or 100) / 100
+            return int(total)
+
+        if connection.vendor == 'postgresql':
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            return int(plan[0]['Plan']['Plan Rows'])
+
+    # SQLite's planner gives no row estimates
+    return None
+
+
+def estimate(queryset):
+    """
+    Cheap count of `queryset`, as (count, kind).
+
+    A cached exact count comes first, then the table statistics for an
+    unfiltered listing or the planner's row estimate for a filtered one.
+    Without either, or when the estimate is small, the exact count is taken
+    and cached.
+    """
+    cached = cache.get(_cache_key(queryset))
+    if cached is not None:
+        metrics.incr('counts.cached')
+        return cached, 'cached'
+
+    connection = connections[queryset.db]
+    try:
+        if unfiltered(queryset):
+            total = table_rows(connection, queryset.model._meta.db_table)
+        else:
+            total = explain_rows(connection, queryset)
+    except DatabaseError as e:
+        logger.warning("Count estimate failed, counting instead: %s", e)
+        total = None
+
+    if total is not None and total >= count_setting('EXACT_BELOW'):
+        metrics.incr('counts.estimated')
+        return total, 'estimated'
+
+    metrics.incr('counts.exact')
+    return exact(queryset), 'exact'
+
+
+def count(queryset, mode):
+    """
+    {'count': n, 'count_type': 'exact' | 'cached' | 'estimated'} for the
+    response of a listing, or {} for ?count=none.
+    """
+    if mode == 'none':
+        return {}
+    if mode == 'exact':
+        metrics.incr('counts.exact')
+        return {'count': exact(queryset), 'count_type': 'exact'}
+    total, kind = estimate(queryset)
+    return {'count': total, 'count_type': kind}
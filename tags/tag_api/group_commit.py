@@ -0,0 +1,223 @@
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections
+from django.db.models import Q
+
+from . import assignments, metrics
+from .models import VMTag
+from .routers import use_primary
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GROUP_COMMIT = {
+    'ENABLED': False,
+    # Seconds the first queued operation waits for others to join its batch
+    'MAX_DELAY': 0.005,
+    # Operations per batch; a full batch is written at once
+    'MAX_OPERATIONS': 500,
+    # Seconds a caller waits for its batch to commit
+    'TIMEOUT': 10,
+}
+
+
+def group_commit_setting(name):
+    return getattr(settings, 'TAG_GROUP_COMMIT', {}).get(name, DEFAULT_GROUP_COMMIT[name])
+
+
+class GroupCommitTimeout(Exception):
+    pass
+
+
+class _Operation:
+    __slots__ = ('action', 'tag', 'vm_ids', 'assigned_by', 'event', 'error')
+
+    def __init__(self, action, tag, vm_ids, assigned_by):
+        self.action = action
+        self.tag = tag
+        self.vm_ids = vm_ids
+        self.assigned_by = assigned_by
+        self.event = threading.Event()
+        self.error = None
+
+
+def _pairs(vm_ids_by_tag):
+    # Q for the vms_tags rows of {tag_id: vm_ids}
+    return reduce(or_, (Q(tag_id=tag_id, vm_id__in=sorted(vm_ids)) for tag_id, vm_ids in vm_ids_by_tag.items()))
+
+
+def write_batch(batch):
+    """
+    Apply a batch of operations with one multi-row INSERT and one DELETE.
+
+    The last operation on a (VM, tag) pair decides whether it ends up
+    assigned, as if the operations had run one by one. Rows are written in
+    key order, like VMTag.assign(), and checked the same way: an unknown or
+    deleted VM or tag fails the whole batch, which flush() then retries
+    operation by operation.
+    """
+    final = {}
+    for operation in batch:
+        for vm_id in operation.vm_ids:
+            final[(vm_id, operation.tag.pk)] = operation
+
+    assigning = {}
+    added, removed, tags = defaultdict(set), defaultdict(set), {}
+    for (vm_id, tag_id), operation in sorted(final.items()):
+        tags[tag_id] = operation.tag
+        if operation.action == 'assign':
+            assigning[(vm_id, tag_id)] = operation.assigned_by
+            added[tag_id].add(vm_id)
+        else:
+            removed[tag_id].add(vm_id)
+
+    if assigning:
+        VMTag._check_targets(sorted(added), sorted({vm_id for vm_id, tag_id in assigning}))
+        # Only new rows are inserted and reported to the listeners
+        for vm_id, tag_id in VMTag.objects.filter(_pairs(added)).values_list('vm_id', 'tag_id'):
+            assigning.pop((vm_id, tag_id), None)
+            added[tag_id].discard(vm_id)
+        VMTag.objects.bulk_create(
+            [VMTag(vm_id=vm_id, tag_id=tag_id, assigned_by=assigned_by) for (vm_id, tag_id), assigned_by in assigning.items()],
+            ignore_conflicts=True,
+        )
+    if removed:
+        VMTag.objects.filter(_pairs(removed)).delete()
+
+    for tag_id, vm_ids in added.items():
+        VMTag._changed('post_add', tags[tag_id], vm_ids)
+    for tag_id, vm_ids in removed.items():
+        VMTag._changed('post_remove', tags[tag_id], vm_ids)
+    return len(final)
+
+
+def apply(operation):
+    if operation.action == 'assign':
+        VMTag.assign(operation.tag, operation.vm_ids, operation.assigned_by)
+    else:
+        VMTag.unassign(operation.tag, operation.vm_ids)
+
+
+class WriteBuffer:
+    """
+    In-process queue of small assign/unassign calls, written by one flusher
+    thread in shared transactions: one commit (and fsync) per batch instead
+    of one per request.
+
+    A batch is written once MAX_OPERATIONS are queued or MAX_DELAY after its
+    first operation. Callers block until their batch has committed, so an
+    acknowledged assignment is durable.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name='tag-group-commit', daemon=True)
+                self.thread.start()
+
+    def submit(self, action, tag, vm_ids, assigned_by=None):
+        operation = _Operation(action, tag, VMTag._sorted_pks(vm_ids), assigned_by)
+        self._start()
+
+        start = time.perf_counter()
+        self.queue.put(operation)
+        if not operation.event.wait(group_commit_setting('TIMEOUT')):
+            metrics.incr('group_commit.timeouts')
+            raise GroupCommitTimeout("The assignment was not confirmed in time; it may still be applied")
+
+        # Sum of caller latencies; divided by operations it gives the mean
+        metrics.incr('group_commit.wait_us', int((time.perf_counter() - start) * 1e6))
+        metrics.incr('group_commit.operations')
+        if operation.error is not None:
+            raise operation.error
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + group_commit_setting('MAX_DELAY')
+        max_operations = group_commit_setting('MAX_OPERATIONS')
+        while len(batch) < max_operations:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            close_old_connections()
+            try:
+                # Its checks and locking reads must not go to a replica
+                with use_primary():
+                    self.flush(batch)
+            except Exception as e:
+                logger.exception("Group commit flush failed")
+                for operation in batch:
+                    operation.error = operation.error or e
+            finally:
+                for operation in batch:
+                    operation.event.set()
+
+    def flush(self, batch):
+        start = time.perf_counter()
+        try:
+            rows = assignments.atomic_with_retry(write_batch, batch)
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0].error = e
+                return
+            # One bad operation (say, an unknown VM id) must not fail the others
+            logger.warning("Group commit of %d operations failed, writing them one by one: %s", len(batch), e)
+            metrics.incr('group_commit.fallbacks')
+            for operation in batch:
+                try:
+                    apply(operation)
+                except Exception as error:
+                    operation.error = error
+            return
+        finally:
+            metrics.incr('group_commit.flush_us', int((time.perf_counter() - start) * 1e6))
+
+        metrics.incr('group_commit.flushes')
+        metrics.incr('group_commit.rows', rows)
+
+
+# One per process, like the coalescing flights
+buffer = WriteBuffer()
+
+
+def buffered(vm_ids, using=DEFAULT_DB_ALIAS):
+    # Calls inside a transaction must commit with it, and calls bigger than
+    # one assignment chunk gain nothing from sharing a commit
+    return (group_commit_setting('ENABLED')
+            and not connections[using].in_atomic_block
+            and len(vm_ids) <= assignments.assignment_setting('CHUNK_SIZE'))
+
+
+def assign(tag, vm_ids, assigned_by=None):
+    # VMTag.assign(), through the write buffer when it is enabled
+    if buffered(vm_ids):
+        buffer.submit('assign', tag, vm_ids, assigned_by)
+    else:
+        VMTag.assign(tag, vm_ids, assigned_by)
+
+
+def unassign(tag, vm_ids):
+    if buffered(vm_ids):
+        buffer.submit('unassign', tag, vm_ids)
+    else:
+        VMTag.unassign(tag, vm_ids)
@@ -0,0 +1,136 @@
+import datetime
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Q
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from . import metrics
+from .models import VM, VMTag
+
+DEFAULT_HISTOGRAMS = {
+    # Seconds the buckets before the current one are cached; they only change
+    # when VMs or tags are deleted or tags are (un)assigned, which starts a
+    # new cache generation
+    'CACHE_TTL': 86400,
+}
+
+GENERATION_KEY = 'tag_api:histogram:generation'
+
+INTERVALS = ('hour', 'day', 'week')
+
+
+def histogram_setting(name):
+    return getattr(settings, 'TAG_HISTOGRAMS', {}).get(name, DEFAULT_HISTOGRAMS[name])
+
+
+def bucket_start(moment, interval):
+    # Start of the bucket holding `moment`, as Trunc() computes it in the database
+    if settings.USE_TZ:
+        moment = timezone.localtime(moment)
+    start = moment.replace(minute=0, second=0, microsecond=0)
+    if interval != 'hour':
+        start = start.replace(hour=0)
+    if interval == 'week':
+        # ISO weeks start on Monday
+        start -= datetime.timedelta(days=start.weekday())
+    return start
+
+
+def grouped(interval, after, before, tag_ids, per_tag):
+    """
+    VM creation counts per bucket, or per bucket and tag, for VMs created in
+    [after, before), in one grouped query. Empty buckets are left out.
+    """
+    if per_tag:
+        queryset = VMTag.objects.filter(vm__deleted_at=None, tag__deleted_at=None)
+        if tag_ids:
+            queryset = queryset.filter(tag_id__in=tag_ids)
+        field, group = 'vm__creation_date', ('start', 'tag_id')
+    else:
+        queryset = VM.objects.all()
+        if tag_ids:
+            queryset = queryset.filter(vm_id__in=VMTag.objects.filter(tag_id__in=tag_ids).values('vm_id'))
+        field, group = 'creation_date', ('start',)
+
+    window = Q()
+    if after is not None:
+        window &= Q(**{field + '__gte': after})
+    if before is not None:
+        window &= Q(**{field + '__lt': before})
+
+    rows = (queryset.filter(window)
+            .annotate(start=Trunc(field, interval))
+            .values(*group)
+            .annotate(count=Count('pk'))
+            .order_by(*group))
+
+    buckets = []
+    for row in rows:
+        bucket = {'start': row['start'], 'count': row['count']}
+        if per_tag:
+            bucket['tag_id'] = str(row['tag_id'])
+        buckets.append(bucket)
+    return buckets
+
+
+def _generation():
+    # An evicted generation is replaced by a new one, never reused
+    return cache.get_or_set(GENERATION_KEY, lambda: uuid.uuid4().hex, None)
+
+
+def _cache_key(*parts):
+    return 'tag_api:histogram:' + hashlib.sha1(repr((_generation(),) + parts).encode()).hexdigest()
+
+
+def invalidate():
+    """
+    Drop every cached histogram once the current transaction commits, so no
+    request caches what came before the change under the new generation.
+    """
+    transaction.on_commit(lambda: cache.set(GENERATION_KEY, uuid.uuid4().hex, None))
+
+
+# Signal handlers for the changes that alter closed buckets
+
+def on_tags_changed(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        invalidate()
+
+
+def on_deleted(sender, **kwargs):
+    invalidate()
+
+
+def histogram(interval, after=None, before=None, tag_ids=(), per_tag=False):
+    """
+    Buckets of VM creation counts, oldest first.
+
+    Buckets that closed before the current one are cached under a key that
+    includes the current bucket's start and the cache generation, so they are
+    read at most once per interval or data change (see invalidate()); only
+    the still-open bucket is counted on every request.
+    """
+    boundary = bucket_start(timezone.now(), interval)
+    tag_ids = sorted(str(tag_id) for tag_id in tag_ids)
+    buckets = []
+
+    closed_end = boundary if before is None else min(before, boundary)
+    if after is None or after < closed_end:
+        key = _cache_key(interval, after, closed_end, tag_ids, per_tag)
+        closed = cache.get(key)
+        if closed is None:
+            metrics.incr('histograms.misses')
+            closed = grouped(interval, after, closed_end, tag_ids, per_tag)
+            cache.set(key, closed, histogram_setting('CACHE_TTL'))
+        else:
+            metrics.incr('histograms.hits')
+        buckets.extend(closed)
+
+    if before is None or before > boundary:
+        buckets.extend(grouped(interval, boundary if after is None else max(after, boundary), before, tag_ids, per_tag))
+    return buckets
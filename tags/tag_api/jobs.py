@@ -0,0 +1,177 @@
+import datetime
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job, TagsModel, UserProfile, VMTag
+from .routers import use_primary
+
+logger = logging.getLogger(__name__)
+
+# Job handlers, keyed by action. A handler receives the Job and yields the
+# number of items it processed after each committed batch.
+HANDLERS = {}
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class _Slot:
+    """
+    A place in the pending-job count, given back by release() once the job's
+    worker is done. A job that never reaches a worker gives it back when the
+    slot is dropped: a rolled-back transaction discards the on_commit
+    callback holding it.
+    """
+
+    def __init__(self):
+        # Calling a finalizer runs it at most once, however it is triggered
+        self.release = weakref.finalize(self, _release)
+
+
+def job_setting(name, default):
+    return getattr(settings, 'TAG_JOBS', {}).get(name, default)
+
+
+def register(action):
+    def decorator(func):
+        HANDLERS[action] = func
+        return func
+    return decorator
+
+
+def _get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            fail_stale()
+            # A small fixed pool keeps bulk jobs from taking every DB connection
+            # away from interactive requests.
+            _executor = ThreadPoolExecutor(
+                max_workers=job_setting('MAX_WORKERS', 2),
+                thread_name_prefix='tag-jobs',
+            )
+        return _executor
+
+
+def submit(action, payload, total=0):
+    global _pending
+
+    if action not in HANDLERS:
+        raise ValueError("Unknown job action: {0}".format(action))
+
+    with _pending_lock:
+        if _pending >= job_setting('MAX_PENDING', 100):
+            raise JobQueueFull("Too many jobs are pending, try again later")
+        _pending += 1
+    slot = _Slot()
+
+    try:
+        job = Job.objects.create(action=action, payload=payload, total=total)
+    except Exception:
+        slot.release()
+        raise
+
+    # Only hand the job to a worker once the row is visible to other connections
+    transaction.on_commit(lambda: _get_executor().submit(_run, job.job_id, slot))
+    return job
+
+
+def _release():
+    global _pending
+
+    with _pending_lock:
+        _pending -= 1
+
+
+def _run(job_id, slot):
+    close_old_connections()
+    try:
+        # Jobs read what the submitting request just wrote
+        with use_primary():
+            run_job(job_id)
+    finally:
+        slot.release()
+        connection.close()
+
+
+def fail_stale():
+    """
+    Mark failed the queued and running jobs left untouched for STALE_AFTER
+    seconds: the process that held them died. Runs as each process starts
+    its worker pool. Running jobs touch their row after every batch, and a
+    worker only starts a job that is still queued, so a job failed here is
+    never picked up late.
+    """
+    cutoff = timezone.now() - datetime.timedelta(seconds=job_setting('STALE_AFTER', 3600))
+    stale = Job.objects.filter(status__in=(Job.STATUS_QUEUED, Job.STATUS_RUNNING), updated_at__lt=cutoff)
+    count = stale.update(status=Job.STATUS_FAILED, error="Interrupted: the worker running this job stopped", updated_at=timezone.now())
+    if count:
+        logger.warning("Marked %d interrupted jobs as failed", count)
+    return count
+
+
+def run_job(job_id):
+    job = Job.objects.get(job_id=job_id)
+    # Claims the job, unless fail_stale() gave up on it while it waited
+    if not Job.objects.filter(job_id=job_id, status=Job.STATUS_QUEUED).update(status=Job.STATUS_RUNNING, updated_at=timezone.now()):
+        logger.warning("Job %s is no longer queued, skipping it", job_id)
+        return
+    pause = job_setting('BATCH_PAUSE', 0)
+
+    try:
+        for count in HANDLERS[job.action](job):
+            _update(job_id, processed=F('processed') + count)
+            if pause:
+                time.sleep(pause)
+
+    except Exception as e:
+        logger.exception("Job %s failed", job_id)
+        _update(job_id, status=Job.STATUS_FAILED, error=str(e))
+        return
+
+    _update(job_id, status=Job.STATUS_DONE)
+
+
+def _update(job_id, **fields):
+    # queryset.update() skips auto_now, so bump updated_at here
+    Job.objects.filter(job_id=job_id).update(updated_at=timezone.now(), **fields)
+
+
+def batches(items, size=None):
+    size = size or job_setting('BATCH_SIZE', 1000)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+@register('assign')
+def assign_tag(job):
+    tag = TagsModel.objects.get(tag_id=job.payload['tag_id'])
+    assigned_by = job.payload.get('assigned_by')
+    assigned_by = UserProfile.objects.get(user_id=assigned_by) if assigned_by is not None else None
+    for chunk in batches(job.payload['vm_ids']):
+        # assign() commits (and retries) chunk by chunk itself
+        VMTag.assign(tag, chunk, assigned_by)
+        yield len(chunk)
+
+
+@register('unassign')
+def unassign_tag(job):
+    tag = TagsModel.objects.get(tag_id=job.payload['tag_id'])
+    for chunk in batches(job.payload['vm_ids']):
+        VMTag.unassign(tag, chunk)
+        yield len(chunk)
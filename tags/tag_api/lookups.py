@@ -0,0 +1,93 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.http import QueryDict
+
+DEFAULT_LOOKUPS = {
+    # Most values one list parameter may hold
+    'MAX_VALUES': 1000,
+    # Values per IN (...) query; keeps statements under backend parameter limits
+    'CHUNK_SIZE': 500,
+}
+
+
+def lookup_setting(name):
+    return getattr(settings, 'TAG_LOOKUPS', {}).get(name, DEFAULT_LOOKUPS[name])
+
+
+def param_values(request, name, to_python=None, split=True):
+    """
+    Values of a query parameter that may be repeated (?a=1&a=2) and, with
+    `split`, comma separated (?a=1,2).
+
+    Names are not split, as they may contain commas. Values are converted
+    with `to_python`, de-duplicated and kept in request order.
+    """
+    values = []
+    for value in request.GET.getlist(name):
+        values.extend([part.strip() for part in value.split(',')] if split else [value])
+
+    result = []
+    for value in values:
+        if value == '':
+            continue
+        if to_python is not None:
+            try:
+                value = to_python(value)
+            except (ValidationError, ValueError, TypeError):
+                raise ValidationError("Invalid {0}: {1}".format(name, value))
+        if value not in result:
+            result.append(value)
+
+    max_values = lookup_setting('MAX_VALUES')
+    if len(result) > max_values:
+        raise ValidationError("{0} can hold at most {1} values".format(name, max_values))
+    return result
+
+
+def fetch(queryset, field, values, serialize, limit=None):
+    # serialize() over queryset.filter(field__in=values), one query per chunk,
+    # stopping once `limit` rows are in
+    size = lookup_setting('CHUNK_SIZE')
+    rows = []
+    for start in range(0, len(values), size):
+        if limit is not None and len(rows) >= limit:
+            break
+        rows.extend(serialize(queryset.filter(**{field + '__in': values[start:start + size]})))
+    return rows
+
+
+def count(queryset, field, values):
+    size = lookup_setting('CHUNK_SIZE')
+    return sum(
+        queryset.filter(**{field + '__in': values[start:start + size]}).distinct().count()
+        for start in range(0, len(values), size)
+    )
+
+
+def in_request_order(rows, key, values):
+    """
+    Sort rows into the order their `key` was asked for in.
+
+    Returns (rows, missing), `missing` holding the values that matched no
+    row. Rows sharing a value (tags of the same name) stay together.
+    """
+    position = {str(value): index for index, value in enumerate(values)}
+    rows.sort(key=lambda row: position.get(str(row[key]), len(position)))
+    found = {str(row[key]) for row in rows}
+    return rows, [str(value) for value in values if str(value) not in found]
+
+
+def body_query(data):
+    """
+    QueryDict standing in for the query string of a lookup sent as a JSON
+    body, for id lists too long for a URL: {"tag_id": ["a", "b"]}.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError("Request body must be a JSON object")
+
+    query = QueryDict(mutable=True)
+    for name, value in data.items():
+        values = value if isinstance(value, list) else [value]
+        # JSON true/false as the query string would spell them
+        query.setlist(name, [str(item).lower() if isinstance(item, bool) else str(item) for item in values])
+    return query
@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count
+
+from tag_api.models import TagsModel, VM
+
+
+class Command(BaseCommand):
+    help = "Report vms_tags table and index size and time a VM-by-tag join; run before and after a storage change"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def table_sizes(self, table):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'mysql':
+                cursor.execute(
+                    "SELECT data_length, index_length FROM information_schema.TABLES "
+                    "WHERE table_schema = DATABASE() AND table_name = %s", [table])
+                return cursor.fetchone()
+
+            if connection.vendor == 'sqlite':
+                # Needs SQLite built with the dbstat virtual table
+                cursor.execute(
+                    "SELECT SUM(CASE WHEN name = %s THEN pgsize ELSE 0 END), "
+                    "SUM(CASE WHEN name != %s THEN pgsize ELSE 0 END) "
+                    "FROM dbstat WHERE name = %s OR name IN "
+                    "(SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s)", [table, table, table, table])
+                return cursor.fetchone()
+
+        return None, None
+
+    def handle(self, *args, **options):
+        through = VM.tags.through._meta
+
+        with connection.cursor() as cursor:
+            description = connection.introspection.get_table_description(cursor, through.db_table)
+        for column in description:
+            if column.name != 'id':
+                self.stdout.write("{0}.{1}: {2}".format(through.db_table, column.name, column.type_code))
+
+        try:
+            data, index = self.table_sizes(through.db_table)
+            self.stdout.write("rows: {0}  data: {1} bytes  indexes: {2} bytes".format(VM.tags.through.objects.count(), data, index))
+        except Exception as e:
+            self.stdout.write("table size unavailable: {0}".format(e))
+
+        # The most assigned tag gives the largest join
+        tag = TagsModel.objects.annotate(vm_count=Count('vms')).order_by('-vm_count').first()
+        if tag is None or not tag.vm_count:
+            self.stdout.write("no assignments to time")
+            return
+
+        timings = []
+        for _ in range(options['repeat']):
+            start = time.perf_counter()
+            count = len(VM.objects.filter(tags__tag_name=tag.tag_name, tags__scope_ref=tag.scope_ref_id).values_list('vm_id', flat=True))
+            timings.append(time.perf_counter() - start)
+
+        self.stdout.write("join VMs by tag {0!r}: {1} rows, best {2:.2f} ms".format(tag.tag_name, count, min(timings) * 1000))
@@ -0,0 +1,67 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+
+from tag_api import metrics
+from tag_api.coalescing import DEFAULT_COALESCING
+
+
+class Command(BaseCommand):
+    help = "Load test: identical concurrent GETs with request coalescing off and on, counting DB queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='/vms')
+        parser.add_argument('--query', default='', help="Query string, e.g. tag_name=web&scope=prod")
+        parser.add_argument('--threads', type=int, default=32)
+        parser.add_argument('--rounds', type=int, default=20)
+
+    def handle(self, *args, **options):
+        url = options['path'] + ('?' + options['query'] if options['query'] else '')
+        host = next((host.lstrip('.') for host in settings.ALLOWED_HOSTS if '*' not in host), 'localhost')
+
+        self.stdout.write("{0:<10} {1:>9} {2:>9} {3:>9} {4:>9}".format('coalescing', 'requests', 'queries', 'shared', 'ms'))
+        for enabled in (False, True):
+            coalescing = dict(getattr(settings, 'TAG_COALESCING', DEFAULT_COALESCING), ENABLED=enabled)
+            with override_settings(TAG_COALESCING=coalescing, TAG_RATE_LIMITS={'ENABLED': False}):
+                metrics.reset()
+                requests, queries, elapsed = self.run(url, host, options['threads'], options['rounds'])
+
+            self.stdout.write("{0:<10} {1:>9} {2:>9} {3:>9} {4:>9.1f}".format(
+                'on' if enabled else 'off', requests, queries, metrics.snapshot().get('coalescing.shared', 0), elapsed * 1000))
+
+    def run(self, url, host, threads, rounds):
+        barrier = threading.Barrier(threads)
+        lock = threading.Lock()
+        totals = {'requests': 0, 'queries': 0}
+
+        def count(execute, sql, params, many, context):
+            with lock:
+                totals['queries'] += 1
+            return execute(sql, params, many, context)
+
+        def worker():
+            client = Client(SERVER_NAME=host)
+            try:
+                with connection.execute_wrapper(count):
+                    for _ in range(rounds):
+                        # Every thread sends its request at the same moment
+                        barrier.wait()
+                        response = client.get(url)
+                        if response.status_code != 200:
+                            raise RuntimeError("{0} returned {1}".format(url, response.status_code))
+                        with lock:
+                            totals['requests'] += 1
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        start = time.perf_counter()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return totals['requests'], totals['queries'], time.perf_counter() - start
@@ -0,0 +1,54 @@
+import random
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from tag_api import middleware
+from tag_api.serializers import dumps
+
+
+class Command(BaseCommand):
+    help = "Compare size and CPU time of the response compressors on realistic tag and VM listings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=20000)
+        parser.add_argument('--repeat', type=int, default=3)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        scopes = ['tenant-{0}'.format(i) for i in range(20)]
+        user_ids = list(range(1, 50))
+
+        listings = {
+            'vms': {'status': 'success', 'error_code': 0, 'message': "VMs retrieved successfully", 'data': [
+                {'vm_id': str(uuid.uuid4()), 'vm_name': 'vm-{0:08d}'.format(i), 'creation_date': now}
+                for i in range(options['rows'])
+            ]},
+            'tags': {'status': 'success', 'error_code': 0, 'message': "Tags get successfully", 'data': [
+                {'tag_id': str(uuid.uuid4()), 'tag_name': 'env={0}'.format(i), 'scope': random.choice(scopes), 'user_id_id': random.choice(user_ids)}
+                for i in range(options['rows'])
+            ]},
+        }
+
+        levels = [('gzip', level) for level in (1, 6, 9)]
+        if middleware.brotli is None:
+            self.stdout.write("brotli is not installed, skipping it")
+        else:
+            levels += [('br', quality) for quality in (1, 4, 11)]
+
+        self.stdout.write("{0:<6} {1:<6} {2:>6} {3:>12} {4:>8} {5:>10}".format('list', 'codec', 'level', 'bytes', 'ratio', 'ms'))
+        for name, data in listings.items():
+            content = dumps(data)
+            self.stdout.write("{0:<6} {1:<6} {2:>6} {3:>12} {4:>8} {5:>10}".format(name, 'none', '-', len(content), '1.00', '-'))
+
+            for encoding, level in levels:
+                timings = []
+                for _ in range(options['repeat']):
+                    start = time.perf_counter()
+                    compressed = middleware.compress(content, encoding, level)
+                    timings.append(time.perf_counter() - start)
+
+                self.stdout.write("{0:<6} {1:<6} {2:>6} {3:>12} {4:>8.2f} {5:>10.2f}".format(
+                    name, encoding, level, len(compressed), len(content) / len(compressed), min(timings) * 1000))
@@ -0,0 +1,42 @@
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from tag_api import renderers
+
+
+class Command(BaseCommand):
+    help = "Compare payload size and encoding time of the response formats on a synthetic VM listing"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        rows = [
+            {'vm_id': uuid.uuid4(), 'vm_name': 'vm-{0:08d}'.format(i), 'creation_date': now}
+            for i in range(options['rows'])
+        ]
+        data = {'status': 'success', 'error_code': 0, 'message': "VMs retrieved successfully", 'data': rows}
+
+        if renderers.msgpack is None:
+            self.stdout.write("msgpack is not installed, skipping it")
+
+        self.stdout.write("{0:<40} {1:>12} {2:>10}".format('media type', 'bytes', 'ms'))
+        seen = set()
+        for media_type, encode in sorted(renderers.FORMATS.items()):
+            # Aliases such as application/x-msgpack share an encoder
+            if encode in seen:
+                continue
+            seen.add(encode)
+
+            timings = []
+            for _ in range(options['repeat']):
+                start = time.perf_counter()
+                payload = encode(data)
+                timings.append(time.perf_counter() - start)
+
+            self.stdout.write("{0:<40} {1:>12} {2:>10.2f}".format(media_type, len(payload), min(timings) * 1000))
@@ -0,0 +1,30 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from tag_api.transfer import FORMATS, TABLES, WRITERS, Progress, iter_rows
+
+
+class Command(BaseCommand):
+    help = "Export users, tags, VMs and VM-tag assignments to CSV or NDJSON files"
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--chunk-size', type=int, default=10000)
+        parser.add_argument('--progress-every', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        os.makedirs(options['directory'], exist_ok=True)
+
+        for name, model, columns in TABLES:
+            path = os.path.join(options['directory'], '{0}.{1}'.format(name, options['format']))
+            progress = Progress(self.stdout.write, name, options['progress_every'])
+
+            with open(path, 'w', newline='', encoding='utf-8') as stream:
+                writer = WRITERS[options['format']](stream, columns)
+                for row in iter_rows(model, columns, options['chunk_size']):
+                    writer.write(row)
+                    progress.add(1)
+
+            progress.report(done=True)
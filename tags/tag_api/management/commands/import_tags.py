@@ -0,0 +1,43 @@
+import itertools
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from tag_api.transfer import FORMATS, TABLES, Progress, instance_builder, keep_auto_now, read_rows
+
+
+class Command(BaseCommand):
+    help = "Import users, tags, VMs and VM-tag assignments written by export_tags"
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--ignore-conflicts', action='store_true', help="Skip rows that already exist")
+        parser.add_argument('--progress-every', type=int, default=100000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        for name, model, columns in TABLES:
+            path = os.path.join(options['directory'], '{0}.{1}'.format(name, options['format']))
+            if not os.path.exists(path):
+                raise CommandError("Missing file: {0}".format(path))
+
+            build = instance_builder(model, columns)
+            progress = Progress(self.stdout.write, name, options['progress_every'])
+
+            with open(path, newline='', encoding='utf-8') as stream, keep_auto_now(model):
+                rows = read_rows(stream, options['format'], model, columns)
+                while True:
+                    batch = [build(row) for row in itertools.islice(rows, batch_size)]
+                    if not batch:
+                        break
+
+                    # One short transaction per batch keeps lock time and undo log bounded
+                    with transaction.atomic():
+                        model.objects.bulk_create(batch, batch_size=batch_size, ignore_conflicts=options['ignore_conflicts'])
+                    progress.add(len(batch))
+
+            progress.report(done=True)
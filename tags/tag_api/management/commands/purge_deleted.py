@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from tag_api.models import UserProfile, VM
+from tag_api.purge import purge_deleted
+
+
+class Command(BaseCommand):
+    help = "Purge soft-deleted VMs and users whose background purge did not run, in batches"
+
+    def handle(self, *args, **options):
+        vms = VM.all_objects.exclude(deleted_at=None).count()
+        users = UserProfile.all_objects.exclude(deleted_at=None).count()
+
+        rows = sum(purge_deleted())
+        self.stdout.write(self.style.SUCCESS("Purged {0} VMs and {1} users ({2} rows)".format(vms, users, rows)))
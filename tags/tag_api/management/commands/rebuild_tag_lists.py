@@ -0,0 +1,34 @@
+import itertools
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from tag_api import tag_lists
+from tag_api.models import VM
+from tag_api.transfer import iter_rows
+
+
+class Command(BaseCommand):
+    help = "Rebuild the denormalized VM tag lists from the vms_tags table, fixing any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--dry-run', action='store_true', help="Only report VMs whose list is out of date")
+
+    def handle(self, *args, **options):
+        vm_ids = (vm_id for vm_id, in iter_rows(VM, ['vm_id'], options['batch_size']))
+        checked = repaired = 0
+
+        while True:
+            batch = list(itertools.islice(vm_ids, options['batch_size']))
+            if not batch:
+                break
+            checked += len(batch)
+
+            # refresh() locks the batch's VM rows before reading vms_tags, so
+            # a concurrent tag change is never overwritten with a stale list
+            with transaction.atomic():
+                repaired += tag_lists.refresh(batch, dry_run=options['dry_run'])
+
+        action = "out of date" if options['dry_run'] else "repaired"
+        self.stdout.write(self.style.SUCCESS("Checked {0} VMs, {1} {2}".format(checked, repaired, action)))
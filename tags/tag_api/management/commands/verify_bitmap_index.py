@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tag_api.bitmaps import TagBitmapIndex
+
+
+class Command(BaseCommand):
+    # This process has no index of its own; the ones serving /vms are
+    # checked as they rebuild (see bitmaps.rebuild() and VERIFY_ON_REBUILD)
+    help = "Build a fresh tag bitmap index from the primary and check it against the vms_tags table"
+
+    def handle(self, *args, **options):
+        index = TagBitmapIndex()
+
+        start = time.perf_counter()
+        index.build()
+        self.stdout.write("Built index for {0} VMs and {1} tags in {2:.1f} ms".format(
+            len(index.alive), len(index.bitmaps), (time.perf_counter() - start) * 1000))
+
+        mismatches = index.verify()
+        for tag_id, (missing, extra) in mismatches.items():
+            self.stdout.write("tag {0}: {1} missing, {2} extra".format(tag_id, len(missing), len(extra)))
+
+        if mismatches:
+            raise CommandError("{0} tags do not match the database".format(len(mismatches)))
+
+        self.stdout.write(self.style.SUCCESS("Index matches the database"))
@@ -0,0 +1,22 @@
+import threading
+from collections import defaultdict
+
+# Per-process counters, served by GET /metrics. Each worker process reports
+# its own numbers; a scraper sums them.
+_counters = defaultdict(int)
+_lock = threading.Lock()
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
@@ -0,0 +1,201 @@
+import re
+import zlib
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+
+from . import coalescing, routers
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+DEFAULT_COMPRESSION = {
+    'MIN_SIZE': 1024,
+    'CONTENT_TYPES': (
+        'application/json',
+        'application/vnd.tags.columnar+json',
+        'text/csv',
+        'text/plain',
+    ),
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 4,
+}
+
+
+def compression_setting(name):
+    return getattr(settings, 'TAG_COMPRESSION', {}).get(name, DEFAULT_COMPRESSION[name])
+
+
+def gzip_compressor(level=None):
+    # wbits=31 writes a gzip header and trailer instead of a bare zlib stream
+    level = compression_setting('GZIP_LEVEL') if level is None else level
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+def brotli_compressor(quality=None):
+    quality = compression_setting('BROTLI_QUALITY') if quality is None else quality
+    compressor = brotli.Compressor(quality=quality)
+    return compressor.process, compressor.flush, compressor.finish
+
+
+COMPRESSORS = {'gzip': gzip_compressor}
+
+if brotli is not None:
+    COMPRESSORS['br'] = brotli_compressor
+
+
+def compress(content, encoding, level=None):
+    process, _, finish = COMPRESSORS[encoding](level)
+    return process(content) + finish()
+
+
+def compress_stream(chunks, encoding, level=None):
+    process, flush, finish = COMPRESSORS[encoding](level)
+    for chunk in chunks:
+        # Flush after every chunk so clients can decode the stream as it arrives
+        data = process(chunk) + flush()
+        if data:
+            yield data
+    yield finish()
+
+
+def accepted_encoding(request):
+    accepted = {}
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        match = re.search(r'q=([0-9.]+)', params)
+        if match:
+            try:
+                q = float(match.group(1))
+            except ValueError:
+                q = 0.0
+        accepted[coding.strip().lower()] = q
+
+    # Prefer brotli over gzip when the client accepts both
+    for encoding in ('br', 'gzip'):
+        if encoding in COMPRESSORS and accepted.get(encoding, 0) > 0:
+            return encoding
+    return None
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Gzip/Brotli compression for API responses.
+
+    Only responses whose content type is in TAG_COMPRESSION['CONTENT_TYPES']
+    are compressed. Buffered responses also have to be at least
+    TAG_COMPRESSION['MIN_SIZE'] bytes; streaming responses are compressed
+    chunk by chunk.
+    """
+
+    def process_response(self, request, response):
+        if response.has_header('Content-Encoding'):
+            return response
+
+        if not response.streaming and len(response.content) < compression_setting('MIN_SIZE'):
+            return response
+
+        content_type = response.get('Content-Type', '').split(';')[0].strip().lower()
+        if content_type not in compression_setting('CONTENT_TYPES'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        encoding = accepted_encoding(request)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = compress_stream(response.streaming_content, encoding)
+            del response['Content-Length']
+        else:
+            compressed = compress(response.content, encoding)
+            if len(compressed) >= len(response.content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+
+        response['Content-Encoding'] = encoding
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Decide per request whether reads may go to a replica.
+
+    Write requests always use the primary, and so do reads from a client
+    that wrote within the last TAG_DB_REPLICAS['STICKY_SECONDS'] (tracked
+    by a cookie set on the write's response).
+    """
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        write = request.method not in self.safe_methods
+
+        with routers.use_primary(write or routers.recently_wrote(request)):
+            response = self.get_response(request)
+
+        if write:
+            routers.remember_write(response)
+        return response
+
+
+class CoalescingMiddleware:
+    """
+    Share one response between identical GETs running at the same time in
+    this worker (see tag_api/coalescing.py).
+
+    Works with WSGI threads and with ASGI coroutines. Shared responses carry
+    an X-Coalesced header. Sits inside ReplicaRoutingMiddleware, so requests
+    pinned to the primary never share a replica read.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            # Lets the handler see the instance as async, as MiddlewareMixin does
+            markcoroutinefunction(self)
+            self.flights = coalescing.async_flights
+        else:
+            self.flights = coalescing.flights
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        key = coalescing.request_key(request)
+        if key is None:
+            return self.get_response(request)
+
+        frozen, response = self.flights.do(key, lambda: self.get_response(request))
+        return response if frozen is None else self.shared(frozen)
+
+    async def __acall__(self, request):
+        key = coalescing.request_key(request)
+        if key is None:
+            return await self.get_response(request)
+
+        frozen, response = await self.flights.do(key, lambda: self.get_response(request))
+        return response if frozen is None else self.shared(frozen)
+
+    def shared(self, frozen):
+        response = coalescing.thaw(frozen)
+        response['X-Coalesced'] = '1'
+        return response
+
@@ -0,0 +1,33 @@
+# Generated by Django 4.1.5 on 2024-01-08 10:12
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0018_alter_tagsmodel_tag_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('job_id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('action', models.CharField(max_length=50, verbose_name='action')),
+                ('payload', models.JSONField(default=dict, verbose_name='payload')),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('done', 'done'), ('failed', 'failed')], default='queued', max_length=20, verbose_name='status')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='total')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='processed')),
+                ('error', models.TextField(blank=True, null=True, verbose_name='error')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='created_at')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='updated_at')),
+            ],
+            options={
+                'verbose_name': 'jobs',
+                'db_table': 'jobs',
+                'managed': True,
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.1.5 on 2024-01-10 09:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0019_job'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='tagsmodel',
+            index=models.Index(fields=['scope', 'tag_name'], name='tags_scope_name_idx'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 4.1.5 on 2024-01-12 11:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_scopes(apps, schema_editor):
+    Scope = apps.get_model('tag_api', 'Scope')
+    TagsModel = apps.get_model('tag_api', 'TagsModel')
+
+    names = TagsModel.objects.exclude(scope=None).values_list('scope', flat=True).distinct()
+    for name in names.iterator():
+        scope = Scope.objects.create(name=name)
+        # One set-based UPDATE per scope rather than a save() per tag
+        TagsModel.objects.filter(scope=name).update(scope_ref=scope)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0020_tagsmodel_scope_name_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Scope',
+            fields=[
+                ('scope_id', models.AutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='name')),
+            ],
+            options={
+                'verbose_name': 'scopes',
+                'db_table': 'scopes',
+                'managed': True,
+            },
+        ),
+        migrations.AddField(
+            model_name='tagsmodel',
+            name='scope_ref',
+            field=models.ForeignKey(blank=True, db_column='scope_id', null=True, on_delete=django.db.models.deletion.PROTECT, related_name='tags', to='tag_api.scope'),
+        ),
+        migrations.RunPython(backfill_scopes, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='tagsmodel',
+            name='tags_scope_name_idx',
+        ),
+        migrations.AlterUniqueTogether(
+            name='tagsmodel',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='tagsmodel',
+            constraint=models.UniqueConstraint(fields=('scope_ref', 'tag_name'), name='tags_scope_tag_name_uniq'),
+        ),
+    ]
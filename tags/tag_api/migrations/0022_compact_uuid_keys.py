@@ -0,0 +1,80 @@
+# Generated by Django 4.1.5 on 2024-01-15 14:03
+
+from django.db import migrations
+import tag_api.fields
+import uuid
+
+
+# Every UUID column behind the VM/tag many-to-many join
+UUID_COLUMNS = [
+    ('vms', 'vm_id'),
+    ('tags', 'tag_id'),
+    ('vms_tags', 'vm_id'),
+    ('vms_tags', 'tagsmodel_id'),
+]
+
+
+def _foreign_keys(schema_editor, table):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    return {name: constraint for name, constraint in constraints.items() if constraint['foreign_key']}
+
+
+def _convert(schema_editor, expression, final_type):
+    # Only MySQL changes storage; other backends keep their UUID column type
+    if schema_editor.connection.vendor != 'mysql':
+        return
+
+    quote = schema_editor.quote_name
+    foreign_keys = _foreign_keys(schema_editor, 'vms_tags')
+
+    # MySQL refuses to change the type of a column on either side of a foreign key
+    for name in foreign_keys:
+        schema_editor.execute('ALTER TABLE vms_tags DROP FOREIGN KEY {0}'.format(quote(name)))
+
+    for table, column in UUID_COLUMNS:
+        # varbinary in between so the value can shrink or grow without charset checks
+        schema_editor.execute('ALTER TABLE {0} MODIFY {1} varbinary(32) NOT NULL'.format(quote(table), quote(column)))
+        schema_editor.execute('UPDATE {0} SET {1} = {2}'.format(quote(table), quote(column), expression.format(quote(column))))
+        schema_editor.execute('ALTER TABLE {0} MODIFY {1} {2} NOT NULL'.format(quote(table), quote(column), final_type))
+
+    for name, constraint in foreign_keys.items():
+        to_table, to_column = constraint['foreign_key']
+        schema_editor.execute('ALTER TABLE vms_tags ADD CONSTRAINT {0} FOREIGN KEY ({1}) REFERENCES {2} ({3})'.format(
+            quote(name), quote(constraint['columns'][0]), quote(to_table), quote(to_column)))
+
+
+def to_binary(apps, schema_editor):
+    _convert(schema_editor, 'UNHEX({0})', 'binary(16)')
+
+
+def to_hex(apps, schema_editor):
+    _convert(schema_editor, 'LOWER(HEX({0}))', 'char(32)')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0021_scope'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(to_binary, to_hex),
+            ],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='tagsmodel',
+                    name='tag_id',
+                    field=tag_api.fields.CompactUUIDField(default=uuid.uuid4, primary_key=True, serialize=False, unique=True),
+                ),
+                migrations.AlterField(
+                    model_name='vm',
+                    name='vm_id',
+                    field=tag_api.fields.CompactUUIDField(default=uuid.uuid4, primary_key=True, serialize=False, unique=True),
+                ),
+            ],
+        ),
+    ]
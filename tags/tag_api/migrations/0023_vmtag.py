@@ -0,0 +1,68 @@
+# Generated by Django 4.1.5 on 2024-01-16 10:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0022_compact_uuid_keys'),
+    ]
+
+    operations = [
+        # VMTag takes over the implicit vms_tags table as is: same name,
+        # columns and unique index, so no row is copied
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='VMTag',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('vm', models.ForeignKey(db_column='vm_id', on_delete=django.db.models.deletion.CASCADE, to='tag_api.vm')),
+                        ('tag', models.ForeignKey(db_column='tagsmodel_id', on_delete=django.db.models.deletion.CASCADE, to='tag_api.tagsmodel')),
+                    ],
+                    options={
+                        'verbose_name': 'vms_tags',
+                        'db_table': 'vms_tags',
+                        'managed': True,
+                        'unique_together': {('vm', 'tag')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='vm',
+                    name='tags',
+                    field=models.ManyToManyField(related_name='vms', through='tag_api.VMTag', to='tag_api.tagsmodel'),
+                ),
+            ],
+        ),
+        # Existing assignments get the migration time
+        migrations.AddField(
+            model_name='vmtag',
+            name='assigned_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now, verbose_name='assigned_at'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='vmtag',
+            name='assigned_by',
+            field=models.ForeignKey(blank=True, db_column='assigned_by', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='tag_api.userprofile'),
+        ),
+        # Add the reverse index before dropping the single-column ones, MySQL
+        # needs an index on each foreign key at all times
+        migrations.AddIndex(
+            model_name='vmtag',
+            index=models.Index(fields=['tag', 'vm'], name='vms_tags_tag_vm_idx'),
+        ),
+        migrations.AlterField(
+            model_name='vmtag',
+            name='vm',
+            field=models.ForeignKey(db_column='vm_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, to='tag_api.vm'),
+        ),
+        migrations.AlterField(
+            model_name='vmtag',
+            name='tag',
+            field=models.ForeignKey(db_column='tagsmodel_id', db_index=False, on_delete=django.db.models.deletion.CASCADE, to='tag_api.tagsmodel'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2024-01-16 15:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0023_vmtag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vm',
+            name='tag_list',
+            field=models.JSONField(blank=True, default=list, verbose_name='tag_list'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2024-01-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0024_vm_tag_list'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vm',
+            name='version',
+            field=models.PositiveIntegerField(default=1, verbose_name='version'),
+        ),
+    ]
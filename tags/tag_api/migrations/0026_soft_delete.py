@@ -0,0 +1,28 @@
+# Generated by Django 4.1.5 on 2024-01-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0025_vm_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tagsmodel',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='deleted_at'),
+        ),
+        migrations.AddField(
+            model_name='userprofile',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='deleted_at'),
+        ),
+        migrations.AddField(
+            model_name='vm',
+            name='deleted_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='deleted_at'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.1.5 on 2024-01-19 14:20
+
+from django.db import migrations, models
+
+
+def backfill_key_value(apps, schema_editor):
+    TagsModel = apps.get_model('tag_api', 'TagsModel')
+
+    # Same split as models.split_tag_name(), which may change after this migration
+    def split(tag_name):
+        key, sep, value = tag_name.partition('=')
+        return key.strip() or None, value.strip() if sep else None
+
+    # Keyset pages of 1000, one bulk UPDATE each
+    tags = TagsModel.objects.exclude(tag_name=None).order_by('pk').only('tag_id', 'tag_name')
+    last = None
+    while True:
+        page = list((tags if last is None else tags.filter(pk__gt=last))[:1000])
+        if not page:
+            break
+        for tag in page:
+            tag.key, tag.value = split(tag.tag_name)
+        TagsModel.objects.bulk_update(page, ['key', 'value'])
+        last = page[-1].pk
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0026_soft_delete'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tagsmodel',
+            name='key',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='key'),
+        ),
+        migrations.AddField(
+            model_name='tagsmodel',
+            name='value',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='value'),
+        ),
+        # Filled before the index exists, so it is built once
+        migrations.RunPython(backfill_key_value, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='tagsmodel',
+            index=models.Index(fields=['key', 'value'], name='tags_key_value_idx'),
+        ),
+    ]
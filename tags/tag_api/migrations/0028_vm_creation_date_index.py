@@ -0,0 +1,18 @@
+# Generated by Django 4.1.5 on 2024-01-20 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tag_api', '0027_tag_key_value'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='vm',
+            name='creation_date',
+            field=models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='creation_date'),
+        ),
+    ]
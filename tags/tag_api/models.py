@@ -1,33 +1,126 @@
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
+from django.db.models.signals import m2m_changed
+from django.dispatch import Signal
+from django.utils import timezone
 from django import forms
 from django.core.exceptions import ValidationError
 import uuid
 from django.http import JsonResponse
 
+from . import assignments
+from .fields import CompactUUIDField
+
+# Sent with `instance` when a row is soft-deleted, so in-memory indexes can
+# drop it before purge.py removes it from the database
+soft_deleted = Signal()
+
+
+class LiveManager(models.Manager):
+    # Rows that are not soft-deleted; `all_objects` sees every row
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at=None)
+
 
 class UserProfile(models.Model):
     user_id = models.AutoField(primary_key=True)
     user_name = models.CharField(max_length=255)
     # is_admin = models.BooleanField(default=False)
+    # Set by soft_delete(); the purger removes the row later
+    deleted_at = models.DateTimeField('deleted_at', blank=True, null=True, db_index=True)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
 
     class Meta:
         managed = True
         db_table = 'user'
         verbose_name = 'user'
 
+    def soft_delete(self):
+        """
+        Hide the user and their tags at once.
+
+        Two UPDATEs instead of the cascade collector; purge.purge_user()
+        deletes the rows, and the tags' vms_tags rows, in batches later.
+        """
+        self.deleted_at = timezone.now()
+        with transaction.atomic():
+            UserProfile.all_objects.filter(pk=self.pk).update(deleted_at=self.deleted_at)
+            tags = list(TagsModel.objects.filter(user_id=self).only('tag_id'))
+            TagsModel.objects.filter(user_id=self).update(deleted_at=self.deleted_at)
+            for tag in tags:
+                soft_deleted.send(sender=TagsModel, instance=tag)
+            soft_deleted.send(sender=UserProfile, instance=self)
+
+
+class Scope(models.Model):
+    scope_id = models.AutoField(primary_key=True)
+    name = models.CharField('name', max_length=255, unique=True)
+
+    class Meta:
+        managed = True
+        db_table = 'scopes'
+        verbose_name = 'scopes'
+
+    @classmethod
+    def for_name(cls, name):
+        if name is None:
+            return None
+        return cls.objects.get_or_create(name=name)[0]
+
+
+def split_tag_name(tag_name):
+    # 'env=prod' -> ('env', 'prod'); a name without '=' is a key with no value
+    if tag_name is None:
+        return None, None
+    key, sep, value = tag_name.partition('=')
+    return key.strip() or None, value.strip() if sep else None
+
 
 class TagsModel(models.Model):
-    tag_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=True, unique=True)
+    tag_id = CompactUUIDField(primary_key=True, default=uuid.uuid4, editable=True, unique=True)
     tag_name  = models.CharField('tag_name',max_length=255, blank=True, null=True)
     scope  = models.CharField('scope',max_length=255, blank=True, null=True)
     user_id = models.ForeignKey(UserProfile, to_field='user_id', on_delete=models.CASCADE, db_column='user_id')
+    # Integer key of `scope`; uniqueness and scope filters go through it
+    scope_ref = models.ForeignKey(Scope, on_delete=models.PROTECT, blank=True, null=True, db_column='scope_id', related_name='tags')
+    # Set when the owning user is soft-deleted
+    deleted_at = models.DateTimeField('deleted_at', blank=True, null=True, db_index=True)
+    # tag_name split at its first '=', kept in step by save()
+    key = models.CharField('key', max_length=255, blank=True, null=True)
+    value = models.CharField('value', max_length=255, blank=True, null=True)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
     
     class Meta:
         managed = True
-        unique_together = (('tag_name', 'scope'),)
+        # Scope-prefixed, so per-tenant lookups (and ?fields=tag_id,tag_name) stay on this index
+        constraints = [models.UniqueConstraint(fields=['scope_ref', 'tag_name'], name='tags_scope_tag_name_uniq')]
+        # Serves key-only, key=value and key IN (values) lookups
+        indexes = [models.Index(fields=['key', 'value'], name='tags_key_value_idx')]
         db_table = 'tags'
         verbose_name = 'tags'
 
+    @classmethod
+    def for_name(cls, tag_name, scope, user):
+        """
+        Get the tag, creating it if needed; safe against concurrent creates.
+        """
+        tag = cls.objects.filter(tag_name=tag_name, scope_ref__name=scope).first()
+        if tag is not None:
+            return tag
+
+        tag = cls(tag_name=tag_name, scope=scope, user_id=user)
+        try:
+            with transaction.atomic():
+                tag.save()
+            return tag
+        except (IntegrityError, ValidationError):
+            # Another request created it first. A locking read sees its row
+            # even where our snapshot (MySQL REPEATABLE READ) predates it.
+            return cls.objects.select_for_update().get(tag_name=tag_name, scope_ref__name=scope)
+
     def save(self, *args, **kwargs):
 
         # Set tag_name to None if it is an empty string
@@ -36,20 +129,180 @@ class TagsModel(models.Model):
         # Set scope to None if it is an empty string
         self.scope = None if self.scope == '' else self.scope
 
+        self.scope_ref = Scope.for_name(self.scope)
+        self.key, self.value = split_tag_name(self.tag_name)
+
         # If scope is null, remove it from uniqueness check
-        if TagsModel.objects.filter(tag_name=self.tag_name, scope=self.scope).exists():
+        if TagsModel.objects.filter(tag_name=self.tag_name, scope_ref=self.scope_ref).exclude(pk=self.pk).exists():
             raise ValidationError("This tag already exists.")
-        
-        super().save(*args, **kwargs)
+
+        # post_save listeners (the VM tag lists) commit together with the row
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
 
 class VM(models.Model):
-    vm_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=True, unique=True)
+    vm_id = CompactUUIDField(primary_key=True, default=uuid.uuid4, editable=True, unique=True)
     vm_name = models.CharField('vm_name', max_length=255, unique=True)
-    creation_date = models.DateTimeField('creation_date', auto_now_add=True)
-    tags = models.ManyToManyField('TagsModel', related_name='vms')
+    # Indexed for created_after/created_before range scans and histograms
+    creation_date = models.DateTimeField('creation_date', auto_now_add=True, db_index=True)
+    tags = models.ManyToManyField('TagsModel', related_name='vms', through='VMTag')
+    # [{tag_id, tag_name, scope}] copy of `tags`, kept when TAG_VM_TAG_LISTS is enabled
+    tag_list = models.JSONField('tag_list', default=list, blank=True)
+    # Bumped by every PATCH/PUT, for optimistic concurrency control
+    version = models.PositiveIntegerField('version', default=1)
+    # Set by soft_delete(); the purger removes the row later
+    deleted_at = models.DateTimeField('deleted_at', blank=True, null=True, db_index=True)
+
+    objects = LiveManager()
+    all_objects = models.Manager()
 
     class Meta:
         managed = True
         db_table = 'vms'
         verbose_name = 'vms'
 
+    def soft_delete(self):
+        # Hide the VM with one UPDATE; purge.purge_vm() deletes it and its
+        # vms_tags rows in batches later
+        self.deleted_at = timezone.now()
+        with transaction.atomic():
+            VM.all_objects.filter(pk=self.pk).update(deleted_at=self.deleted_at)
+            soft_deleted.send(sender=VM, instance=self)
+
+
+class VMTag(models.Model):
+    # The old implicit through table, so existing rows and columns are kept
+    vm = models.ForeignKey(VM, on_delete=models.CASCADE, db_column='vm_id', db_index=False)
+    tag = models.ForeignKey(TagsModel, on_delete=models.CASCADE, db_column='tagsmodel_id', db_index=False)
+    assigned_at = models.DateTimeField('assigned_at', auto_now_add=True)
+    assigned_by = models.ForeignKey(UserProfile, to_field='user_id', on_delete=models.SET_NULL, blank=True, null=True, db_column='assigned_by', related_name='+')
+
+    class Meta:
+        managed = True
+        db_table = 'vms_tags'
+        verbose_name = 'vms_tags'
+        # The unique (vm, tag) index serves "tags of a VM", the reverse one
+        # "VMs with a tag"; single-column indexes on either key would be redundant
+        unique_together = [('vm', 'tag')]
+        indexes = [models.Index(fields=['tag', 'vm'], name='vms_tags_tag_vm_idx')]
+
+    @classmethod
+    def assign(cls, tag, vm_ids, assigned_by=None):
+        """
+        Assign `tag` to every VM in `vm_ids` with multi-row INSERTs.
+
+        Each chunk checks the tag and its VM ids and reads which of the VMs
+        already carry the tag, then inserts only the new rows.
+        VMs are written in key order, TAG_ASSIGNMENTS['CHUNK_SIZE'] per
+        transaction, so concurrent calls on overlapping VMs take row locks
+        in the same order and cannot deadlock each other; a chunk that still
+        hits a deadlock or lock timeout is retried. Unknown or soft-deleted
+        VMs and tags raise ValidationError and leave their chunk unwritten.
+        """
+        for chunk in assignments.chunks(cls._sorted_pks(vm_ids)):
+            assignments.atomic_with_retry(cls._assign_chunk, tag, chunk, assigned_by)
+
+    @classmethod
+    def _assign_chunk(cls, tag, vm_ids, assigned_by):
+        cls._check_targets([tag.pk], vm_ids)
+        new = cls._unassigned(tag, vm_ids)
+        # ignore_conflicts only covers a row a concurrent call inserted since
+        # the read; the ids were checked, so no FK error can be dropped
+        cls.objects.bulk_create(
+            [cls(vm_id=vm_id, tag=tag, assigned_by=assigned_by) for vm_id in new],
+            ignore_conflicts=True,
+        )
+        cls._changed('post_add', tag, set(new))
+
+    @staticmethod
+    def _check_targets(tag_ids, vm_ids):
+        """
+        Reject unknown and soft-deleted VMs and tags; `vm_ids` is sorted.
+
+        MySQL's INSERT IGNORE would silently skip rows of unknown VMs instead
+        of failing on their foreign key. A row added to a soft-deleted VM or
+        tag would outlive purge.py's batches and make its final DELETE of
+        the VM or tag fail on the foreign key.
+        """
+        found = set(TagsModel.objects.filter(tag_id__in=tag_ids).values_list('tag_id', flat=True))
+        unknown = [str(tag_id) for tag_id in tag_ids if tag_id not in found]
+        if unknown:
+            raise ValidationError("Unknown or deleted tag ids: {0}".format(', '.join(unknown)))
+
+        # A locking read, in key order: a VM cannot be soft-deleted between
+        # this check and the insert
+        found = set(VM.objects.select_for_update().filter(vm_id__in=vm_ids).order_by('vm_id').values_list('vm_id', flat=True))
+        unknown = [str(vm_id) for vm_id in vm_ids if vm_id not in found]
+        if unknown:
+            raise ValidationError("Unknown or deleted VM ids: {0}".format(', '.join(unknown)))
+
+    @classmethod
+    def _unassigned(cls, tag, vm_ids):
+        # The VMs in `vm_ids` (sorted) that do not carry `tag` yet
+        existing = set(cls.objects.filter(tag=tag, vm_id__in=vm_ids).values_list('vm_id', flat=True))
+        return [vm_id for vm_id in vm_ids if vm_id not in existing]
+
+    @classmethod
+    def unassign(cls, tag, vm_ids):
+        for chunk in assignments.chunks(cls._sorted_pks(vm_ids)):
+            assignments.atomic_with_retry(cls._unassign_chunk, tag, chunk)
+
+    @classmethod
+    def _unassign_chunk(cls, tag, vm_ids):
+        # Nothing cascades from VMTag, so this is a single DELETE ... WHERE IN
+        cls.objects.filter(tag=tag, vm_id__in=vm_ids).delete()
+        cls._changed('post_remove', tag, set(vm_ids))
+
+    @classmethod
+    def change_vm_tags(cls, vm, add=(), remove=(), assigned_by=None):
+        """
+        Add and remove tags of one VM, by tag id, in the caller's transaction.
+        """
+        if add:
+            cls.objects.bulk_create([cls(vm=vm, tag_id=tag_id, assigned_by=assigned_by) for tag_id in sorted(add)], ignore_conflicts=True)
+            cls._changed('post_add', vm, set(add), reverse=False)
+        if remove:
+            cls.objects.filter(vm=vm, tag_id__in=sorted(remove)).delete()
+            cls._changed('post_remove', vm, set(remove), reverse=False)
+
+    @staticmethod
+    def _sorted_pks(vm_ids):
+        # UUID order is the byte order of the key in the index on every backend
+        to_python = VM._meta.pk.to_python
+        return sorted({to_python(vm_id) for vm_id in vm_ids})
+
+    @classmethod
+    def _changed(cls, action, instance, pk_set, reverse=True):
+        # Same signal tag.vms.add()/remove() (reverse) and vm.tags.add()/remove()
+        # send, so listeners (e.g. the bitmap index) need not know about bulk writes
+        if pk_set:
+            model = VM if reverse else TagsModel
+            m2m_changed.send(sender=cls, action=action, instance=instance, reverse=reverse, model=model, pk_set=pk_set, using=router.db_for_write(cls))
+
+
+class Job(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_QUEUED, 'queued'),
+        (STATUS_RUNNING, 'running'),
+        (STATUS_DONE, 'done'),
+        (STATUS_FAILED, 'failed'),
+    )
+
+    job_id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    action = models.CharField('action', max_length=50)
+    payload = models.JSONField('payload', default=dict)
+    status = models.CharField('status', max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    total = models.PositiveIntegerField('total', default=0)
+    processed = models.PositiveIntegerField('processed', default=0)
+    error = models.TextField('error', blank=True, null=True)
+    created_at = models.DateTimeField('created_at', auto_now_add=True)
+    updated_at = models.DateTimeField('updated_at', auto_now=True)
+
+    class Meta:
+        managed = True
+        db_table = 'jobs'
+        verbose_name = 'jobs'
@@ -0,0 +1,115 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import router
+
+from . import assignments, jobs, metrics, tag_lists
+from .models import TagsModel, UserProfile, VM, VMTag
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PURGE = {
+    # Rows deleted per statement, each batch in its own short transaction
+    'BATCH_SIZE': 1000,
+    # Seconds between batches, leaving the tables to other writers
+    'BATCH_PAUSE': 0,
+}
+
+
+def purge_setting(name):
+    return getattr(settings, 'TAG_PURGE', {}).get(name, DEFAULT_PURGE[name])
+
+
+def raw_delete(queryset):
+    # A single DELETE ... WHERE: no collector loading rows, no signals
+    return queryset._raw_delete(router.db_for_write(queryset.model))
+
+
+def _delete_assignment_batch(size, queryset, refresh_lists):
+    rows = list(queryset.values_list('pk', 'vm_id')[:size])
+    if rows:
+        raw_delete(VMTag.objects.filter(pk__in=[pk for pk, vm_id in rows]))
+        if refresh_lists and tag_lists.enabled():
+            tag_lists.refresh({vm_id for pk, vm_id in rows})
+    return len(rows)
+
+
+def _clear_assigned_by_batch(size, user_id):
+    pks = list(VMTag.objects.filter(assigned_by_id=user_id).values_list('pk', flat=True)[:size])
+    return VMTag.objects.filter(pk__in=pks).update(assigned_by=None)
+
+
+def in_batches(func, *args):
+    """
+    Call func(BATCH_SIZE, *args) until it reports no rows left, yielding
+    each batch's row count. Batches commit (and retry) one by one.
+    """
+    size = purge_setting('BATCH_SIZE')
+    pause = purge_setting('BATCH_PAUSE')
+    while True:
+        count = assignments.atomic_with_retry(func, size, *args)
+        if not count:
+            return
+        metrics.incr('purge.rows', count)
+        yield count
+        if pause:
+            time.sleep(pause)
+
+
+def purge_vm(vm_id):
+    """
+    Delete a soft-deleted VM: its vms_tags rows in batches, then the row.
+    Yields the number of rows deleted per batch.
+    """
+    if not VM.all_objects.filter(pk=vm_id).exclude(deleted_at=None).exists():
+        return
+
+    # The VM's own tag list goes with it, so there is nothing to refresh
+    yield from in_batches(_delete_assignment_batch, VMTag.objects.filter(vm_id=vm_id), False)
+    yield raw_delete(VM.all_objects.filter(pk=vm_id).exclude(deleted_at=None))
+
+
+def purge_user(user_id):
+    # purge_vm() for a soft-deleted user: their tags one by one, then the user
+    if not UserProfile.all_objects.filter(pk=user_id).exclude(deleted_at=None).exists():
+        return
+
+    for tag_id in list(TagsModel.all_objects.filter(user_id=user_id).values_list('tag_id', flat=True)):
+        # Other VMs' tag lists still name the tag until its rows are gone
+        yield from in_batches(_delete_assignment_batch, VMTag.objects.filter(tag_id=tag_id), True)
+        yield raw_delete(TagsModel.all_objects.filter(pk=tag_id))
+
+    # vms_tags.assigned_by is SET_NULL
+    yield from in_batches(_clear_assigned_by_batch, user_id)
+    yield raw_delete(UserProfile.all_objects.filter(pk=user_id))
+
+
+def purge_deleted():
+    # Every soft-deleted row, including those whose purge job was lost
+    for vm_id in VM.all_objects.exclude(deleted_at=None).values_list('vm_id', flat=True):
+        yield from purge_vm(vm_id)
+    for user_id in UserProfile.all_objects.exclude(deleted_at=None).values_list('user_id', flat=True):
+        yield from purge_user(user_id)
+
+
+@jobs.register('purge_vm')
+def purge_vm_job(job):
+    return purge_vm(job.payload['vm_id'])
+
+
+@jobs.register('purge_user')
+def purge_user_job(job):
+    return purge_user(job.payload['user_id'])
+
+
+def schedule(action, payload):
+    """
+    Queue the purge of a soft-deleted row, or return None when the job queue
+    is full: the row stays hidden until "manage.py purge_deleted" runs.
+    """
+    try:
+        return jobs.submit(action, payload)
+    except jobs.JobQueueFull:
+        logger.warning("Job queue full, %s %s left for purge_deleted", action, payload)
+        return None
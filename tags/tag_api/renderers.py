@@ -0,0 +1,104 @@
+import uuid
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from rest_framework.exceptions import NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+
+from .serializers import dumps, jsonable
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+JSON = 'application/json'
+COLUMNAR_JSON = 'application/vnd.tags.columnar+json'
+MSGPACK = 'application/msgpack'
+
+
+def encode_json(data):
+    return dumps(data)
+
+
+def to_columnar(data):
+    # {'data': [{'a': 1, 'b': 2}, ...]} -> {'data': {'columns': ['a', 'b'], 'rows': [[1, 2], ...]}}
+    columnar = dict(data)
+
+    for key, rows in data.items():
+        if isinstance(rows, list) and all(isinstance(row, dict) for row in rows[:1]):
+            columns = list(rows[0]) if rows else []
+            columnar[key] = {'columns': columns, 'rows': [list(row.values()) for row in rows]}
+
+    return columnar
+
+
+def encode_columnar_json(data):
+    # Rows are converted before they become columns, while they are still dicts
+    return encode_json(to_columnar(jsonable(data)))
+
+
+def _msgpack_default(value):
+    if isinstance(value, uuid.UUID):
+        return value.bytes
+    return DjangoJSONEncoder().default(value)
+
+
+def encode_msgpack(data):
+    # Columnar layout, UUIDs as 16 raw bytes, datetimes as msgpack timestamps
+    return msgpack.packb(to_columnar(data), default=_msgpack_default, use_bin_type=True, datetime=True)
+
+
+FORMATS = {
+    JSON: encode_json,
+    COLUMNAR_JSON: encode_columnar_json,
+}
+
+if msgpack is not None:
+    FORMATS[MSGPACK] = encode_msgpack
+    FORMATS['application/x-msgpack'] = encode_msgpack
+
+
+def negotiate(request):
+    """
+    Pick the best supported media type from the Accept header.
+
+    Falls back to plain JSON when nothing acceptable is offered.
+    """
+    accept = request.META.get('HTTP_ACCEPT', '')
+    best, best_q = JSON, 0.0
+
+    for item in accept.split(','):
+        media_type, _, params = item.strip().partition(';')
+        media_type = media_type.strip().lower()
+        q = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+
+        if media_type in FORMATS and q > best_q:
+            best, best_q = media_type, q
+
+    return best
+
+
+def render(request, data):
+    media_type = negotiate(request)
+    response = HttpResponse(FORMATS[media_type](data), content_type=media_type)
+    response['Vary'] = 'Accept'
+    return response
+
+
+class AcceptNegotiation(DefaultContentNegotiation):
+    # The views build their own responses through render(), so DRF must not
+    # reject media types it has no renderer for.
+    def select_renderer(self, request, renderers, format_suffix=None):
+        try:
+            return super().select_renderer(request, renderers, format_suffix)
+        except NotAcceptable:
+            return (renderers[0], renderers[0].media_type)
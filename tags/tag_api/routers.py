@@ -0,0 +1,124 @@
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+logger = logging.getLogger(__name__)
+
+# Set for the duration of a request (or job) whose reads must see the primary
+_use_primary = contextvars.ContextVar('tag_api_use_primary', default=False)
+
+# alias -> (checked_at, healthy)
+_replica_health = {}
+
+
+def replica_setting(name, default):
+    return getattr(settings, 'TAG_DB_REPLICAS', {}).get(name, default)
+
+
+@contextmanager
+def use_primary(pinned=True):
+    token = _use_primary.set(pinned)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+def remember_write(response):
+    # Read-your-writes: a cookie keeps this client on the primary until the
+    # replicas caught up. Unlike a per-process cache entry it reaches every
+    # worker, and clients behind one proxy do not share it.
+    seconds = replica_setting('STICKY_SECONDS', 5)
+    if seconds:
+        response.set_cookie(replica_setting('STICKY_COOKIE', 'tag_api_primary'), str(time.time() + seconds),
+                            max_age=seconds, httponly=True, samesite='Lax')
+
+
+def recently_wrote(request):
+    try:
+        until = float(request.COOKIES[replica_setting('STICKY_COOKIE', 'tag_api_primary')])
+    except (KeyError, ValueError):
+        return False
+    # Bounded, so an edited cookie cannot pin a client to the primary for good
+    now = time.time()
+    return now < until <= now + replica_setting('STICKY_SECONDS', 5)
+
+
+def replica_lag(alias):
+    """
+    Seconds the replica is behind the primary, or None if replication is stopped.
+
+    Only MySQL reports lag; other backends (e.g. SQLite copies in tests) are
+    treated as up to date.
+    """
+    connection = connections[alias]
+    if connection.vendor != 'mysql':
+        return 0
+
+    with connection.cursor() as cursor:
+        try:
+            cursor.execute('SHOW REPLICA STATUS')
+        except Exception:
+            # MySQL before 8.0.22
+            cursor.execute('SHOW SLAVE STATUS')
+        row = cursor.fetchone()
+        columns = [column[0] for column in cursor.description or ()]
+
+    if row is None:
+        return None
+    status = dict(zip(columns, row))
+    return status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+
+
+def replica_healthy(alias):
+    max_lag = replica_setting('MAX_LAG', 10)
+    if max_lag is None:
+        return True
+
+    checked_at, healthy = _replica_health.get(alias, (None, True))
+    if checked_at is None or time.monotonic() - checked_at > replica_setting('LAG_CHECK_INTERVAL', 5):
+        try:
+            lag = replica_lag(alias)
+            healthy = lag is not None and lag <= max_lag
+        except Exception:
+            logger.warning("Could not check replication lag on %s", alias, exc_info=True)
+            healthy = False
+        if not healthy:
+            logger.warning("Replica %s is lagging or down, reading from the primary", alias)
+        _replica_health[alias] = (time.monotonic(), healthy)
+
+    return healthy
+
+
+def choose_replica():
+    replicas = [alias for alias in replica_setting('ALIASES', []) if replica_healthy(alias)]
+    return random.choice(replicas) if replicas else None
+
+
+class PrimaryReplicaRouter:
+    """
+    Send reads to a healthy replica and everything else to the primary.
+
+    Reads stay on the primary inside write requests, for clients that wrote
+    recently (see ReplicaRoutingMiddleware) and inside use_primary().
+    """
+
+    def db_for_read(self, model, **hints):
+        if _use_primary.get():
+            return DEFAULT_DB_ALIAS
+        return choose_replica() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in replica_setting('ALIASES', [])
@@ -0,0 +1,209 @@
+import re
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .models import TagsModel
+
+NGRAM = 3
+
+
+def search_setting(name, default):
+    return getattr(settings, 'TAG_SEARCH_INDEX', {}).get(name, default)
+
+
+def index_enabled():
+    return search_setting('ENABLED', True)
+
+
+def ngrams(text):
+    text = text.lower()
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+class Pattern:
+    """
+    A tag name pattern where '*' matches any run of characters.
+
+    Without any '*' the pattern matches names containing it, so 'prod' and
+    '*prod*' are the same search. Matching is case-insensitive.
+    """
+
+    def __init__(self, text):
+        text = (text or '').strip()
+        if not text.replace('*', ''):
+            raise ValidationError("q must contain at least one character besides '*'")
+        if '*' not in text:
+            text = '*' + text + '*'
+
+        self.fragments = [fragment.lower() for fragment in text.split('*') if fragment]
+        self.regex = re.compile(
+            ('' if text.startswith('*') else '^')
+            + '.*'.join(re.escape(fragment) for fragment in self.fragments)
+            + ('' if text.endswith('*') else '$'),
+            re.IGNORECASE | re.DOTALL,
+        )
+
+    @property
+    def ngrams(self):
+        grams = set()
+        for fragment in self.fragments:
+            grams |= ngrams(fragment)
+        return grams
+
+    def matches(self, name):
+        return self.regex.search(name) is not None
+
+    def rank(self, name):
+        """
+        Sort key, best first: exact match, then prefix, then a match at a word
+        boundary, then anywhere; shorter names first within each group.
+        """
+        lowered = name.lower()
+        first = self.fragments[0]
+        if lowered == ''.join(self.fragments):
+            group = 0
+        elif lowered.startswith(first):
+            group = 1
+        elif re.search(r'(^|[^0-9a-z])' + re.escape(first), lowered):
+            group = 2
+        else:
+            group = 3
+        return (group, len(name), lowered)
+
+
+class TagSearchIndex:
+    """
+    In-memory trigram index over tag names.
+
+    A substring search first intersects the tag id sets of every trigram in
+    the pattern, then checks only those candidates against the pattern, so
+    it never scans the whole tags table. Patterns with no fragment of three
+    or more characters are checked against every name in memory.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.built_at = None
+        self.tags = {}
+        self.postings = {}
+
+    @property
+    def built(self):
+        return self.built_at is not None
+
+    def build(self):
+        with self.lock:
+            self.tags, self.postings = {}, {}
+            rows = TagsModel.objects.exclude(tag_name=None).values_list('tag_id', 'tag_name', 'scope', 'user_id_id')
+            for row in rows.iterator(chunk_size=10000):
+                self._add(*row)
+            self.built_at = time.monotonic()
+
+    def _add(self, tag_id, tag_name, scope, user_id):
+        self.tags[tag_id] = (tag_name, scope, user_id)
+        for gram in ngrams(tag_name):
+            self.postings.setdefault(gram, set()).add(tag_id)
+
+    def _drop(self, tag_id):
+        entry = self.tags.pop(tag_id, None)
+        if entry is None:
+            return
+        for gram in ngrams(entry[0]):
+            posting = self.postings.get(gram)
+            if posting is not None:
+                posting.discard(tag_id)
+                if not posting:
+                    del self.postings[gram]
+
+    def update(self, tag_id, tag_name, scope, user_id):
+        with self.lock:
+            self._drop(tag_id)
+            if tag_name is not None:
+                self._add(tag_id, tag_name, scope, user_id)
+
+    def drop(self, tag_id):
+        with self.lock:
+            self._drop(tag_id)
+
+    def candidates(self, grams):
+        if not grams:
+            return list(self.tags)
+        # Smallest posting lists first keeps the intersection cheap
+        postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        result = set(postings[0])
+        for posting in postings[1:]:
+            result &= posting
+            if not result:
+                break
+        return result
+
+    def search(self, pattern, scope=None):
+        """
+        Return the [(tag_id, tag_name, scope, user_id)] matching `pattern`, ranked.
+        """
+        with self.lock:
+            matches = []
+            for tag_id in self.candidates(pattern.ngrams):
+                tag_name, tag_scope, user_id = self.tags[tag_id]
+                if scope is not None and tag_scope != scope:
+                    continue
+                if pattern.matches(tag_name):
+                    matches.append((tag_id, tag_name, tag_scope, user_id))
+
+        matches.sort(key=lambda match: pattern.rank(match[1]))
+        return matches
+
+
+_index = TagSearchIndex()
+
+
+def get_index():
+    # Like the bitmap index: built on first use, rebuilt after MAX_AGE seconds
+    # to pick up changes made by other worker processes
+    max_age = search_setting('MAX_AGE', 300)
+    with _index.lock:
+        if not _index.built or (max_age and time.monotonic() - _index.built_at > max_age):
+            _index.build()
+    return _index
+
+
+def search_database(pattern, scope=None):
+    # Unindexed fallback for TAG_SEARCH_INDEX['ENABLED'] = False; scans the table
+    queryset = TagsModel.objects.exclude(tag_name=None)
+    for fragment in pattern.fragments:
+        queryset = queryset.filter(tag_name__icontains=fragment)
+    if scope is not None:
+        queryset = queryset.filter(scope_ref__name=scope)
+
+    matches = [row for row in queryset.values_list('tag_id', 'tag_name', 'scope', 'user_id_id') if pattern.matches(row[1])]
+    matches.sort(key=lambda match: pattern.rank(match[1]))
+    return matches
+
+
+def search(text, scope=None):
+    pattern = Pattern(text)
+    if index_enabled():
+        return get_index().search(pattern, scope)
+    return search_database(pattern, scope)
+
+
+def _defer(func, *args):
+    if index_enabled() and _index.built:
+        transaction.on_commit(lambda: func(*args))
+
+
+def on_tag_saved(sender, instance, **kwargs):
+    _defer(_index.update, _uuid(instance.tag_id), instance.tag_name, instance.scope, instance.user_id_id)
+
+
+def on_tag_deleted(sender, instance, **kwargs):
+    _defer(_index.drop, _uuid(instance.tag_id))
+
+
+def _uuid(value):
+    return value if isinstance(value, uuid.UUID) else uuid.UUID(str(value))
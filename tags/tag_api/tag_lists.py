@@ -0,0 +1,127 @@
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import VM, VMTag
+from .serializers import serialize_rows
+
+
+def tag_list_setting(name, default):
+    return getattr(settings, 'TAG_VM_TAG_LISTS', {}).get(name, default)
+
+
+def enabled():
+    return tag_list_setting('ENABLED', False)
+
+
+def build_lists(vm_ids, lock=False):
+    """
+    Read the tags of each VM in `vm_ids` from vms_tags.
+
+    Returns vm_id -> [{'tag_id', 'tag_name', 'scope'}, ...] ordered by tag
+    name, with an empty list for VMs without tags. With `lock` the vms_tags
+    rows are read with a locking read where the backend can lock them
+    alone, which returns the latest committed rows rather than the
+    transaction's (possibly older) snapshot.
+    """
+    to_python = VM._meta.pk.to_python
+    lists = {to_python(vm_id): [] for vm_id in vm_ids}
+
+    keys = list(lists)
+    size = tag_list_setting('BATCH_SIZE', 1000)
+    for start in range(0, len(keys), size):
+        rows = (VMTag.objects.filter(vm_id__in=keys[start:start + size], tag__deleted_at=None)
+                .order_by('vm_id', 'tag__tag_name', 'tag_id')
+                .values_list('vm_id', 'tag_id', 'tag__tag_name', 'tag__scope'))
+        # FOR UPDATE without OF would lock the joined tags rows too, making
+        # every assignment of a tag wait for the others
+        if lock and connections[rows.db].features.has_select_for_update_of:
+            rows = rows.select_for_update(of=('self',))
+        for vm_id, tag_id, tag_name, scope in rows:
+            lists[vm_id].append({'tag_id': str(tag_id), 'tag_name': tag_name, 'scope': scope})
+    return lists
+
+
+def refresh(vm_ids, dry_run=False):
+    """
+    Rewrite VM.tag_list for these VMs, batch by batch, in the caller's
+    transaction, and return how many lists were out of date.
+
+    The VM rows are locked first, in key order, and vms_tags is read after
+    that: two transactions changing the same VM's tags take turns, and the
+    second builds the list from what the first committed instead of
+    overwriting it with one built from an older snapshot. Only the lists
+    that changed are written; with `dry_run` none are.
+    """
+    to_python = VM._meta.pk.to_python
+    vm_ids = sorted({to_python(vm_id) for vm_id in vm_ids})
+    size = tag_list_setting('BATCH_SIZE', 1000)
+    stale = 0
+    with transaction.atomic(savepoint=False):
+        for start in range(0, len(vm_ids), size):
+            # Soft-deleted VMs too, so their lists are right if restored
+            current = dict(VM.all_objects.select_for_update().filter(vm_id__in=vm_ids[start:start + size])
+                           .order_by('vm_id').values_list('vm_id', 'tag_list'))
+            changed = [VM(vm_id=vm_id, tag_list=tag_list) for vm_id, tag_list in build_lists(current, lock=True).items()
+                       if tag_list != current[vm_id]]
+            if changed and not dry_run:
+                VM.all_objects.bulk_update(changed, ['tag_list'])
+            stale += len(changed)
+    return stale
+
+
+def serialize_with_tags(queryset, columns):
+    """
+    serialize_rows() plus a 'tags' list per VM.
+
+    With TAG_VM_TAG_LISTS enabled the lists come from the VM rows themselves;
+    otherwise they take one more query over vms_tags.
+    """
+    if enabled():
+        rows = serialize_rows(queryset, columns + ['tag_list'])
+        for row in rows:
+            row['tags'] = row.pop('tag_list')
+        return rows
+
+    rows = serialize_rows(queryset, columns if 'vm_id' in columns else columns + ['vm_id'])
+    lists = build_lists(row['vm_id'] for row in rows)
+    to_python = VM._meta.pk.to_python
+    for row in rows:
+        vm_id = row['vm_id'] if 'vm_id' in columns else row.pop('vm_id')
+        row['tags'] = lists[to_python(vm_id)]
+    return rows
+
+
+# Signal handlers. Each runs inside the transaction of the change it follows
+# (related managers, VMTag.assign()/unassign(), TagsModel.save() and the
+# delete collector are all atomic), so the lists never commit out of step.
+
+def on_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not enabled():
+        return
+
+    if reverse:
+        # tag.vms.add()/remove()/clear(): instance is the tag
+        if action == 'pre_clear':
+            instance._tag_list_vm_ids = list(instance.vms.values_list('vm_id', flat=True))
+        elif action in ('post_add', 'post_remove'):
+            refresh(pk_set)
+        elif action == 'post_clear':
+            refresh(instance.__dict__.pop('_tag_list_vm_ids', []))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        refresh([instance.pk])
+
+
+def on_tag_saved(sender, instance, created, **kwargs):
+    # A renamed (or re-scoped) tag changes the lists of every VM carrying it
+    if enabled() and not created:
+        refresh(VMTag.objects.filter(tag=instance).values_list('vm_id', flat=True))
+
+
+def on_tag_deleting(sender, instance, **kwargs):
+    if enabled():
+        instance._tag_list_vm_ids = list(VMTag.objects.filter(tag=instance).values_list('vm_id', flat=True))
+
+
+def on_tag_deleted(sender, instance, **kwargs):
+    if enabled():
+        refresh(instance.__dict__.pop('_tag_list_vm_ids', []))
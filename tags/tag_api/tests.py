@@ -1,3 +1,1791 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import decimal
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+import zlib
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections, transaction
+from django.db.models.signals import m2m_changed
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .fields import CompactUUIDField
+from .middleware import CoalescingMiddleware, CompressionMiddleware, ReplicaRoutingMiddleware
+from .models import Job, TagsModel, UserProfile, VM, VMTag
+from . import bitmaps, coalescing, counts, group_commit, histograms, jobs, metrics, middleware, purge, renderers, routers, search, serializers, tag_lists, throttling, transfer
+from .throttling import LocalBucketStore, TokenBucketThrottle, check_bucket
+from .views import Tags
+
+
+# Replica lag is only measured on MySQL; MAX_LAG=None skips the check so
+# these tests never open a connection to the replica aliases.
+@override_settings(TAG_DB_REPLICAS={'ALIASES': ['replica1', 'replica2'], 'STICKY_SECONDS': 5, 'MAX_LAG': None})
+class ReplicaRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.router = routers.PrimaryReplicaRouter()
+        self.factory = RequestFactory()
+
+    def route(self, request):
+        # (alias a read went to, response)
+        seen = []
+
+        def view(request):
+            seen.append(self.router.db_for_read(VM))
+            return HttpResponse()
+
+        response = ReplicaRoutingMiddleware(view)(request)
+        return seen[0], response
+
+    def route_read(self, request):
+        return self.route(request)[0]
+
+    def test_reads_go_to_a_replica(self):
+        self.assertIn(self.router.db_for_read(VM), ['replica1', 'replica2'])
+
+    def test_writes_go_to_the_primary(self):
+        self.assertEqual(self.router.db_for_write(VM), 'default')
+        self.assertEqual(self.route_read(self.factory.post('/tags', REMOTE_ADDR='10.0.0.1')), 'default')
+
+    def test_reads_stick_to_the_primary_after_a_write(self):
+        alias, response = self.route(self.factory.post('/tags', REMOTE_ADDR='10.0.0.2'))
+        cookie = response.cookies['tag_api_primary']
+        self.assertEqual(cookie['max-age'], 5)
+
+        self.factory.cookies['tag_api_primary'] = cookie.value
+        self.assertEqual(self.route_read(self.factory.get('/tags', REMOTE_ADDR='10.0.0.2')), 'default')
+
+        # Another client behind the same address has no cookie
+        self.factory.cookies.clear()
+        self.assertIn(self.route_read(self.factory.get('/tags', REMOTE_ADDR='10.0.0.2')), ['replica1', 'replica2'])
+
+    def test_stale_or_forged_pins_are_ignored(self):
+        for value in (time.time() - 1, time.time() + 3600, 'soon'):
+            self.factory.cookies['tag_api_primary'] = str(value)
+            self.assertIn(self.route_read(self.factory.get('/tags')), ['replica1', 'replica2'])
+
+    def test_use_primary(self):
+        with routers.use_primary():
+            self.assertEqual(self.router.db_for_read(VM), 'default')
+
+    def test_unhealthy_replicas_fall_back_to_the_primary(self):
+        with override_settings(TAG_DB_REPLICAS={'ALIASES': ['replica1'], 'MAX_LAG': 10}):
+            routers._replica_health['replica1'] = (float('inf'), False)
+            try:
+                self.assertEqual(self.router.db_for_read(VM), 'default')
+            finally:
+                routers._replica_health.clear()
+
+    def test_migrations_only_run_on_the_primary(self):
+        self.assertTrue(self.router.allow_migrate('default', 'tag_api'))
+        self.assertFalse(self.router.allow_migrate('replica1', 'tag_api'))
+
+
+# 'replica1' mirrors the test database (see tags/test_settings.py), so the
+# queries each alias runs show where a request was routed.
+@unittest.skipUnless('replica1' in settings.DATABASES, "needs the 'replica1' database alias")
+@override_settings(TAG_DB_REPLICAS={'ALIASES': ['replica1'], 'STICKY_SECONDS': 5, 'MAX_LAG': None})
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = {'default', 'replica1'}
+
+    def setUp(self):
+        cache.clear()
+        self.user = UserProfile.objects.create(user_name='admin')
+
+    def routed(self, request):
+        # (response, queries on the primary, queries on the replica)
+        with CaptureQueriesContext(connections['default']) as primary, CaptureQueriesContext(connections['replica1']) as replica:
+            response = request()
+        return response, len(primary), len(replica)
+
+    def test_reads_go_to_the_replica(self):
+        response, primary, replica = self.routed(lambda: self.client.get('/tags'))
+
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+    def test_clients_read_their_own_writes(self):
+        response, primary, replica = self.routed(lambda: self.client.post('/tags', {'tag_name': 'fresh', 'scope': 'replica', 'user_id': self.user.user_id}))
+        self.assertEqual(response.json()['status'], 'success')
+        self.assertEqual(replica, 0)
+
+        # The writer stays on the primary and sees its tag
+        response, primary, replica = self.routed(lambda: self.client.get('/tags', {'tag_name': 'fresh'}))
+        self.assertEqual([tag['tag_name'] for tag in response.json()['data']], ['fresh'])
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+        # Other clients still read from the replica
+        response, primary, replica = self.routed(lambda: Client().get('/tags', {'tag_name': 'fresh'}))
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+
+@override_settings(TAG_COALESCING={'ENABLED': True, 'PATHS': ('/vms',), 'TIMEOUT': 5})
+class CoalescingTests(SimpleTestCase):
+    threads = 8
+
+    def setUp(self):
+        metrics.reset()
+        self.factory = RequestFactory()
+        self.calls = 0
+
+    def view(self, status=200):
+        def get_response(request):
+            self.calls += 1
+            # Hold the first request until every other one is waiting on it
+            deadline = time.monotonic() + 5
+            while metrics.snapshot().get('coalescing.followers', 0) < self.threads - 1 and time.monotonic() < deadline:
+                time.sleep(0.001)
+            return HttpResponse(b'{"data": []}', status=status, content_type='application/json')
+        return get_response
+
+    def run_threads(self, middleware, path):
+        responses = []
+        barrier = threading.Barrier(self.threads)
+
+        def worker():
+            barrier.wait()
+            responses.append(middleware(self.factory.get(path)))
+
+        workers = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        return responses
+
+    def test_identical_requests_share_one_call(self):
+        responses = self.run_threads(CoalescingMiddleware(self.view()), '/vms?tag_name=web')
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([response.content for response in responses], [b'{"data": []}'] * self.threads)
+        self.assertEqual(sum(response.has_header('X-Coalesced') for response in responses), self.threads - 1)
+        self.assertEqual(metrics.snapshot()['coalescing.shared'], self.threads - 1)
+
+    def test_errors_are_not_shared(self):
+        self.run_threads(CoalescingMiddleware(self.view(status=500)), '/vms')
+        self.assertEqual(self.calls, self.threads)
+
+    def test_async_requests_share_one_call(self):
+        async def get_response(request):
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            return HttpResponse(b'{}', content_type='application/json')
+
+        middleware = CoalescingMiddleware(get_response)
+        # Django's handler awaits middleware it sees as coroutine functions
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        self.assertFalse(asyncio.iscoroutinefunction(CoalescingMiddleware(self.view())))
+
+        async def main():
+            return await asyncio.gather(*[middleware(self.factory.get('/vms')) for _ in range(self.threads)])
+
+        responses = asyncio.run(main())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(len(responses), self.threads)
+
+    def test_request_key(self):
+        key = coalescing.request_key
+        self.assertEqual(key(self.factory.get('/vms?a=1&b=2')), key(self.factory.get('/vms?b=2&a=1')))
+        self.assertNotEqual(key(self.factory.get('/vms')), key(self.factory.get('/vms', HTTP_ACCEPT='application/msgpack')))
+        unpinned = key(self.factory.get('/vms'))
+        with routers.use_primary():
+            self.assertNotEqual(key(self.factory.get('/vms')), unpinned)
+        self.assertIsNone(key(self.factory.post('/vms')))
+        self.assertIsNone(key(self.factory.get('/tags')))
+
+
+@override_settings(TAG_COMPRESSION={'MIN_SIZE': 100, 'CONTENT_TYPES': ('application/json',)})
+class CompressionTests(SimpleTestCase):
+    body = json.dumps({'data': [{'vm_name': 'vm-{0}'.format(i)} for i in range(50)]}).encode()
+
+    def respond(self, response, encoding='gzip, deflate'):
+        request = RequestFactory().get('/vms', HTTP_ACCEPT_ENCODING=encoding)
+        return CompressionMiddleware(lambda request: response)(request)
+
+    def test_large_responses_are_compressed(self):
+        response = self.respond(HttpResponse(self.body, content_type='application/json'))
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Length'], str(len(response.content)))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(zlib.decompress(response.content, 31), self.body)
+
+    @unittest.skipIf(middleware.brotli is None, "brotli is not installed")
+    def test_brotli_is_preferred(self):
+        response = self.respond(HttpResponse(self.body, content_type='application/json'), 'gzip, br')
+
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(middleware.brotli.decompress(response.content), self.body)
+
+    def test_thresholds(self):
+        # Below MIN_SIZE
+        response = self.respond(HttpResponse(self.body[:99], content_type='application/json'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        # At MIN_SIZE
+        response = self.respond(HttpResponse(b' ' * 100, content_type='application/json'))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        # Content types not listed
+        response = self.respond(HttpResponse(self.body, content_type='text/html'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        # Output that would not be smaller
+        noise = os.urandom(1000)
+        response = self.respond(HttpResponse(noise, content_type='application/json'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, noise)
+
+    def test_refused_encodings(self):
+        response = self.respond(HttpResponse(self.body, content_type='application/json'), 'gzip;q=0, identity')
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(response.content, self.body)
+
+    def test_etag_becomes_weak(self):
+        response = HttpResponse(self.body, content_type='application/json')
+        response['ETag'] = '"abc"'
+
+        self.assertEqual(self.respond(response)['ETag'], 'W/"abc"')
+
+    def test_streaming(self):
+        chunks = [self.body[:200], b'', self.body[200:]]
+        response = self.respond(StreamingHttpResponse(iter(chunks), content_type='application/json'))
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertFalse(response.has_header('Content-Length'))
+        # Each chunk can be decoded as soon as it arrives
+        decompressor = zlib.decompressobj(31)
+        stream = iter(response.streaming_content)
+        self.assertEqual(decompressor.decompress(next(stream)), self.body[:200])
+        self.assertEqual(b''.join(decompressor.decompress(data) for data in stream) + decompressor.flush(), self.body[200:])
+
+
+class TokenBucketTests(SimpleTestCase):
+
+    def test_burst_then_refill(self):
+        store = LocalBucketStore()
+
+        for _ in range(5):
+            tat, wait = check_bucket(store, 'k', 1, 1, 5, 100.0)
+            self.assertIsNotNone(tat)
+            store.set('k', tat, tat - 100.0)
+
+        tat, wait = check_bucket(store, 'k', 1, 1, 5, 100.0)
+        self.assertIsNone(tat)
+        self.assertAlmostEqual(wait, 1.0)
+
+        tat, wait = check_bucket(store, 'k', 1, 1, 5, 101.0)
+        self.assertIsNotNone(tat)
+
+    def test_cost_is_capped_at_the_burst(self):
+        tat, wait = check_bucket(LocalBucketStore(), 'k', 500, 1, 5, 100.0)
+        self.assertEqual(tat, 105.0)
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': True, 'BUCKETS': {'endpoint': (1, 20)}, 'COSTS': {'UNFILTERED_LIST': 10}})
+class TokenBucketThrottleTests(SimpleTestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.view = Tags()
+
+    def allow(self, path, ip, view=None):
+        view = view or self.view
+        request = view.initialize_request(self.factory.get(path, REMOTE_ADDR=ip))
+        return TokenBucketThrottle().allow_request(request, view)
+
+    def test_unfiltered_listing_costs_more(self):
+        self.assertTrue(self.allow('/tags', '10.1.0.1'))
+        self.assertTrue(self.allow('/tags', '10.1.0.1'))
+        self.assertFalse(self.allow('/tags', '10.1.0.1'))
+
+        for _ in range(20):
+            self.assertTrue(self.allow('/tags?tag_name=env', '10.1.0.2'))
+        self.assertFalse(self.allow('/tags?tag_name=env', '10.1.0.2'))
+
+    def test_empty_filter_is_unfiltered(self):
+        self.assertTrue(self.allow('/tags?tag_id=', '10.1.0.3'))
+        self.assertTrue(self.allow('/tags?tag_id=', '10.1.0.3'))
+        self.assertFalse(self.allow('/tags?tag_id=', '10.1.0.3'))
+
+    def test_reset(self):
+        self.assertTrue(self.allow('/tags', '10.1.0.4'))
+        self.assertTrue(self.allow('/tags', '10.1.0.4'))
+        throttling.reset()
+        self.assertTrue(self.allow('/tags', '10.1.0.4'))
+
+    def test_malformed_assign_body(self):
+        client = Client(REMOTE_ADDR='10.1.0.5')
+        for body in ([1, 2], {'action': 'assign', 'vm_ids': 5}, {'action': 'assign', 'vm_ids': 'abc'}):
+            response = client.post('/Assign_Unassign_vm', json.dumps(body), content_type='application/json')
+            self.assertEqual(response.status_code, 200, body)
+            self.assertEqual(response.json()['error_code'], 103, body)
+
+    def test_disabled_by_default(self):
+        with self.settings(TAG_RATE_LIMITS={}):
+            for _ in range(5):
+                self.assertTrue(self.allow('/tags', '10.1.0.6'))
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': True, 'STORE': 'cache', 'BUCKETS': {'endpoint': (0.001, 5)}})
+class CacheBucketStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def allow(self):
+        view = Tags()
+        request = view.initialize_request(self.factory.get('/tags?tag_name=env', REMOTE_ADDR='10.2.0.1'))
+        return TokenBucketThrottle().allow_request(request, view)
+
+    def test_limit_holds_under_concurrency(self):
+        threads = 20
+        barrier = threading.Barrier(threads)
+        results = []
+
+        def worker():
+            barrier.wait()
+            results.append(self.allow())
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        self.assertEqual(results.count(True), 5, results)
+
+    def test_window_slides(self):
+        store = throttling.CacheBucketStore('default')
+        limits = [('k', 1, 2)]
+
+        # Windows of burst / rate = 2 seconds
+        self.assertEqual(store.take(limits, 1, 100.0), 0)
+        self.assertEqual(store.take(limits, 1, 100.5), 0)
+        self.assertAlmostEqual(store.take(limits, 1, 101.0), 1.0)
+        # A quarter into the next window three quarters of the last one count
+        self.assertAlmostEqual(store.take(limits, 1, 102.5), 1.5)
+        self.assertEqual(store.take(limits, 1, 103.5), 0)
+
+    def test_short_bucket_gives_tokens_back(self):
+        store = throttling.CacheBucketStore('default')
+        shared, endpoint = ('ip', 1, 3), ('endpoint', 1, 1)
+
+        self.assertEqual(store.take([shared, endpoint], 1, 100.0), 0)
+        for _ in range(3):
+            self.assertGreater(store.take([shared, endpoint], 1, 100.0), 0)
+        # Only the admitted call used the shared bucket
+        self.assertEqual(store.take([shared, ('other', 1, 1)], 1, 100.0), 0)
+        self.assertEqual(store.take([shared, ('third', 1, 1)], 1, 100.0), 0)
+        self.assertGreater(store.take([shared, ('fourth', 1, 1)], 1, 100.0), 0)
+
+
+class CompactUUIDFieldTests(TestCase):
+    value = uuid.UUID('12345678-1234-5678-1234-567812345678')
+    # Enough of a MySQL connection for the field's conversions
+    mysql = mock.Mock(vendor='mysql', features=mock.Mock(has_native_uuid_field=False))
+
+    def test_mysql_stores_sixteen_bytes(self):
+        field = CompactUUIDField()
+
+        self.assertEqual(field.db_type(self.mysql), 'binary(16)')
+        # Foreign keys copy the column type of their target
+        self.assertEqual(VMTag._meta.get_field('vm').db_type(self.mysql), 'binary(16)')
+        for value in (self.value, str(self.value), self.value.hex):
+            self.assertEqual(field.get_db_prep_value(value, self.mysql), self.value.bytes)
+        self.assertIsNone(field.get_db_prep_value(None, self.mysql))
+
+    def test_other_backends_keep_their_uuid_column(self):
+        field = CompactUUIDField()
+        self.assertEqual(field.db_type(connection), connection.data_types['UUIDField'])
+        self.assertEqual(field.get_db_prep_value(self.value, connection),
+                         self.value if connection.features.has_native_uuid_field else self.value.hex)
+
+    def test_values_from_the_database(self):
+        field = CompactUUIDField()
+        for value in (self.value.bytes, bytearray(self.value.bytes), self.value.hex, str(self.value), self.value):
+            self.assertEqual(field.from_db_value(value, None, self.mysql), self.value)
+        self.assertIsNone(field.from_db_value(None, None, self.mysql))
+
+    def test_round_trip(self):
+        VM.objects.create(vm_id=self.value, vm_name='compact')
+
+        loaded = VM.objects.get(vm_id=str(self.value))
+        self.assertIsInstance(loaded.vm_id, uuid.UUID)
+        self.assertEqual(loaded.vm_id, self.value)
+        self.assertEqual(list(VM.objects.filter(vm_id__in=[self.value.hex]).values_list('vm_id', flat=True)), [self.value])
+
+
+class EncoderTests(SimpleTestCase):
+    data = {
+        'status': 'success',
+        'data': [
+            {'vm_id': uuid.UUID('12345678-1234-5678-1234-567812345678'), 'name': 'caf\u00e9 \u2603 "quoted"',
+             'created': datetime.datetime(2024, 1, 2, 3, 4, 5, 678901, tzinfo=datetime.timezone.utc),
+             'day': datetime.date(2024, 1, 2), 'at': datetime.time(3, 4, 5, 6789), 'price': decimal.Decimal('1.50')},
+            {'vm_id': None, 'name': '', 'created': datetime.datetime(2024, 1, 2, 3, 4, 5),
+             'day': None, 'at': None, 'price': None},
+        ],
+        'nested': {'count': 2, 'ratio': 0.1, 'flags': [True, False, None], 'big': 2 ** 53 + 1},
+        'floats': [float('nan'), float('inf'), float('-inf')],
+    }
+
+    @unittest.skipIf(serializers.simplejson is None, "simplejson is not installed")
+    def test_simplejson_matches_stdlib(self):
+        self.assertEqual(serializers._simplejson_dumps(serializers.jsonable(self.data)),
+                         serializers._stdlib_dumps(serializers.jsonable(self.data)))
+        # Values the row converters leave to default()
+        self.assertEqual(serializers._simplejson_dumps(self.data), serializers._stdlib_dumps(self.data))
+
+    def test_converted_rows_match_django_encoder(self):
+        self.assertEqual(serializers.dumps(self.data), json.dumps(self.data, cls=DjangoJSONEncoder).encode())
+
+    def test_rows_are_not_changed(self):
+        serializers.dumps(self.data)
+        self.assertIsInstance(self.data['data'][0]['vm_id'], uuid.UUID)
+
+    @unittest.skipIf(renderers.msgpack is None, "msgpack is not installed")
+    def test_msgpack_gets_raw_values(self):
+        decoded = renderers.msgpack.unpackb(renderers.encode_msgpack(self.data), timestamp=3)
+        row = dict(zip(decoded['data']['columns'], decoded['data']['rows'][0]))
+
+        self.assertEqual(row['vm_id'], self.data['data'][0]['vm_id'].bytes)
+        self.assertEqual(row['created'], self.data['data'][0]['created'])
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': False})
+class NegotiationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.vms = VM.objects.bulk_create([VM(vm_name='formats-{0}'.format(i)) for i in range(3)])
+
+    def negotiate(self, accept):
+        return renderers.negotiate(RequestFactory().get('/vms', HTTP_ACCEPT=accept))
+
+    def test_highest_q_wins(self):
+        self.assertEqual(self.negotiate('application/json;q=0.5, application/vnd.tags.columnar+json'), renderers.COLUMNAR_JSON)
+        self.assertEqual(self.negotiate('application/vnd.tags.columnar+json;q=0.2, application/json;q=0.9'), renderers.JSON)
+        self.assertEqual(self.negotiate('text/html, Application/Vnd.Tags.Columnar+JSON;q=0.1'), renderers.COLUMNAR_JSON)
+
+    def test_falls_back_to_json(self):
+        self.assertEqual(self.negotiate(''), renderers.JSON)
+        self.assertEqual(self.negotiate('text/csv, */*'), renderers.JSON)
+        self.assertEqual(self.negotiate('application/vnd.tags.columnar+json;q=0'), renderers.JSON)
+        self.assertEqual(self.negotiate('application/vnd.tags.columnar+json;q=high'), renderers.JSON)
+
+    def listing(self, accept):
+        return self.client.get('/vms', {'fields': 'vm_id,vm_name'}, HTTP_ACCEPT=accept)
+
+    def test_columnar_json(self):
+        rows = self.listing('application/json').json()['data']
+        response = self.listing(renderers.COLUMNAR_JSON)
+
+        self.assertEqual(response['Content-Type'], renderers.COLUMNAR_JSON)
+        self.assertIn('Accept', response['Vary'])
+        data = json.loads(response.content)['data']
+        self.assertEqual(data['columns'], ['vm_id', 'vm_name'])
+        self.assertEqual([dict(zip(data['columns'], row)) for row in data['rows']], rows)
+
+    def test_unsupported_accept_gets_json(self):
+        response = self.listing('text/csv')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], renderers.JSON)
+        self.assertEqual(len(response.json()['data']), 3)
+
+    @unittest.skipIf(renderers.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        response = self.listing('application/msgpack, application/json;q=0.5')
+
+        self.assertEqual(response['Content-Type'], renderers.MSGPACK)
+        data = renderers.msgpack.unpackb(response.content)['data']
+        self.assertEqual(data['columns'], ['vm_id', 'vm_name'])
+        self.assertEqual(sorted(uuid.UUID(bytes=row[0]) for row in data['rows']), sorted(vm.vm_id for vm in self.vms))
+
+
+@override_settings(TAG_BITMAP_INDEX={'ENABLED': True, 'MAX_AGE': 0})
+class VMTagTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(user_name='admin')
+        cls.tag = TagsModel(tag_name='env', scope='vmtag', user_id=cls.user)
+        cls.tag.save()
+        cls.vms = VM.objects.bulk_create([VM(vm_name='vmtag-{0}'.format(i)) for i in range(3)])
+
+    def test_assign_skips_existing_rows(self):
+        VMTag.assign(self.tag, [self.vms[0].vm_id], self.user)
+        VMTag.assign(self.tag, [str(vm.vm_id) for vm in self.vms])
+
+        rows = VMTag.objects.filter(tag=self.tag)
+        self.assertEqual(rows.count(), 3)
+        # The first assignment keeps its metadata
+        self.assertEqual(rows.get(vm=self.vms[0]).assigned_by, self.user)
+        self.assertIsNone(rows.get(vm=self.vms[1]).assigned_by)
+
+    def test_unknown_vm_ids_are_rejected(self):
+        unknown = uuid.uuid4()
+        with self.assertRaisesMessage(ValidationError, str(unknown)), transaction.atomic():
+            VMTag.assign(self.tag, [self.vms[0].vm_id, unknown])
+        self.assertFalse(VMTag.objects.filter(tag=self.tag).exists())
+
+        response = self.client.post('/Assign_Unassign_vm', json.dumps(
+            {'action': 'assign', 'tag_name': 'env', 'vm_ids': [str(self.vms[0].vm_id), str(unknown)]}), content_type='application/json')
+        self.assertEqual(response.json()['error_code'], 103)
+
+    def test_only_inserted_rows_are_reported(self):
+        added = []
+
+        def receiver(action, pk_set, **kwargs):
+            if action == 'post_add':
+                added.append(pk_set)
+
+        VMTag.assign(self.tag, [self.vms[0].vm_id])
+        m2m_changed.connect(receiver, sender=VMTag)
+        try:
+            VMTag.assign(self.tag, [vm.vm_id for vm in self.vms])
+            VMTag.assign(self.tag, [vm.vm_id for vm in self.vms])
+        finally:
+            m2m_changed.disconnect(receiver, sender=VMTag)
+
+        self.assertEqual(added, [{self.vms[1].vm_id, self.vms[2].vm_id}])
+
+    def test_unassign(self):
+        VMTag.assign(self.tag, [vm.vm_id for vm in self.vms])
+        VMTag.unassign(self.tag, [self.vms[0].vm_id, self.vms[1].vm_id])
+
+        self.assertEqual(list(self.tag.vms.all()), [self.vms[2]])
+
+    def test_bitmap_index_follows_bulk_writes(self):
+        index = bitmaps.get_index()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            VMTag.assign(self.tag, [vm.vm_id for vm in self.vms])
+        self.assertEqual(len(index.match([self.tag.tag_id])), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            VMTag.unassign(self.tag, [self.vms[0].vm_id])
+        self.assertEqual(set(index.vm_ids_for(index.match([self.tag.tag_id]))), {self.vms[1].vm_id, self.vms[2].vm_id})
+
+    def test_bitmap_index_skips_unknown_vms(self):
+        index = bitmaps.get_index()
+        index.build()
+        size = len(index.vm_ids)
+
+        index.add(self.tag.tag_id, [uuid.uuid4(), self.vms[0].vm_id])
+        index.add_tags(uuid.uuid4(), [self.tag.tag_id])
+        self.assertEqual(len(index.vm_ids), size)
+        self.assertEqual(index.vm_ids_for(index.match([self.tag.tag_id])), [self.vms[0].vm_id])
+
+    @override_settings(TAG_BITMAP_INDEX={'ENABLED': True, 'MAX_AGE': 60})
+    def test_rebuild_checks_the_live_index(self):
+        VMTag.assign(self.tag, [self.vms[0].vm_id])
+        index = bitmaps.get_index()
+        index.build()
+        # A write the index never heard about
+        VMTag.objects.filter(tag=self.tag).delete()
+
+        metrics.reset()
+        index.built_at -= 61
+        with self.assertLogs('tag_api.bitmaps', 'WARNING'):
+            self.assertIs(bitmaps.get_index(), index)
+        self.assertEqual(metrics.snapshot()['bitmaps.drifted_tags'], 1)
+        self.assertEqual(index.verify(), {})
+
+    @override_settings(TAG_DB_REPLICAS={'ALIASES': ['replica1'], 'MAX_LAG': None})
+    def test_bitmap_index_reads_the_primary(self):
+        self.assertEqual(routers.PrimaryReplicaRouter().db_for_read(VM), 'replica1')
+        # A read routed to the replica would fail here
+        index = bitmaps.TagBitmapIndex()
+        index.build()
+        self.assertEqual(index.verify(), {})
+
+    @override_settings(TAG_LOOKUPS={'CHUNK_SIZE': 2})
+    def test_bitmap_listing_reads_matches_in_chunks(self):
+        VMTag.assign(self.tag, [vm.vm_id for vm in self.vms])
+        bitmaps.get_index().build()
+        ordered = sorted(str(vm.vm_id) for vm in self.vms)
+
+        def listed(**params):
+            response = self.client.get('/vms', dict(params, tags_all=str(self.tag.tag_id), fields='vm_id'))
+            return response.json()
+
+        data = listed(count='exact')
+        self.assertEqual([row['vm_id'] for row in data['data']], ordered)
+        self.assertEqual(data['count'], 3)
+
+        # Unfiltered: the page is cut from the matches, so one chunk is read
+        with self.assertNumQueries(1):
+            data = listed(limit=1, offset=2)
+        self.assertEqual([row['vm_id'] for row in data['data']], ordered[2:])
+
+        # Filtered: chunks are read until the page is full
+        data = listed(limit=2, offset=1, created_after='2000-01-01T00:00:00Z', count='exact')
+        self.assertEqual([row['vm_id'] for row in data['data']], ordered[1:])
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(listed(count_only='1', created_after='2000-01-01T00:00:00Z')['data']['count'], 3)
+        self.assertEqual(listed(count_only='1')['data']['count'], 3)
+
+
+@override_settings(TAG_VM_TAG_LISTS={'ENABLED': True}, TAG_RATE_LIMITS={'ENABLED': False})
+class TagListTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(user_name='admin')
+        cls.tag = TagsModel(tag_name='env', scope='lists', user_id=cls.user)
+        cls.tag.save()
+        cls.vm = VM.objects.create(vm_name='lists-vm')
+
+    def tag_list(self):
+        self.vm.refresh_from_db(fields=['tag_list'])
+        return [(entry['tag_name'], entry['scope']) for entry in self.vm.tag_list]
+
+    def test_follows_assignments(self):
+        VMTag.assign(self.tag, [self.vm.vm_id])
+        self.assertEqual(self.tag_list(), [('env', 'lists')])
+
+        VMTag.unassign(self.tag, [self.vm.vm_id])
+        self.assertEqual(self.tag_list(), [])
+
+        self.vm.tags.add(self.tag)
+        self.vm.tags.clear()
+        self.assertEqual(self.tag_list(), [])
+
+    def test_follows_tag_rename_and_delete(self):
+        self.tag.vms.add(self.vm)
+        self.tag.tag_name = 'environment'
+        self.tag.save()
+        self.assertEqual(self.tag_list(), [('environment', 'lists')])
+
+        self.tag.delete()
+        self.assertEqual(self.tag_list(), [])
+
+    def test_include_tags(self):
+        VMTag.assign(self.tag, [self.vm.vm_id])
+        with override_settings(TAG_VM_TAG_LISTS={'ENABLED': False}):
+            joined = self.client.get('/vms', {'include': 'tags', 'fields': 'vm_name'}).json()['data']
+        denormalized = self.client.get('/vms', {'include': 'tags', 'fields': 'vm_name'}).json()['data']
+
+        self.assertEqual(joined, denormalized)
+        self.assertEqual(denormalized, [{'vm_name': 'lists-vm', 'tags': [{'tag_id': str(self.tag.tag_id), 'tag_name': 'env', 'scope': 'lists'}]}])
+
+    def test_rebuild_repairs_drift(self):
+        # bulk_create() sends no signals, so the list goes stale
+        VMTag.objects.bulk_create([VMTag(vm=self.vm, tag=self.tag)])
+        self.assertEqual(self.tag_list(), [])
+
+        out = io.StringIO()
+        call_command('rebuild_tag_lists', '--dry-run', stdout=out)
+        self.assertIn("1 out of date", out.getvalue())
+        self.assertEqual(self.tag_list(), [])
+
+        call_command('rebuild_tag_lists', stdout=out)
+        self.assertEqual(self.tag_list(), [('env', 'lists')])
+        self.assertEqual(tag_lists.refresh([self.vm.vm_id]), 0)
+
+
+class TagSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(user_name='admin')
+        for name in ('preprod', 'env=prod-eu', 'production', 'prod', 'staging'):
+            TagsModel(tag_name=name, scope='search', user_id=cls.user).save()
+
+    def setUp(self):
+        search.get_index().build()
+
+    def names(self, **params):
+        response = self.client.get('/tags/search', params).json()
+        self.assertEqual(response['status'], 'success', response)
+        return [tag['tag_name'] for tag in response['data']['results']]
+
+    def test_ranking(self):
+        # Exact, prefix, word boundary, anywhere
+        self.assertEqual(self.names(q='*prod*'), ['prod', 'production', 'env=prod-eu', 'preprod'])
+        self.assertEqual(self.names(q='PROD'), self.names(q='*prod*'))
+
+    def test_anchored_patterns(self):
+        self.assertEqual(self.names(q='prod*'), ['prod', 'production'])
+        self.assertEqual(self.names(q='*prod'), ['prod', 'preprod'])
+        self.assertEqual(self.names(q='env*eu'), ['env=prod-eu'])
+        # Shorter than a trigram: checked against every name
+        self.assertEqual(self.names(q='ag*'), [])
+        self.assertEqual(self.names(q='st'), ['staging'])
+
+    def test_pagination(self):
+        data = self.client.get('/tags/search', {'q': 'prod', 'limit': 2, 'offset': 1}).json()['data']
+        self.assertEqual(data['count'], 4)
+        self.assertEqual([tag['tag_name'] for tag in data['results']], ['production', 'env=prod-eu'])
+
+        self.assertEqual(self.client.get('/tags/search', {'q': 'prod', 'limit': 1000}).json()['error_code'], 103)
+        self.assertEqual(self.client.get('/tags/search', {'q': '**'}).json()['error_code'], 103)
+
+    def test_served_from_index(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.names(q='stag'), ['staging'])
+
+    def test_index_follows_changes(self):
+        tag = TagsModel(tag_name='prodigy', scope='search', user_id=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.save()
+        self.assertIn('prodigy', self.names(q='prod'))
+
+        tag.tag_name = 'canary'
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.save()
+        self.assertNotIn('prodigy', self.names(q='prod'))
+        self.assertEqual(self.names(q='canary'), ['canary'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            tag.delete()
+        self.assertEqual(self.names(q='canary'), [])
+
+    @override_settings(TAG_SEARCH_INDEX={'ENABLED': False})
+    def test_database_fallback(self):
+        self.assertEqual(self.names(q='*prod*'), ['prod', 'production', 'env=prod-eu', 'preprod'])
+        self.assertEqual(self.names(q='*prod', scope='other'), [])
+
+
+# Runs outside a test transaction like real requests do: an error inside
+# the update's transaction would otherwise break the test's own
+@override_settings(TAG_VM_TAG_LISTS={'ENABLED': True}, TAG_RATE_LIMITS={'ENABLED': False})
+class VMUpdateTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = UserProfile.objects.create(user_name='admin')
+        self.tags = []
+        for name in ('web', 'db', 'cache'):
+            tag = TagsModel(tag_name=name, scope='update', user_id=self.user)
+            tag.save()
+            self.tags.append(tag)
+        self.web, self.db, self.cache = [str(tag.tag_id) for tag in self.tags]
+        self.vm = VM.objects.create(vm_name='update-vm')
+        VMTag.assign(self.tags[0], [self.vm.vm_id])
+
+    def patch(self, **body):
+        return self.client.patch('/vms/{0}'.format(self.vm.vm_id), json.dumps(body), content_type='application/json')
+
+    def state(self):
+        vm = VM.objects.get(vm_id=self.vm.vm_id)
+        return vm.vm_name, vm.version, sorted(entry['tag_name'] for entry in vm.tag_list)
+
+    def test_patch_applies_a_diff(self):
+        response = self.patch(vm_name='renamed', add_tags=[self.db], remove_tags=[self.web], version=1).json()
+
+        self.assertEqual(response['data']['version'], 2, response)
+        self.assertEqual(self.state(), ('renamed', 2, ['db']))
+
+    def test_noop_patch_writes_nothing(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.patch(vm_name='update-vm', add_tags=[self.web], remove_tags=[self.cache]).json()
+
+        self.assertEqual(response['status'], 'success', response)
+        statements = [query['sql'].split()[0] for query in captured.captured_queries]
+        # The VM row and its rows for the two named tags; BEGIN aside, nothing else
+        self.assertEqual([statement for statement in statements if statement != 'BEGIN'], ['SELECT', 'SELECT'])
+        self.assertEqual(self.state(), ('update-vm', 1, ['web']))
+
+    def test_stale_version_is_rejected(self):
+        self.patch(add_tags=[self.db], version=1)
+        response = self.patch(remove_tags=[self.web], version=1)
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['data']['version'], 2)
+        self.assertEqual(self.state(), ('update-vm', 2, ['db', 'web']))
+
+    def test_put_replaces_tags(self):
+        response = self.client.put('/vms/{0}'.format(self.vm.vm_id), json.dumps({'vm_name': 'replaced', 'tags': [self.db, self.cache]}), content_type='application/json').json()
+
+        self.assertEqual(response['status'], 'success', response)
+        self.assertEqual(self.state(), ('replaced', 2, ['cache', 'db']))
+
+    def test_errors(self):
+        self.assertEqual(self.patch(add_tags=[str(uuid.uuid4())]).json()['error_code'], 100)
+        self.assertEqual(self.patch(add_tags=[self.db], remove_tags=[self.db]).json()['error_code'], 103)
+        self.assertEqual(self.client.patch('/vms/{0}'.format(uuid.uuid4()), '{}', content_type='application/json').json()['error_code'], 100)
+        self.assertEqual(self.state(), ('update-vm', 1, ['web']))
+
+
+@override_settings(
+    TAG_ASSIGNMENTS={'CHUNK_SIZE': 10, 'RETRIES': 100, 'RETRY_BACKOFF': 0.001},
+    TAG_RATE_LIMITS={'ENABLED': False},
+)
+class AssignmentStressTests(TransactionTestCase):
+    threads = 8
+    rounds = 5
+
+    def setUp(self):
+        self.user = UserProfile.objects.create(user_name='admin')
+        self.tags = []
+        for i in range(4):
+            tag = TagsModel(tag_name='stress-{0}'.format(i), scope='stress', user_id=self.user)
+            tag.save()
+            self.tags.append(tag)
+        self.vm_ids = [vm.vm_id for vm in VM.objects.bulk_create([VM(vm_name='stress-vm-{0}'.format(i)) for i in range(60)])]
+
+    def hammer(self, work):
+        errors = []
+        barrier = threading.Barrier(self.threads)
+
+        def worker(seed):
+            try:
+                barrier.wait()
+                work(random.Random(seed))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker, args=(seed,)) for seed in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_overlapping_assign_and_unassign(self):
+        lock = threading.Lock()
+        expected = {tag.tag_id: set() for tag in self.tags}
+
+        def change(action, record):
+            def work(rng):
+                for _ in range(self.rounds):
+                    tag = rng.choice(self.tags)
+                    # Overlapping sets in arbitrary order
+                    vm_ids = rng.sample(self.vm_ids, 40)
+                    action(tag, vm_ids)
+                    with lock:
+                        record(expected[tag.tag_id], vm_ids)
+            return work
+
+        self.hammer(change(VMTag.assign, set.update))
+        self.hammer(change(VMTag.unassign, set.difference_update))
+
+        for tag in self.tags:
+            self.assertEqual(set(tag.vms.values_list('vm_id', flat=True)), expected[tag.tag_id])
+
+    def test_concurrent_vm_posts_share_a_new_tag(self):
+        def work(rng):
+            response = Client().post('/vms', {'vm_name': 'racer-{0}'.format(rng.random()), 'tags': 'fresh', 'scope': 'stress', 'user_id': self.user.user_id})
+            self.assertEqual(response.json()['status'], 'success', response.content)
+
+        self.hammer(work)
+
+        tag = TagsModel.objects.get(tag_name='fresh')
+        self.assertEqual(tag.vms.count(), self.threads)
+
+
+class GroupCommitTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = UserProfile.objects.create(user_name='admin')
+        self.tag = TagsModel(tag_name='grouped', scope='group', user_id=self.user)
+        self.tag.save()
+        self.vm_ids = [vm.vm_id for vm in VM.objects.bulk_create([VM(vm_name='group-vm-{0}'.format(i)) for i in range(8)])]
+        metrics.reset()
+
+    @override_settings(TAG_GROUP_COMMIT={'ENABLED': True, 'MAX_DELAY': 0.2})
+    def test_concurrent_calls_share_commits(self):
+        barrier = threading.Barrier(len(self.vm_ids))
+        responses = []
+
+        def worker(vm_id):
+            try:
+                barrier.wait()
+                responses.append(Client().post('/Assign_Unassign_vm', json.dumps(
+                    {'action': 'assign', 'tag_name': 'grouped', 'vm_ids': [str(vm_id)]}), content_type='application/json').json())
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=worker, args=(vm_id,)) for vm_id in self.vm_ids]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        # Every call was answered after its batch committed
+        self.assertEqual([response['status'] for response in responses], ['success'] * len(self.vm_ids))
+        self.assertEqual(set(self.tag.vms.values_list('vm_id', flat=True)), set(self.vm_ids))
+
+        counters = metrics.snapshot()
+        self.assertEqual(counters['group_commit.operations'], len(self.vm_ids))
+        self.assertLess(counters['group_commit.flushes'], len(self.vm_ids))
+
+    def test_last_operation_wins(self):
+        first, second = self.vm_ids[:2]
+        VMTag.assign(self.tag, [second])
+        group_commit.write_batch([
+            group_commit._Operation('assign', self.tag, [first], None),
+            group_commit._Operation('unassign', self.tag, [first, second], None),
+            group_commit._Operation('assign', self.tag, [second], self.user),
+        ])
+
+        self.assertEqual(list(self.tag.vms.values_list('vm_id', flat=True)), [second])
+
+    def test_bad_operation_fails_alone(self):
+        good = group_commit._Operation('assign', self.tag, [self.vm_ids[0]], None)
+        other = group_commit._Operation('unassign', self.tag, [self.vm_ids[1]], None)
+        bad = group_commit._Operation('assign', self.tag, [self.vm_ids[2], uuid.uuid4()], None)
+        VMTag.assign(self.tag, [self.vm_ids[1]])
+
+        # The unknown VM id fails the shared write on every backend...
+        with self.assertRaises(ValidationError):
+            group_commit.write_batch([good, other, bad])
+        self.assertEqual(list(self.tag.vms.values_list('vm_id', flat=True)), [self.vm_ids[1]])
+
+        # ...so flush() falls back to one transaction per operation
+        group_commit.WriteBuffer().flush([good, other, bad])
+
+        self.assertIsNone(good.error)
+        self.assertIsNone(other.error)
+        self.assertIsInstance(bad.error, ValidationError)
+        self.assertEqual(list(self.tag.vms.values_list('vm_id', flat=True)), [self.vm_ids[0]])
+        self.assertEqual(metrics.snapshot()['group_commit.fallbacks'], 1)
+
+    def test_only_new_rows_are_reported(self):
+        added = []
+
+        def receiver(action, pk_set, **kwargs):
+            if action == 'post_add':
+                added.append(pk_set)
+
+        VMTag.assign(self.tag, [self.vm_ids[0]])
+        m2m_changed.connect(receiver, sender=VMTag)
+        try:
+            group_commit.write_batch([group_commit._Operation('assign', self.tag, self.vm_ids[:2], None)])
+        finally:
+            m2m_changed.disconnect(receiver, sender=VMTag)
+
+        self.assertEqual(added, [{self.vm_ids[1]}])
+
+
+# Job progress as the 'test_steps' handler saw it before each batch
+steps_seen = []
+
+
+@jobs.register('test_steps')
+def run_steps(job):
+    for count in job.payload['steps']:
+        if count is None:
+            raise RuntimeError("step failed")
+        steps_seen.append(Job.objects.get(pk=job.pk).processed)
+        yield count
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': False})
+class JobTests(TransactionTestCase):
+
+    def setUp(self):
+        self.user = UserProfile.objects.create(user_name='admin')
+        self.tag = TagsModel(tag_name='queued', scope='jobs', user_id=self.user)
+        self.tag.save()
+        self.vm_ids = [str(vm.vm_id) for vm in VM.objects.bulk_create([VM(vm_name='job-vm-{0}'.format(i)) for i in range(5)])]
+
+    def wait_for(self, job_id):
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            job = self.client.get('/jobs/{0}'.format(job_id)).json()['data']
+            if job['status'] in (Job.STATUS_DONE, Job.STATUS_FAILED):
+                return job
+            time.sleep(0.02)
+        self.fail("Job {0} did not finish".format(job_id))
+
+    @override_settings(TAG_JOBS={'BATCH_SIZE': 2})
+    def test_assign_runs_as_job(self):
+        response = self.client.post('/Assign_Unassign_vm', json.dumps(
+            {'action': 'assign', 'tag_name': 'queued', 'vm_ids': self.vm_ids, 'async': True}), content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+
+        job = self.wait_for(response.json()['data']['job_id'])
+        self.assertEqual((job['status'], job['processed'], job['total']), (Job.STATUS_DONE, 5, 5))
+        self.assertEqual(set(str(vm_id) for vm_id in self.tag.vms.values_list('vm_id', flat=True)), set(self.vm_ids))
+        self.assertEqual(jobs._pending, 0)
+
+    def test_progress_is_saved_per_batch(self):
+        job = Job.objects.create(action='test_steps', payload={'steps': [2, 3, 4]}, total=9)
+        steps_seen.clear()
+        jobs.run_job(job.job_id)
+
+        job.refresh_from_db()
+        self.assertEqual(steps_seen, [0, 2, 5])
+        self.assertEqual((job.status, job.processed), (Job.STATUS_DONE, 9))
+
+    def test_failed_job_keeps_progress(self):
+        job = Job.objects.create(action='test_steps', payload={'steps': [2, None]}, total=4)
+        jobs.run_job(job.job_id)
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.processed, job.error), (Job.STATUS_FAILED, 2, 'step failed'))
+
+    @override_settings(TAG_JOBS={'MAX_PENDING': 0})
+    def test_full_queue_is_503(self):
+        response = self.client.post('/Assign_Unassign_vm', json.dumps(
+            {'action': 'assign', 'tag_name': 'queued', 'vm_ids': self.vm_ids, 'async': True}), content_type='application/json')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['error_code'], 109)
+        self.assertFalse(Job.objects.exists())
+
+    def test_rollback_releases_slot(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                jobs.submit('test_steps', {'steps': [1]})
+                self.assertEqual(jobs._pending, 1)
+                raise RuntimeError("rolled back")
+
+        self.assertEqual(jobs._pending, 0)
+        self.assertFalse(Job.objects.exists())
+
+    def test_interrupted_jobs_are_failed(self):
+        hour_ago = timezone.now() - datetime.timedelta(hours=1, seconds=1)
+        queued = Job.objects.create(action='test_steps', payload={'steps': [1]})
+        running = Job.objects.create(action='test_steps', payload={'steps': [1]}, status=Job.STATUS_RUNNING)
+        done = Job.objects.create(action='test_steps', payload={'steps': [1]}, status=Job.STATUS_DONE)
+        fresh = Job.objects.create(action='test_steps', payload={'steps': [1]})
+        Job.objects.filter(pk__in=[queued.pk, running.pk, done.pk]).update(updated_at=hour_ago)
+
+        self.assertEqual(jobs.fail_stale(), 2)
+        statuses = dict(Job.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {queued.pk: Job.STATUS_FAILED, running.pk: Job.STATUS_FAILED,
+                                    done.pk: Job.STATUS_DONE, fresh.pk: Job.STATUS_QUEUED})
+
+        # A worker reaching a failed job leaves it alone
+        steps_seen.clear()
+        jobs.run_job(queued.job_id)
+        self.assertEqual(steps_seen, [])
+        self.assertEqual(Job.objects.get(pk=queued.pk).status, Job.STATUS_FAILED)
+
+
+class BatchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(user_name='admin')
+
+    def batch(self, operations, atomic=False):
+        return self.client.post('/batch', json.dumps({'atomic': atomic, 'operations': operations}), content_type='application/json').json()
+
+    def test_references_between_operations(self):
+        response = self.batch([
+            {'id': 'tag', 'method': 'POST', 'path': '/tags', 'body': {'tag_name': 'batch-env', 'scope': 'batch', 'user_id': self.user.user_id}},
+            {'id': 'vm', 'method': 'POST', 'path': '/vms', 'body': {'vm_name': 'batch-vm'}},
+            {'method': 'POST', 'path': '/Assign_Unassign_vm', 'body': {'action': 'assign', 'tag_name': 'batch-env', 'vm_ids': ['${vm.data.vm_id}']}},
+            {'method': 'GET', 'path': '/tags?fields=tag_name', 'query': {'tag_id': '${tag.data.tag_id}'}},
+        ], atomic=True)
+
+        self.assertEqual(response['status'], 'success', response)
+        results = response['data']['results']
+        self.assertEqual([result['id'] for result in results], ['tag', 'vm', '2', '3'])
+        self.assertEqual(results[3]['body']['data'], [{'tag_name': 'batch-env'}])
+        self.assertEqual(list(VM.objects.get(vm_name='batch-vm').tags.values_list('tag_name', flat=True)), ['batch-env'])
+
+    def test_atomic_batch_rolls_back(self):
+        response = self.batch([
+            {'method': 'POST', 'path': '/vms', 'body': {'vm_name': 'rolled-back'}},
+            {'method': 'POST', 'path': '/Assign_Unassign_vm', 'body': {'action': 'bogus'}},
+            {'method': 'GET', 'path': '/user'},
+        ], atomic=True)
+
+        self.assertEqual(response['error_code'], 110)
+        self.assertEqual(len(response['data']['results']), 2)
+        self.assertFalse(VM.objects.filter(vm_name='rolled-back').exists())
+
+    def test_failures_without_transaction(self):
+        response = self.batch([
+            {'id': 'missing', 'method': 'GET', 'path': '/nowhere'},
+            {'method': 'GET', 'path': '/jobs/${missing.data.job_id}'},
+            {'method': 'POST', 'path': '/batch', 'body': {}},
+            {'method': 'POST', 'path': '/vms', 'body': {'vm_name': 'kept'}},
+        ])
+
+        self.assertEqual(response['error_code'], 110)
+        self.assertEqual([result['status'] for result in response['data']['results']], [400, 400, 400, 200])
+        self.assertTrue(VM.objects.filter(vm_name='kept').exists())
+
+    @override_settings(TAG_BATCH={'MAX_OPERATIONS': 2, 'MAX_SECONDS': 0})
+    def test_limits(self):
+        self.assertEqual(self.batch([{'path': '/user'}] * 3)['error_code'], 103)
+        self.assertEqual(self.batch([])['error_code'], 103)
+
+        results = self.batch([{'path': '/user'}])['data']['results']
+        self.assertEqual(results[0]['status'], 504)
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': False})
+class FieldsTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(user_name='admin')
+        cls.tag = TagsModel(tag_name='env', scope='fields', user_id=cls.user)
+        cls.tag.save()
+        VM.objects.create(vm_name='fields-vm')
+
+    def test_rows_hold_the_requested_fields(self):
+        response = self.client.get('/tags', {'fields': 'tag_name, user_id,tag_name', 'scope': 'fields'}).json()
+        self.assertEqual(response['data'], [{'tag_name': 'env', 'user_id': self.user.user_id}])
+
+        response = self.client.get('/vms', {'fields': 'vm_name'}).json()
+        self.assertEqual(response['data'], [{'vm_name': 'fields-vm'}])
+
+    def test_public_names(self):
+        # ?fields= rows name the owner user_id, as ?user_id= does
+        row = self.client.get('/tags', {'tag_id': str(self.tag.tag_id), 'fields': 'user_id'}).json()['data'][0]
+        self.assertEqual(row, {'user_id': self.user.user_id})
+
+        row = self.client.get('/tags', {'scope': 'fields', 'fields': ','.join(Tags.allowed_fields)}).json()['data'][0]
+        self.assertEqual(set(row), set(Tags.allowed_fields))
+
+    def test_default_keys_are_unchanged(self):
+        for params in ({'scope': 'fields'}, {'tag_id': str(self.tag.tag_id)}):
+            row = self.client.get('/tags', params).json()['data'][0]
+            self.assertEqual(set(row), set(Tags.allowed_fields.values()))
+            self.assertEqual(row['user_id_id'], self.user.user_id)
+
+    def test_invalid_fields(self):
+        for fields in ('user_id_id', 'tag_name,deleted_at', 'vm_name'):
+            response = self.client.get('/tags', {'fields': fields}).json()
+            self.assertEqual(response['error_code'], 103, fields)
+            self.assertIn('Allowed fields: tag_id, tag_name', response['message'])
+
+        response = self.client.get('/vms', {'fields': 'tag_list'}).json()
+        self.assertEqual(response['error_code'], 103)
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': False})
+class LookupTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(user_name='admin')
+        cls.tags = []
+        for name in ('alpha', 'beta', 'gamma'):
+            tag = TagsModel(tag_name=name, scope='lookup', user_id=cls.user)
+            tag.save()
+            cls.tags.append(tag)
+        cls.vms = VM.objects.bulk_create([VM(vm_name='lookup-vm-{0}'.format(i)) for i in range(5)])
+
+    def test_tag_ids_in_request_order(self):
+        alpha, beta, gamma = (str(tag.tag_id) for tag in self.tags)
+        unknown = str(uuid.uuid4())
+        response = self.client.get('/tags?tag_id={0},{1}&tag_id={2}&tag_id={3}'.format(gamma, unknown, alpha, gamma)).json()
+
+        self.assertEqual([row['tag_id'] for row in response['data']], [gamma, alpha])
+        self.assertEqual(response['missing'], [unknown])
+
+    def test_names_are_not_split(self):
+        response = self.client.get('/tags', {'tag_name': ['beta', 'alpha,beta'], 'fields': 'scope'}).json()
+
+        self.assertEqual(response['data'], [{'scope': 'lookup'}])
+        self.assertEqual(response['missing'], ['alpha,beta'])
+
+    @override_settings(TAG_LOOKUPS={'MAX_VALUES': 2})
+    def test_max_values(self):
+        response = self.client.get('/vms', {'vm_id': ','.join(str(vm.vm_id) for vm in self.vms[:3])}).json()
+        self.assertEqual(response['error_code'], 103)
+
+    def test_invalid_id(self):
+        response = self.client.get('/tags', {'tag_id': 'not-a-uuid'}).json()
+        self.assertEqual(response['error_code'], 103)
+
+    @override_settings(TAG_LOOKUPS={'CHUNK_SIZE': 2})
+    def test_post_lookup_in_chunks(self):
+        names = ['lookup-vm-4', 'nope', 'lookup-vm-0', 'lookup-vm-2', 'lookup-vm-1']
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.post('/vms/lookup', json.dumps({'vm_name': names, 'fields': 'vm_id'}), content_type='application/json').json()
+
+        self.assertEqual(len(captured), 3)
+        by_name = {vm.vm_name: str(vm.vm_id) for vm in self.vms}
+        self.assertEqual(response['data'], [{'vm_id': by_name[name]} for name in names if name != 'nope'])
+        self.assertEqual(response['missing'], ['nope'])
+
+    def test_post_lookup_count(self):
+        response = self.client.post('/vms/lookup', json.dumps({'vm_id': [str(vm.vm_id) for vm in self.vms], 'count_only': True}), content_type='application/json').json()
+        self.assertEqual(response['data'], {'count': 5})
+
+    def test_lookup_only_accepts_post(self):
+        self.assertEqual(self.client.get('/tags/lookup').status_code, 405)
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': False})
+class CountTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        VM.objects.bulk_create([VM(vm_name='count-vm-{0}'.format(i)) for i in range(12)])
+
+    def setUp(self):
+        cache.clear()
+
+    def test_exact_count_with_page(self):
+        response = self.client.get('/vms', {'count': 'exact', 'limit': 5, 'offset': 10, 'fields': 'vm_name'}).json()
+
+        self.assertEqual((response['count'], response['count_type']), (12, 'exact'))
+        self.assertEqual(len(response['data']), 2)
+
+    def test_pages_do_not_overlap(self):
+        names = [
+            row['vm_name']
+            for offset in (0, 5, 10)
+            for row in self.client.get('/vms', {'limit': 5, 'offset': offset, 'fields': 'vm_name'}).json()['data']
+        ]
+        self.assertEqual(sorted(names), sorted(VM.objects.values_list('vm_name', flat=True)))
+
+    def test_estimated_count_reuses_exact_count(self):
+        # Small tables are counted exactly, then served from the cache
+        first = self.client.get('/vms', {'count': 'estimated', 'limit': 1}).json()
+        VM.objects.create(vm_name='count-vm-new')
+        with CaptureQueriesContext(connection) as captured:
+            second = self.client.get('/vms', {'count': 'estimated', 'limit': 1}).json()
+
+        self.assertEqual((first['count'], first['count_type']), (12, 'exact'))
+        self.assertEqual((second['count'], second['count_type']), (12, 'cached'))
+        self.assertEqual(len(captured), 1)
+
+    @override_settings(TAG_COUNTS={'EXACT_BELOW': 0})
+    def test_estimate_from_table_statistics(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        VM.objects.create(vm_name='count-vm-new')
+
+        response = self.client.get('/vms', {'count': 'estimated', 'fields': 'vm_id'}).json()
+        self.assertEqual((response['count'], response['count_type']), (12, 'estimated'))
+
+    def test_no_count_by_default(self):
+        self.assertNotIn('count', self.client.get('/tags').json())
+
+    def test_invalid_mode(self):
+        self.assertEqual(self.client.get('/tags', {'count': 'some'}).json()['error_code'], 103)
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': False})
+class PurgeTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = UserProfile.objects.create(user_name='owner')
+        cls.other = UserProfile.objects.create(user_name='other')
+        cls.tags = []
+        for i in range(3):
+            tag = TagsModel(tag_name='purge-{0}'.format(i), scope='purge', user_id=cls.owner)
+            tag.save()
+            cls.tags.append(tag)
+        cls.kept = TagsModel(tag_name='kept', scope='purge', user_id=cls.other)
+        cls.kept.save()
+
+        cls.vms = VM.objects.bulk_create([VM(vm_name='purge-vm-{0}'.format(i)) for i in range(5)])
+        for tag in cls.tags:
+            VMTag.assign(tag, [vm.vm_id for vm in cls.vms], cls.other)
+        VMTag.assign(cls.kept, [vm.vm_id for vm in cls.vms], cls.owner)
+
+    @override_settings(TAG_PURGE={'BATCH_SIZE': 2})
+    def test_vm_is_hidden_then_purged(self):
+        vm = self.vms[0]
+        response = self.client.delete('/vms/{0}'.format(vm.vm_id)).json()
+
+        self.assertEqual(response['status'], 'success')
+        self.assertFalse(VM.objects.filter(pk=vm.pk).exists())
+        self.assertEqual(self.client.get('/vms', {'vm_id': str(vm.vm_id)}).json()['missing'], [str(vm.vm_id)])
+        self.assertEqual(self.client.get('/vms/{0}'.format(vm.vm_id)).json()['data'], [])
+        self.assertEqual(VMTag.objects.filter(vm=vm).count(), 4)
+
+        jobs.run_job(response['data']['job_id'])
+
+        job = Job.objects.get(job_id=response['data']['job_id'])
+        self.assertEqual((job.status, job.processed), (Job.STATUS_DONE, 5))
+        self.assertFalse(VM.all_objects.filter(pk=vm.pk).exists())
+        self.assertFalse(VMTag.objects.filter(vm_id=vm.pk).exists())
+
+    def test_deleted_rows_cannot_be_assigned(self):
+        vm = VM.objects.create(vm_name='purge-late')
+        vm.soft_delete()
+        with self.assertRaisesMessage(ValidationError, str(vm.vm_id)), transaction.atomic():
+            VMTag.assign(self.kept, [vm.vm_id])
+
+        self.owner.soft_delete()
+        with self.assertRaisesMessage(ValidationError, 'deleted'), transaction.atomic():
+            VMTag.assign(self.tags[0], [self.vms[0].vm_id])
+
+        # Nothing was added behind the purger's back
+        self.assertEqual(list(purge.purge_vm(vm.vm_id)), [1])
+        self.assertFalse(VM.all_objects.filter(pk=vm.pk).exists())
+
+    def test_deleted_vm_name_is_kept_until_purged(self):
+        self.client.delete('/vms/{0}'.format(self.vms[1].vm_id))
+        response = self.client.post('/vms', {'vm_name': self.vms[1].vm_name}).json()
+        self.assertEqual(response['error_code'], 102)
+
+    @override_settings(TAG_PURGE={'BATCH_SIZE': 2}, TAG_VM_TAG_LISTS={'ENABLED': True})
+    def test_user_is_hidden_then_purged(self):
+        response = self.client.delete('/user/{0}'.format(self.owner.user_id)).json()
+
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual([user['user_name'] for user in self.client.get('/user').json()['users']], ['other'])
+        self.assertEqual(self.client.get('/tags', {'scope': 'purge', 'fields': 'tag_name'}).json()['data'], [{'tag_name': 'kept'}])
+        self.assertEqual(self.client.get('/vms', {'tag_name': 'purge-0', 'count': 'exact'}).json()['count'], 0)
+
+        jobs.run_job(response['data']['job_id'])
+
+        self.assertFalse(UserProfile.all_objects.filter(pk=self.owner.pk).exists())
+        self.assertFalse(TagsModel.all_objects.filter(user_id=self.owner.pk).exists())
+        self.assertEqual(set(VMTag.objects.values_list('tag_id', flat=True)), {self.kept.tag_id})
+        self.assertFalse(VMTag.objects.exclude(assigned_by=None).exists())
+        self.assertEqual(VM.objects.get(pk=self.vms[0].pk).tag_list, [{'tag_id': str(self.kept.tag_id), 'tag_name': 'kept', 'scope': 'purge'}])
+
+    def test_purge_deleted_command(self):
+        # Soft deletes whose purge jobs never ran
+        self.vms[2].soft_delete()
+        self.owner.soft_delete()
+
+        call_command('purge_deleted', stdout=io.StringIO())
+
+        self.assertEqual(VM.all_objects.count(), 4)
+        self.assertEqual(list(UserProfile.all_objects.values_list('user_name', flat=True)), ['other'])
+        self.assertEqual(VMTag.objects.count(), 4)
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': False})
+class KeyValueTagTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(user_name='admin')
+        cls.vms = {name: VM.objects.create(vm_name=name) for name in ('web', 'db', 'cache', 'plain')}
+        tags = {}
+        for name in ('env=prod', 'env=staging', 'role=web', 'legacy'):
+            tags[name] = TagsModel(tag_name=name, scope='kv', user_id=cls.user)
+            tags[name].save()
+
+        VMTag.assign(tags['env=prod'], [cls.vms['web'].vm_id, cls.vms['db'].vm_id])
+        VMTag.assign(tags['env=staging'], [cls.vms['db'].vm_id, cls.vms['cache'].vm_id])
+        VMTag.assign(tags['role=web'], [cls.vms['web'].vm_id])
+        VMTag.assign(tags['legacy'], [cls.vms['plain'].vm_id])
+
+    def vm_names(self, params):
+        response = self.client.get('/vms', dict(params, fields='vm_name')).json()
+        self.assertEqual(response['status'], 'success', response)
+        return sorted(row['vm_name'] for row in response['data'])
+
+    def test_split_tag_name(self):
+        tag = TagsModel(tag_name=' owner = team=infra ', scope='kv', user_id=self.user)
+        tag.save()
+        self.assertEqual((tag.key, tag.value), ('owner', 'team=infra'))
+        self.assertEqual(TagsModel.objects.filter(key='legacy').values_list('value', flat=True).get(), None)
+
+    def test_key_only(self):
+        self.assertEqual(self.vm_names({'tag_key': 'env'}), ['cache', 'db', 'web'])
+
+    def test_key_value(self):
+        self.assertEqual(self.vm_names({'tag_key': 'env', 'tag_value': 'prod'}), ['db', 'web'])
+
+    def test_key_in_values(self):
+        # db carries both values and is listed once
+        self.assertEqual(self.vm_names({'tag_key': 'env', 'tag_value': ['prod', 'staging']}), ['cache', 'db', 'web'])
+
+    def test_value_without_key(self):
+        self.assertEqual(self.client.get('/vms', {'tag_value': 'prod'}).json()['error_code'], 103)
+
+    def test_tag_name_still_works(self):
+        self.assertEqual(self.vm_names({'tag_name': 'env=staging'}), ['cache', 'db'])
+
+    def test_tags_by_key_and_create_from_key_value(self):
+        response = self.client.post('/tags', {'key': 'tier', 'value': 'gold', 'scope': 'kv', 'user_id': self.user.user_id}).json()
+        self.assertEqual(response['status'], 'success', response)
+
+        response = self.client.get('/tags', {'key': ['tier', 'role'], 'fields': 'tag_name,key,value'}).json()
+        self.assertEqual(sorted(response['data'], key=lambda row: row['key']), [
+            {'tag_name': 'role=web', 'key': 'role', 'value': 'web'},
+            {'tag_name': 'tier=gold', 'key': 'tier', 'value': 'gold'},
+        ])
+
+
+class TransferTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # An empty user_name must not come back as NULL
+        users = [UserProfile.objects.create(user_name=name) for name in ('admin', 'caf\u00e9, "ops"', '')]
+        tags = []
+        for i, tag_name in enumerate(('env', 'tier=gold', 'note')):
+            tag = TagsModel(tag_name=tag_name, scope='transfer-{0}'.format(i % 2), user_id=users[i % 2])
+            tag.save()
+            tags.append(tag)
+        vms = VM.objects.bulk_create([VM(vm_name='transfer-{0}'.format(i)) for i in range(5)])
+        VMTag.assign(tags[0], [vm.vm_id for vm in vms], users[0])
+        VMTag.assign(tags[1], [vms[0].vm_id, vms[3].vm_id], users[1])
+        # Optimistic-lock versions and denormalized tag lists are kept
+        VM.objects.filter(pk=vms[1].pk).update(version=4, tag_list=[{'tag_name': 'env', 'scope': 'transfer-0'}])
+        # Waiting for the purger, with vms_tags rows still pointing at them
+        vms[3].soft_delete()
+        users[1].soft_delete()
+
+    def snapshot(self):
+        return {name: list(model._base_manager.order_by(model._meta.pk.attname).values_list(*columns))
+                for name, model, columns in transfer.TABLES}
+
+    def test_round_trip(self):
+        before = self.snapshot()
+        self.assertTrue(all(before.values()))
+
+        for fmt in transfer.FORMATS:
+            with self.subTest(fmt), tempfile.TemporaryDirectory() as directory:
+                # Pages smaller than every table
+                call_command('export_tags', directory, format=fmt, chunk_size=2, stdout=io.StringIO())
+                for name, model, columns in reversed(transfer.TABLES):
+                    purge.raw_delete(model._base_manager.all())
+
+                call_command('import_tags', directory, format=fmt, batch_size=2, stdout=io.StringIO())
+                self.assertEqual(self.snapshot(), before)
+
+                # Structured tags get their key and value back
+                self.assertEqual(TagsModel.all_objects.filter(key='tier', value='gold').count(), 1)
+
+    def test_ignore_conflicts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            call_command('export_tags', directory, stdout=io.StringIO())
+            call_command('import_tags', directory, ignore_conflicts=True, stdout=io.StringIO())
+        self.assertEqual(VMTag.objects.count(), 7)
+
+
+class HistogramTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        user = UserProfile.objects.create(user_name='admin')
+        cls.web = TagsModel(tag_name='web', scope='hist', user_id=user)
+        cls.web.save()
+
+        created = {
+            'a': datetime.datetime(2024, 1, 1, 10, 30, tzinfo=datetime.timezone.utc),
+            'b': datetime.datetime(2024, 1, 1, 15, 0, tzinfo=datetime.timezone.utc),
+            'c': datetime.datetime(2024, 1, 2, 9, 0, tzinfo=datetime.timezone.utc),
+            'd': datetime.datetime(2024, 1, 8, 0, 0, tzinfo=datetime.timezone.utc),
+        }
+        for name, when in created.items():
+            vm = VM.objects.create(vm_name='hist-' + name)
+            VM.objects.filter(pk=vm.pk).update(creation_date=when)
+        # Created now, in the still-open bucket
+        VM.objects.create(vm_name='hist-now')
+        VMTag.assign(cls.web, list(VM.objects.filter(vm_name__in=['hist-a', 'hist-c', 'hist-now']).values_list('vm_id', flat=True)))
+
+    def setUp(self):
+        cache.clear()
+
+    def buckets(self, params):
+        response = self.client.get('/vms/histogram', params).json()
+        self.assertEqual(response['status'], 'success', response)
+        return [(bucket['start'][:13], bucket['count']) + ((bucket['tag_id'],) if 'tag_id' in bucket else ()) for bucket in response['data']['buckets']]
+
+    def test_daily_buckets(self):
+        self.assertEqual(self.buckets({'interval': 'day', 'created_before': '2024-02-01'}), [
+            ('2024-01-01T00', 2), ('2024-01-02T00', 1), ('2024-01-08T00', 1)])
+
+    def test_weekly_buckets_include_open_bucket(self):
+        today = histograms.bucket_start(timezone.now(), 'week').isoformat()[:13]
+        self.assertEqual(self.buckets({'interval': 'week'}), [('2024-01-01T00', 3), ('2024-01-08T00', 1), (today, 1)])
+
+    def test_per_tag_and_tag_filter(self):
+        params = {'interval': 'hour', 'created_after': '2024-01-01', 'created_before': '2024-01-03'}
+        tag_id = str(self.web.tag_id)
+        self.assertEqual(self.buckets(dict(params, per_tag=1)), [('2024-01-01T10', 1, tag_id), ('2024-01-02T09', 1, tag_id)])
+        self.assertEqual(self.buckets(dict(params, tag_id=tag_id)), [('2024-01-01T10', 1), ('2024-01-02T09', 1)])
+
+    def test_closed_buckets_are_cached(self):
+        self.buckets({'interval': 'day'})
+        late = VM.objects.create(vm_name='hist-late')
+        VM.objects.filter(pk=late.pk).update(creation_date=datetime.datetime(2024, 1, 2, 12, 0, tzinfo=datetime.timezone.utc))
+
+        with CaptureQueriesContext(connection) as captured:
+            buckets = self.buckets({'interval': 'day'})
+
+        # Only the open bucket was queried; the cached past does not see the late VM
+        self.assertEqual(len(captured), 1)
+        self.assertEqual(buckets[1], ('2024-01-02T00', 1))
+        self.assertEqual(sum(bucket[1] for bucket in buckets), 5)
+
+    def test_tag_changes_invalidate_closed_buckets(self):
+        params = {'interval': 'day', 'created_before': '2024-02-01', 'per_tag': 1}
+        tag_id = str(self.web.tag_id)
+        self.assertEqual(self.buckets(params), [('2024-01-01T00', 1, tag_id), ('2024-01-02T00', 1, tag_id)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            VMTag.assign(self.web, [VM.objects.get(vm_name='hist-d').vm_id])
+        self.assertEqual(self.buckets(params)[-1], ('2024-01-08T00', 1, tag_id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            VM.objects.get(vm_name='hist-a').delete()
+        self.assertEqual(self.buckets(params)[0], ('2024-01-02T00', 1, tag_id))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.web.delete()
+        self.assertEqual(self.buckets(params), [])
+
+    def test_created_filters_on_vms(self):
+        response = self.client.get('/vms', {'created_after': '2024-01-01T12:00:00', 'created_before': '2024-01-08', 'fields': 'vm_name'}).json()
+        self.assertEqual(sorted(row['vm_name'] for row in response['data']), ['hist-b', 'hist-c'])
+
+    def test_invalid_params(self):
+        self.assertEqual(self.client.get('/vms/histogram', {'interval': 'month'}).json()['error_code'], 103)
+        self.assertEqual(self.client.get('/vms', {'created_after': 'yesterday'}).json()['error_code'], 103)
+
+
+# Dataset sizes every endpoint is run against; query counts must not change
+# between them. Wall-time ceilings are in seconds at the largest size and can
+# be scaled for slow CI machines with TAG_PERF_SLACK.
+BUDGET_SIZES = (10, 100, 400)
+PERF_SLACK = float(os.environ.get('TAG_PERF_SLACK', '1'))
+
+
+@override_settings(TAG_RATE_LIMITS={'ENABLED': False})
+class QueryBudgetTests(TestCase):
+    """
+    Query count and wall-time budgets for every endpoint.
+
+    Each case is run after seeding BUDGET_SIZES VMs (two tags each), so an
+    N+1 pattern shows up as a count that grows with the data.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserProfile.objects.create(user_name='admin')
+        cls.scope_tag = TagsModel(tag_name='budget', scope='perf', user_id=cls.user)
+        cls.scope_tag.save()
+
+    def setUp(self):
+        self.seeded_vm_ids = []
+        self.seeded_tag_ids = []
+
+    def seed(self, size):
+        existing = len(self.seeded_vm_ids)
+        if existing >= size:
+            return
+
+        vms = VM.objects.bulk_create([VM(vm_name='budget-vm-{0}'.format(i)) for i in range(existing, size)])
+        # bulk_create() skips save(), so the fields it derives are set here
+        # for the scope and key/value filters to match the seeded tags
+        tags = TagsModel.objects.bulk_create([
+            TagsModel(tag_name='budget-tag={0}'.format(i), scope='perf', scope_ref=self.scope_tag.scope_ref,
+                      key='budget-tag', value=str(i), user_id=self.user)
+            for i in range(existing, size)
+        ])
+
+        self.seeded_vm_ids += [str(vm.vm_id) for vm in vms]
+        self.seeded_tag_ids += [str(tag.tag_id) for tag in tags]
+
+        VMTag.objects.bulk_create(
+            [VMTag(vm=vm, tag=tag) for vm, tag in zip(vms, tags)]
+            + [VMTag(vm=vm, tag=self.scope_tag) for vm in vms]
+        )
+
+    def assertBudget(self, queries, ceiling, call, setup=None):
+        """
+        Run call(size) at every dataset size and check its query count and run
+        time. setup(size), if given, runs before and is not measured.
+        """
+        for size in BUDGET_SIZES:
+            self.seed(size)
+            if setup is not None:
+                setup(size)
+
+            start = time.perf_counter()
+            with CaptureQueriesContext(connection) as captured:
+                response = call(size)
+            elapsed = time.perf_counter() - start
+
+            self.assertEqual(response.status_code, 200, response.content)
+            self.assertNotEqual(response.json().get('status'), 'error', response.content)
+            self.assertEqual(
+                len(captured), queries,
+                "{0} queries at size {1}, budget is {2}:\n{3}".format(
+                    len(captured), size, queries, '\n'.join(q['sql'] for q in captured.captured_queries)),
+            )
+            self.assertLess(elapsed, ceiling * PERF_SLACK, "took {0:.3f}s at size {1}".format(elapsed, size))
+
+    # Tags
+
+    def test_tags_list(self):
+        self.assertBudget(1, 0.5, lambda size: self.client.get('/tags'))
+
+    def test_tags_filtered(self):
+        def call(size):
+            response = self.client.get('/tags', {'scope': 'perf', 'fields': 'tag_id,tag_name'})
+            self.assertEqual(len(response.json()['data']), size + 1)
+            return response
+
+        self.assertBudget(1, 0.2, call)
+
+    def test_tags_page_with_count(self):
+        self.assertBudget(2, 0.5, lambda size: self.client.get('/tags', {'count': 'exact', 'limit': 50, 'offset': 10}))
+
+    def test_tags_by_ids(self):
+        self.assertBudget(1, 0.2, lambda size: self.client.get('/tags', {'tag_id': ','.join(self.seeded_tag_ids[:200])}))
+
+    def test_tags_create(self):
+        self.assertBudget(4, 0.2, lambda size: self.client.post(
+            '/tags', {'tag_name': 'new-{0}'.format(size), 'scope': 'perf', 'user_id': self.user.user_id}))
+
+    def test_tags_lookup(self):
+        self.assertBudget(1, 0.2, lambda size: self.client.post(
+            '/tags/lookup', json.dumps({'tag_id': self.seeded_tag_ids[:200], 'fields': 'tag_name'}), content_type='application/json'))
+
+    def test_tags_search(self):
+        def setup(size):
+            search.get_index().build()
+
+        def call(size):
+            response = self.client.get('/tags/search', {'q': 'budget-tag=*', 'scope': 'perf'})
+            self.assertEqual(response.json()['data']['count'], size)
+            return response
+
+        # Served from the in-memory index
+        self.assertBudget(0, 0.2, call, setup)
+
+    def test_tags_delete(self):
+        def call(size):
+            tag = TagsModel(tag_name='gone-{0}'.format(size), scope='perf', user_id=self.user)
+            tag.save()
+            return self.client.delete('/tags?tag_id={0}&user_id={1}'.format(tag.tag_id, self.user.user_id))
+
+        # The three queries of tag.save() above are part of the count
+        self.assertBudget(8, 0.2, call)
+
+    # VMs
+
+    def test_vms_list(self):
+        self.assertBudget(1, 0.5, lambda size: self.client.get('/vms'))
+
+    def test_vms_by_tag(self):
+        self.assertBudget(1, 0.5, lambda size: self.client.get('/vms', {'tag_name': 'budget', 'scope': 'perf'}))
+
+    def test_vms_page_with_count(self):
+        self.assertBudget(2, 0.5, lambda size: self.client.get('/vms', {'count': 'exact', 'tag_name': 'budget', 'limit': 50}))
+
+    def test_vms_created_between(self):
+        self.assertBudget(1, 0.5, lambda size: self.client.get('/vms', {'created_after': '2024-01-01', 'created_before': '2100-01-01'}))
+
+    def test_vms_histogram(self):
+        def call(size):
+            # Cold cache: one grouped query for the closed buckets, one for the open one
+            cache.clear()
+            since = timezone.now() - datetime.timedelta(days=1)
+            return self.client.get('/vms/histogram', {'interval': 'hour', 'created_after': since.date().isoformat()})
+
+        self.assertBudget(2, 0.5, call)
+
+    def test_vms_lookup(self):
+        self.assertBudget(1, 0.5, lambda size: self.client.post(
+            '/vms/lookup', json.dumps({'vm_id': self.seeded_vm_ids[:200]}), content_type='application/json'))
+
+    def test_vms_by_key_value(self):
+        def call(size):
+            response = self.client.get('/vms', {'tag_key': 'budget-tag', 'tag_value': [str(i) for i in range(0, size, 2)], 'fields': 'vm_id'})
+            self.assertEqual(len(response.json()['data']), size // 2)
+            return response
+
+        self.assertBudget(1, 0.5, call)
+
+    def test_vms_tag_sets(self):
+        self.assertBudget(1, 0.5, lambda size: self.client.get('/vms', {
+            'tags_all': str(self.scope_tag.tag_id),
+            'tags_none': self.seeded_tag_ids[0],
+        }))
+
+    def test_vms_include_tags(self):
+        self.assertBudget(2, 0.5, lambda size: self.client.get('/vms', {'include': 'tags'}))
+
+    @override_settings(TAG_VM_TAG_LISTS={'ENABLED': True})
+    def test_vms_include_tag_lists(self):
+        self.assertBudget(1, 0.5, lambda size: self.client.get('/vms', {'include': 'tags'}))
+
+    def test_vms_count(self):
+        self.assertBudget(1, 0.2, lambda size: self.client.get('/vms', {'tags_any': str(self.scope_tag.tag_id), 'count_only': '1'}))
+
+    def test_vms_create(self):
+        # Two of them are the savepoint around creating the new tag
+        self.assertBudget(11, 0.2, lambda size: self.client.post(
+            '/vms', {'vm_name': 'new-vm-{0}'.format(size), 'tags': 'new-tag-{0}'.format(size), 'scope': 'perf', 'user_id': self.user.user_id}))
+
+    def test_vms_put(self):
+        # Swaps one tag at every size: the last seeded tag replaces the previous one
+        self.assertBudget(6, 0.2, lambda size: self.client.put('/vms/{0}'.format(self.seeded_vm_ids[0]), json.dumps(
+            {'tags': [str(self.scope_tag.tag_id), self.seeded_tag_ids[size - 1]]}), content_type='application/json'))
+
+    def test_vms_patch(self):
+        added = []
+
+        def call(size):
+            # Adds the last seeded tag and removes the one added before it
+            # (the VM's own seeded tag the first time)
+            remove = added[-1:] or self.seeded_tag_ids[:1]
+            added.append(self.seeded_tag_ids[size - 1])
+            return self.client.patch('/vms/{0}'.format(self.seeded_vm_ids[0]), json.dumps(
+                {'vm_name': 'renamed-{0}'.format(size), 'add_tags': added[-1:], 'remove_tags': remove}), content_type='application/json')
+
+        self.assertBudget(6, 0.2, call)
+
+    def test_vms_delete(self):
+        self.assertBudget(7, 0.2, lambda size: self.client.delete('/vms/{0}'.format(self.seeded_vm_ids[size - 1])))
+
+    # Assignments
+
+    def test_assign(self):
+        # The tag, the tag and VM id checks, the existing rows and one
+        # multi-row INSERT (SQLite splits it past 249 rows: 999 bound parameters)
+        self.assertBudget(5, 0.5, lambda size: self.client.post('/Assign_Unassign_vm', json.dumps(
+            {'action': 'assign', 'tag_name': 'budget-tag=1', 'vm_ids': self.seeded_vm_ids[:200]}), content_type='application/json'))
+
+    def test_unassign(self):
+        self.assertBudget(2, 0.5, lambda size: self.client.post('/Assign_Unassign_vm', json.dumps(
+            {'action': 'unassign', 'tag_name': 'budget', 'vm_ids': self.seeded_vm_ids}), content_type='application/json'))
+
+    # Users and jobs
+
+    def test_users(self):
+        self.assertBudget(1, 0.2, lambda size: self.client.get('/user'))
+
+    def test_users_delete(self):
+        def setup(size):
+            # A new owner for every seeded tag, so the tags soft-deleted with
+            # the user grow with the data
+            self.owner = UserProfile.objects.create(user_name='owner-{0}'.format(size))
+            TagsModel.all_objects.filter(key='budget-tag').update(user_id=self.owner, deleted_at=None)
+
+        self.assertBudget(9, 0.5, lambda size: self.client.delete('/user/{0}'.format(self.owner.user_id)), setup)
+
+    def test_job_status(self):
+        job = Job.objects.create(action='assign', total=1)
+        self.assertBudget(1, 0.2, lambda size: self.client.get('/jobs/{0}'.format(job.job_id)))
+
+    # Batch and metrics
+
+    def test_batch(self):
+        self.assertBudget(12, 0.5, lambda size: self.client.post('/batch', json.dumps({'atomic': True, 'operations': [
+            {'id': 'tag', 'method': 'POST', 'path': '/tags', 'body': {'tag_name': 'batch-{0}'.format(size), 'scope': 'perf', 'user_id': self.user.user_id}},
+            {'method': 'POST', 'path': '/Assign_Unassign_vm', 'body': {'action': 'assign', 'tag_name': 'batch-{0}'.format(size), 'vm_ids': self.seeded_vm_ids[:200]}},
+            {'method': 'GET', 'path': '/vms', 'query': {'tags_all': '${tag.data.tag_id}', 'fields': 'vm_id'}},
+        ]}), content_type='application/json'))
+
+    def test_metrics(self):
+        self.assertBudget(0, 0.2, lambda size: self.client.get('/metrics'))
@@ -0,0 +1,211 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+
+DEFAULT_RATE_LIMITS = {
+    # Off unless configured: clients used to getting no 429s keep getting none
+    'ENABLED': False,
+    # 'local' keeps buckets in this process, 'cache' shares them through CACHE
+    'STORE': 'local',
+    'CACHE': 'default',
+    # name -> (tokens per second, burst size)
+    'BUCKETS': {
+        'global': (500, 1000),
+        'ip': (50, 100),
+        'user': (50, 100),
+        'endpoint': (20, 40),
+    },
+    # Token cost of expensive calls (see the views' throttle_cost())
+    'COSTS': {
+        'UNFILTERED_LIST': 10,
+        'VMS_PER_TOKEN': 100,
+    },
+}
+
+
+def rate_limit_setting(name):
+    return getattr(settings, 'TAG_RATE_LIMITS', {}).get(name, DEFAULT_RATE_LIMITS[name])
+
+
+def cost_setting(name):
+    return rate_limit_setting('COSTS').get(name, DEFAULT_RATE_LIMITS['COSTS'][name])
+
+
+class LocalBucketStore:
+    """
+    Token buckets kept in a dict in this process.
+
+    Each bucket is stored as a single float (the GCRA "theoretical arrival
+    time"), so an update is one dict assignment and needs no lock. Two
+    threads racing on the same key can at worst both be admitted for the
+    same token, which is fine for rate limiting.
+    """
+
+    max_keys = 100000
+
+    def __init__(self):
+        self.buckets = {}
+
+    def get(self, key):
+        return self.buckets.get(key)
+
+    def set(self, key, tat, ttl):
+        self.buckets[key] = tat
+        if len(self.buckets) > self.max_keys:
+            self.prune()
+
+    def take(self, limits, cost, now):
+        """
+        Take `cost` tokens from every (key, rate, burst) bucket, or from none.
+        Returns 0, or the seconds to wait when a bucket is short.
+        """
+        # Check every bucket before taking tokens from any of them
+        updates = []
+        for key, rate, burst in limits:
+            new_tat, wait = check_bucket(self, key, cost, rate, burst, now)
+            if new_tat is None:
+                return wait
+            updates.append((key, new_tat, new_tat - now))
+
+        for key, new_tat, ttl in updates:
+            self.set(key, new_tat, ttl)
+        return 0
+
+    def prune(self):
+        # A bucket whose arrival time has passed is full again, same as absent
+        now = time.time()
+        for key, tat in list(self.buckets.items()):
+            if tat < now:
+                self.buckets.pop(key, None)
+
+
+class CacheBucketStore:
+    """
+    Buckets shared by every worker through the Django cache.
+
+    The cache has no compare-and-set, so buckets are kept as counters that
+    only change through cache.incr() (atomic on Redis and memcached): a
+    sliding window of burst / rate seconds that admits `burst` tokens,
+    counting the previous window in proportion to its overlap. Every
+    concurrent call sees its own count, so the limit holds across workers
+    without locks, at one or two cache round trips per bucket.
+    """
+
+    prefix = 'tag_api:bucket:'
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def _incr(self, key, tokens, ttl):
+        try:
+            return self.cache.incr(key, tokens)
+        except ValueError:
+            # First call in this window; add() loses to a concurrent first call
+            if self.cache.add(key, tokens, ttl):
+                return tokens
+            return self.cache.incr(key, tokens)
+
+    def take(self, limits, cost, now):
+        """
+        LocalBucketStore.take() on shared counters. Tokens taken from the
+        buckets that had room are given back when another one is short.
+        """
+        windows = []
+        for key, rate, burst in limits:
+            length = burst / rate
+            index = int(now // length)
+            counter = '{0}{1}:{2}'.format(self.prefix, key, index)
+            before = '{0}{1}:{2}'.format(self.prefix, key, index - 1)
+            windows.append((counter, before, int(min(cost, burst)), burst, length, now / length - index))
+
+        previous = self.cache.get_many([before for counter, before, *rest in windows])
+
+        taken = []
+        for counter, before, tokens, burst, length, elapsed in windows:
+            count = self._incr(counter, tokens, int(2 * length) + 1)
+            taken.append((counter, tokens))
+            if previous.get(before, 0) * (1 - elapsed) + count > burst:
+                for counter, tokens in taken:
+                    self.cache.decr(counter, tokens)
+                # Until this window ends and its count starts to fade
+                return max((1 - elapsed) * length, 0.001)
+        return 0
+
+
+def check_bucket(store, key, cost, rate, burst, now):
+    """
+    GCRA form of a token bucket refilling `rate` tokens per second up to `burst`.
+
+    Returns (new_tat, 0) when `cost` tokens are available, else (None, wait).
+    """
+    interval = 1.0 / rate
+    # A call bigger than the whole bucket would otherwise never get through
+    cost = min(cost, burst)
+    tat = max(store.get(key) or now, now)
+    new_tat = tat + cost * interval
+
+    if new_tat - now > burst * interval:
+        return None, new_tat - now - burst * interval
+    return new_tat, 0
+
+
+_local_store = LocalBucketStore()
+
+
+def reset():
+    # Forget this process's buckets, as after a restart
+    _local_store.buckets.clear()
+
+
+def on_setting_changed(setting, **kwargs):
+    # override_settings(TAG_RATE_LIMITS=...) starts from full buckets
+    if setting == 'TAG_RATE_LIMITS':
+        reset()
+
+
+def get_store():
+    if rate_limit_setting('STORE') == 'cache':
+        return CacheBucketStore(rate_limit_setting('CACHE'))
+    return _local_store
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle every API view with global, per IP, per user_id and per
+    client-and-endpoint token buckets.
+
+    Views can make expensive calls cost more than one token by defining
+    throttle_cost(request).
+    """
+
+    def keys(self, request, view):
+        ip = self.get_ident(request)
+        keys = [('global', 'global'), ('ip', 'ip:' + ip)]
+
+        # A JSON body need not be an object; the view rejects it later
+        data = request.data if isinstance(request.data, dict) else {}
+        user_id = request.query_params.get('user_id') or data.get('user_id')
+        if user_id:
+            keys.append(('user', 'user:{0}'.format(user_id)))
+
+        keys.append(('endpoint', 'endpoint:{0}:{1}'.format(view.__class__.__name__, ip)))
+        return keys
+
+    def allow_request(self, request, view):
+        self.wait_time = 0
+        if not rate_limit_setting('ENABLED'):
+            return True
+
+        cost = view.throttle_cost(request) if hasattr(view, 'throttle_cost') else 1
+        buckets = rate_limit_setting('BUCKETS')
+        store = get_store()
+        keys = [(name, key) for name, key in self.keys(request, view) if name in buckets]
+
+        self.wait_time = store.take([(key, *buckets[name]) for name, key in keys], cost, time.time())
+        return not self.wait_time
+
+    def wait(self):
+        return self.wait_time
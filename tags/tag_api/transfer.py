@@ -0,0 +1,157 @@
+import csv
+import datetime
+import json
+import time
+from contextlib import contextmanager
+
+from django.db import models
+
+from .models import Scope, TagsModel, UserProfile, VM, VMTag, split_tag_name
+
+
+# Exported tables in dependency order: (file name, model, columns).
+# Soft-deleted rows go too, with their deleted_at: vms_tags rows still point
+# at them until the purger runs, and it finishes the job after an import.
+TABLES = [
+    ('users', UserProfile, ['user_id', 'user_name', 'deleted_at']),
+    ('scopes', Scope, ['scope_id', 'name']),
+    ('tags', TagsModel, ['tag_id', 'tag_name', 'scope', 'scope_ref_id', 'user_id_id', 'deleted_at']),
+    ('vms', VM, ['vm_id', 'vm_name', 'creation_date', 'version', 'tag_list', 'deleted_at']),
+    ('vm_tags', VMTag, ['vm_id', 'tag_id', 'assigned_at', 'assigned_by_id']),
+]
+
+FORMATS = ('csv', 'ndjson')
+
+
+def iter_rows(model, columns, chunk_size):
+    """
+    Yield value tuples for every row, ordered by primary key.
+
+    Pages with "pk > last seen pk" instead of OFFSET or a client-side
+    cursor, so memory stays flat and each page is an index range scan.
+    """
+    pk = model._meta.pk.attname
+    # Every row, soft-deleted or not
+    queryset = model._base_manager.order_by(pk)
+    last = None
+
+    while True:
+        page = queryset if last is None else queryset.filter(**{pk + '__gt': last})
+        rows = list(page.values_list(pk, *columns)[:chunk_size])
+        if not rows:
+            return
+        for row in rows:
+            yield row[1:]
+        last = rows[-1][0]
+
+
+def _json_default(value):
+    # Full precision, unlike DjangoJSONEncoder which trims to milliseconds
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _to_text(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        # JSON columns (VM.tag_list)
+        return json.dumps(value)
+    return value
+
+
+class CsvWriter:
+    def __init__(self, stream, columns):
+        self.writer = csv.writer(stream)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow([_to_text(value) for value in row])
+
+
+class NdjsonWriter:
+    def __init__(self, stream, columns):
+        self.stream = stream
+        self.columns = columns
+
+    def write(self, row):
+        self.stream.write(json.dumps(dict(zip(self.columns, row)), default=_json_default))
+        self.stream.write('\n')
+
+
+WRITERS = {'csv': CsvWriter, 'ndjson': NdjsonWriter}
+
+
+def _from_text(field):
+    # CSV cell -> value: an empty cell is NULL only in a nullable column,
+    # so empty strings survive; JSON columns are decoded
+    def convert(text):
+        if text == '' and field.null:
+            return None
+        if isinstance(field, models.JSONField):
+            return json.loads(text)
+        return text
+    return convert
+
+
+def read_rows(stream, fmt, model, columns):
+    # Yield dicts keyed by column
+    if fmt == 'csv':
+        converters = [(column, _from_text(model._meta.get_field(column))) for column in columns]
+        for row in csv.DictReader(stream):
+            yield {column: convert(row[column]) for column, convert in converters}
+    else:
+        for line in stream:
+            if line.strip():
+                row = json.loads(line)
+                yield {column: row.get(column) for column in columns}
+
+
+def instance_builder(model, columns):
+    # Returns row dict -> unsaved model instance, converting text back to field types
+    fields = [(column, model._meta.get_field(column).to_python) for column in columns]
+
+    def build(row):
+        instance = model(**{column: to_python(row[column]) for column, to_python in fields})
+        if model is TagsModel:
+            # bulk_create() skips save(), which derives these from tag_name
+            instance.key, instance.value = split_tag_name(instance.tag_name)
+        return instance
+
+    return build
+
+
+@contextmanager
+def keep_auto_now(model):
+    # bulk_create() would overwrite imported auto_now_add timestamps
+    fields = [field for field in model._meta.concrete_fields if getattr(field, 'auto_now_add', False)]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+class Progress:
+    def __init__(self, write, name, every):
+        self.write = write
+        self.name = name
+        self.every = every
+        self.count = 0
+        self.start = time.perf_counter()
+
+    def add(self, count):
+        before = self.count
+        self.count += count
+        if self.count // self.every != before // self.every:
+            self.report()
+
+    def report(self, done=False):
+        elapsed = time.perf_counter() - self.start
+        rate = self.count / elapsed if elapsed else 0
+        self.write("{0}: {1} rows{2} ({3:.0f} rows/s)".format(self.name, self.count, ' done' if done else '', rate))
@@ -1,17 +1,31 @@
 from django.urls import path, include
-from .views import Tags, VMs, AssignUnassignTags, Users
+from .views import Tags, TagSearch, TagLookup, VMs, VMLookup, VMHistogram, AssignUnassignTags, Users, Jobs, Batch, Metrics
 
 urlpatterns = [
    
     # Tags URL
     path('tags', Tags.as_view()),
+    path('tags/search', TagSearch.as_view()),
+    path('tags/lookup', TagLookup.as_view()),
     path('tags/<str:id>', Tags.as_view()),
     path('Assign_Unassign_vm', AssignUnassignTags.as_view()),
 
+    # Background jobs URL
+    path('jobs/<str:job_id>', Jobs.as_view()),
+
     # VMs URL
     path('vms', VMs.as_view(), name='vms'),
-    path('vms/<int:id>', VMs.as_view()),
+    path('vms/lookup', VMLookup.as_view()),
+    path('vms/histogram', VMHistogram.as_view()),
+    path('vms/<str:vm_id>', VMs.as_view()),
 
     # User Profile URL
     path('user', Users.as_view()),
+    path('user/<int:user_id>', Users.as_view()),
+
+    # Per-process counters
+    path('metrics', Metrics.as_view()),
+
+    # Many API calls in one round trip
+    path('batch', Batch.as_view()),
 ]
\ No newline at end of file
@@ -1,6 +1,5 @@
 from django.shortcuts import get_object_or_404, render
 from django.http import HttpResponse, HttpResponseRedirect
-from django.http import JsonResponse
 from django import forms
 from django.core.exceptions import ValidationError
 from django.views.decorators.csrf import csrf_exempt
@@ -8,48 +7,101 @@ from django.db import IntegrityError, transaction
 # from cloud_service_app.models.tags_model import TagsModel
 # from cloud_service_app.forms.forms import tags_form 
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 import datetime
 from rest_framework.views import APIView
 # import requests
-from django.db.models import Q
+from django.db.models import F, Q
 # from cloud_service_app.helpers import *
 import json
 from django.utils.translation import gettext as _
 
-from .models import TagsModel, VM, UserProfile
+from .models import TagsModel, VM, VMTag, UserProfile, Job
 from .forms import tags_form, VMForm
+from . import assignments, batch, bitmaps, counts, group_commit, histograms, jobs, lookups, metrics, purge, search, tag_lists
+from .throttling import cost_setting
+from . import renderers
+from .serializers import JsonResponse, public_names, requested_columns, requested_includes, serialize_rows
+
+
+def tag_name_for(key, value):
+    # The tag_name of a structured tag; None without a key
+    if not key:
+        return None
+    return key if value in (None, '') else '{0}={1}'.format(key, value)
 
 
 class Tags(APIView):
+    # Fields a client may select with ?fields=, mapped to their columns
+    allowed_fields = {'tag_id': 'tag_id', 'tag_name': 'tag_name', 'scope': 'scope', 'user_id': 'user_id_id', 'key': 'key', 'value': 'value'}
+    filter_params = ('tag_id', 'tag_name', 'scope', 'user_id', 'key', 'value')
+
+    def throttle_cost(self, request):
+        # Full listings cost more than filtered lookups
+        if request.method == 'GET' and not any(request.GET.get(param) for param in self.filter_params):
+            return cost_setting('UNFILTERED_LIST')
+        return 1
+
     def get(self,request):
         try:
+            requested = requested_columns(request, self.allowed_fields)
+            columns = requested or list(self.allowed_fields.values())
+            # ?fields= rows are keyed by the public names; the default listing
+            # keeps its column keys (user_id_id) for existing clients
+            keys = public_names(columns, self.allowed_fields) if requested else None
+
+            tag_ids = lookups.param_values(request, 'tag_id', TagsModel._meta.pk.to_python)
+            tag_names = lookups.param_values(request, 'tag_name', split=False)
+            scopes = lookups.param_values(request, 'scope', split=False)
+            user_ids = lookups.param_values(request, 'user_id', int)
+            tag_keys = lookups.param_values(request, 'key', split=False)
+            tag_values = lookups.param_values(request, 'value', split=False)
+            count_mode = counts.count_mode(request)
+            page = page_params(request)
+
+            # Lists of ids or names are looked up in chunks and answered in
+            # request order, with the values that matched nothing listed
+            key, values = ('tag_id', tag_ids) if tag_ids else ('tag_name', tag_names) if tag_names else (None, None)
+
             filters = Q()
-            if request.method == 'GET' and 'tag_id' in request.GET:
-                tag_id = request.GET['tag_id']
-                filters &= Q(tag_id=tag_id)
+            if tag_names and key != 'tag_name':
+                filters &= Q(tag_name__in=tag_names)
 
-            if request.method == 'GET' and 'tag_name' in request.GET:
-                tag_name = request.GET['tag_name']
-                filters &= Q(tag_name=tag_name)
+            if scopes:
+                filters &= Q(scope_ref__name__in=scopes)
 
-            if request.method == 'GET' and 'scope' in request.GET:
-                scope = request.GET['scope']
-                filters &= Q(scope=scope)
+            if user_ids:
+                filters &= Q(user_id__in=user_ids)
 
-            if request.method == 'GET' and 'user_id' in request.GET:
-                user_id = request.GET['user_id']
-                filters &= Q(user_id=user_id)
+            # Structured lookups on the (key, value) index
+            if tag_keys:
+                filters &= Q(key__in=tag_keys)
 
-            if not filters:
-                tags_data = TagsModel.objects.all().values()
-            
+            if tag_values:
+                filters &= Q(value__in=tag_values)
+
+            tags_data = TagsModel.objects.filter(filters)
+
+            missing = None
+            if key is None:
+                total = counts.count(tags_data, count_mode)
+                list_result = serialize_rows(paginate(tags_data.order_by('pk'), page) if page else tags_data, columns, keys)
             else:
-                tags_data = TagsModel.objects.filter(filters).values()
+                key_columns = columns if key in columns else columns + [key]
+                key_names = public_names(key_columns, self.allowed_fields) if requested else None
+                rows = lookups.fetch(tags_data, key, values, lambda queryset: serialize_rows(queryset, key_columns, key_names))
+                list_result, missing = lookups.in_request_order(rows, key, values)
+                if key not in columns:
+                    for row in list_result:
+                        del row[key]
+                total = {'count': len(list_result), 'count_type': 'exact'} if count_mode != 'none' else {}
+                list_result = paginate(list_result, page)
 
-            list_result = [entry for entry in tags_data]
-            
             data = {'status':'success','error_code': 0, 'message': _("Tags get successfully"), 'data':list_result}
-            return JsonResponse(data)
+            data.update(total)
+            if missing is not None:
+                data['missing'] = missing
+            return renderers.render(request, data)
 
 
         except ValidationError as e:
@@ -63,12 +115,13 @@ class Tags(APIView):
 
     def post(self,request):
         try:
-            form = tags_form(request.POST)
+            # request.data takes form posts as well as JSON bodies (e.g. from /batch)
+            form = tags_form(request.data)
 
             if form.is_valid():
-                tag_name = request.POST.get('tag_name', default=None)
-                scope = request.POST.get('scope', default=None)
-                user_id = request.POST.get('user_id')
+                tag_name = request.data.get('tag_name') or tag_name_for(request.data.get('key'), request.data.get('value'))
+                scope = request.data.get('scope')
+                user_id = request.data.get('user_id')
                 user_profile = get_object_or_404(UserProfile, user_id=user_id)
                     
                 tag = TagsModel()
@@ -76,8 +129,8 @@ class Tags(APIView):
                 tag.scope = scope
                 tag.user_id = user_profile
 
-                tag_data = tag.save()
-                data = {'status': 'success', 'error_code': 0, 'message': _("Tag Added successfully"), 'data': ''}
+                tag.save()
+                data = {'status': 'success', 'error_code': 0, 'message': _("Tag Added successfully"), 'data': {'tag_id': tag.tag_id}}
 
             return JsonResponse(data)
     
@@ -139,21 +192,101 @@ class Tags(APIView):
             return JsonResponse(data)
         
 
+class TagSearch(APIView):
+    def get(self, request):
+        try:
+            limit = int_param(request, 'limit', 20)
+            offset = int_param(request, 'offset', 0)
+            max_limit = search.search_setting('MAX_PAGE_SIZE', 100)
+            if limit < 1 or limit > max_limit or offset < 0:
+                raise ValidationError("limit must be between 1 and {0} and offset at least 0".format(max_limit))
+
+            matches = search.search(request.GET.get('q'), request.GET.get('scope') or None)
+
+            results = [
+                {'tag_id': str(tag_id), 'tag_name': tag_name, 'scope': scope, 'user_id': user_id}
+                for tag_id, tag_name, scope, user_id in matches[offset:offset + limit]
+            ]
+
+            data = {'status': 'success', 'error_code': 0, 'message': _("Tags found successfully"),
+                    'data': {'count': len(matches), 'limit': limit, 'offset': offset, 'results': results}}
+            return renderers.render(request, data)
+
+        except ValidationError as e:
+            data = {'status': 'error', 'error_code': 103, 'message': "error: {0} ".format(e)}
+            return JsonResponse(data)
+
+
+def int_param(request, name, default):
+    try:
+        return int(request.GET.get(name, default))
+    except ValueError:
+        raise ValidationError("{0} must be an integer".format(name))
+
+
+def datetime_param(request, name):
+    # ISO 8601 datetime, or a date meaning its midnight; naive values are in TIME_ZONE
+    value = request.GET.get(name)
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None and parse_date(value) is not None:
+            parsed = datetime.datetime.combine(parse_date(value), datetime.time())
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise ValidationError("{0} must be an ISO 8601 date or datetime".format(name))
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+def page_params(request):
+    # (limit, offset) from ?limit=&offset=, or None to list everything
+    if 'limit' not in request.GET:
+        return None
+    limit = int_param(request, 'limit', None)
+    offset = int_param(request, 'offset', 0)
+    if limit < 1 or offset < 0:
+        raise ValidationError("limit must be at least 1 and offset at least 0")
+    return limit, offset
+
+
+def paginate(items, page):
+    # Slice of a queryset or list for page_params()
+    if page is None:
+        return items
+    limit, offset = page
+    return items[offset:offset + limit]
+
+
 class AssignUnassignTags(APIView):
 
+    def throttle_cost(self, request):
+        try:
+            vm_ids = vm_id_list(request)
+        except ValidationError:
+            # Rejected by post()
+            return 1
+        return 1 + len(vm_ids) // cost_setting('VMS_PER_TOKEN')
+
     def post(self, request):
 
         try:
+            vm_ids = vm_id_list(request)
             action = request.data.get("action")
 
             if action == 'assign':
                 # tag_id = request.data.get('tag_id')
                 tag_name = request.data.get('tag_name')
-                vm_ids = request.data.get('vm_ids', [])
 
                 tag = get_object_or_404(TagsModel, tag_name=tag_name)
+                assigned_by = assigning_user(request)
 
-                tag.vms.add(*vm_ids)
+                if run_as_job(request, vm_ids):
+                    return submit_job(action, tag, vm_ids, assigned_by)
+
+                # Shares a commit with concurrent small calls when TAG_GROUP_COMMIT is enabled
+                group_commit.assign(tag, vm_ids, assigned_by)
 
                 data = {'status': 'success', 'error_code': 0, 'message': _("Tag Assigned to Objects successfully"), 'data': ''}
                 return JsonResponse(data)
@@ -161,11 +294,13 @@ class AssignUnassignTags(APIView):
             elif action == 'unassign':
                 # tag_id = request.POST.get('tag_id')
                 tag_name = request.data.get('tag_name')
-                vm_ids = request.data.get('vm_ids', [])
 
                 tag = get_object_or_404(TagsModel, tag_name=tag_name)
 
-                tag.vms.remove(*vm_ids)
+                if run_as_job(request, vm_ids):
+                    return submit_job(action, tag, vm_ids)
+
+                group_commit.unassign(tag, vm_ids)
 
                 data = {'status':'success', 'error_code': 0, 'message': _("Tag Unassigned from Objects successfully"), 'data': ''}
                 return JsonResponse(data)
@@ -178,68 +313,309 @@ class AssignUnassignTags(APIView):
             data = {'status':'error', 'error_code': 103, 'message': "error: {0} ".format(e)}
             return JsonResponse(data)
 
+        except group_commit.GroupCommitTimeout as e:
+            data = {'status': 'error', 'error_code': 109, 'message': "error: {0}".format(e)}
+            return JsonResponse(data, status=503)
+
         except Exception as e:
             data = {'status':'error', 'error_code': 101, 'message': "error: {0}".format(e)}        
             return JsonResponse(data)
 
+def vm_id_list(request):
+    # vm_ids of an assign/unassign body: a JSON list or repeated form fields
+    if not isinstance(request.data, dict):
+        raise ValidationError("Request body must be a JSON object")
+    if hasattr(request.data, 'getlist'):
+        return request.data.getlist('vm_ids')
+
+    vm_ids = request.data.get('vm_ids', [])
+    if not isinstance(vm_ids, list):
+        raise ValidationError("vm_ids must be a list")
+    return vm_ids
+
+
+def run_as_job(request, vm_ids):
+    # Large lists always go to the job queue, smaller ones only when asked to
+    if str(request.data.get('async', '')).lower() in ('1', 'true', 'yes'):
+        return True
+    return len(vm_ids) >= jobs.job_setting('ASYNC_THRESHOLD', 5000)
+
+
+def assigning_user(request):
+    user_id = request.data.get('user_id')
+    if user_id in (None, '', 'None'):
+        return None
+    return get_object_or_404(UserProfile, user_id=user_id)
+
+
+def submit_job(action, tag, vm_ids, assigned_by=None):
+    payload = {'tag_id': str(tag.tag_id), 'vm_ids': [str(vm_id) for vm_id in vm_ids]}
+    if assigned_by is not None:
+        payload['assigned_by'] = assigned_by.user_id
+
+    try:
+        job = jobs.submit(action, payload, total=len(vm_ids))
+    except jobs.JobQueueFull as e:
+        data = {'status': 'error', 'error_code': 109, 'message': "error: {0}".format(e)}
+        return JsonResponse(data, status=503)
+
+    data = {'status': 'success', 'error_code': 0, 'message': _("Job submitted successfully"), 'data': {'job_id': job.job_id}}
+    return JsonResponse(data, status=202)
+
+
+def create_vm(vm_name, tag_name, scope, user_id):
+    # Check if VM instance with the same name already exists (a deleted one
+    # keeps its name until it is purged)
+    if VM.all_objects.filter(vm_name=vm_name).exists():
+        return None
+
+    user_profile = get_object_or_404(UserProfile, user_id=user_id) if tag_name else None
+    vm_instance = VM.objects.create(vm_name=vm_name)
+
+    if tag_name:
+        # Concurrent requests naming the same new tag end up sharing one
+        tag_instance = TagsModel.for_name(tag_name, scope, user_profile)
+
+        # Assign the tag to the VM instance
+        vm_instance.tags.add(tag_instance, through_defaults={'assigned_by': user_profile})
+
+    return vm_instance
+
+
+class VersionConflict(Exception):
+    def __init__(self, current):
+        super().__init__(current)
+        self.current = current
+
+
+def tag_id_list(request, name):
+    # Repeated parameters, a JSON list or a comma separated string of tag ids
+    if hasattr(request.data, 'getlist'):
+        values = request.data.getlist(name)
+    else:
+        values = request.data.get(name) or []
+        values = [values] if isinstance(values, str) else values
+
+    to_python = TagsModel._meta.pk.to_python
+    return [to_python(tag_id.strip()) for value in values for tag_id in str(value).split(',') if tag_id.strip()]
+
+
+def update_vm(vm_id, vm_name, add, remove, replace, version, assigned_by):
+    """
+    Apply the smallest set of writes that brings the VM to the requested state.
+
+    Only the tags named in the request are read (all of them for a full
+    replacement), and a request that changes nothing writes nothing. The
+    version check is part of the UPDATE, so no row is locked up front.
+    """
+    vm = VM.objects.only('vm_id', 'vm_name', 'version').get(vm_id=vm_id)
+    if version is not None and version != vm.version:
+        raise VersionConflict(vm.version)
+
+    if replace is not None:
+        current = set(VMTag.objects.filter(vm=vm).values_list('tag_id', flat=True))
+        to_add, to_remove = set(replace) - current, current - set(replace)
+    else:
+        named = set(add) | set(remove)
+        current = set(VMTag.objects.filter(vm=vm, tag_id__in=named).values_list('tag_id', flat=True)) if named else set()
+        to_add, to_remove = set(add) - current, set(remove) & current
+
+    rename = vm_name is not None and vm_name != vm.vm_name
+    if not (rename or to_add or to_remove):
+        return vm
+
+    if to_add and TagsModel.objects.filter(tag_id__in=to_add).count() != len(to_add):
+        raise TagsModel.DoesNotExist
+
+    fields = {'version': F('version') + 1}
+    if rename:
+        fields['vm_name'] = vm_name
+    if not VM.objects.filter(vm_id=vm.vm_id, version=vm.version).update(**fields):
+        # A locking read, since our snapshot may predate the winning update
+        raise VersionConflict(VM.objects.select_for_update().values_list('version', flat=True).get(vm_id=vm.vm_id))
+
+    VMTag.change_vm_tags(vm, to_add, to_remove, assigned_by)
+
+    vm.version += 1
+    if rename:
+        vm.vm_name = vm_name
+    return vm
+
+
+class Jobs(APIView):
+    def get(self, request, job_id):
+        try:
+            job = Job.objects.get(job_id=job_id)
+
+            job_data = {
+                'job_id': job.job_id,
+                'action': job.action,
+                'status': job.status,
+                'total': job.total,
+                'processed': job.processed,
+                'error': job.error,
+                'created_at': job.created_at,
+                'updated_at': job.updated_at,
+            }
+
+            data = {'status': 'success', 'error_code': 0, 'message': _("Job retrieved successfully"), 'data': job_data}
+            return JsonResponse(data)
+
+        except (Job.DoesNotExist, ValidationError):
+            data = {'status': 'error', 'error_code': 100, 'message': _("Job not found")}
+            return JsonResponse(data)
+
 # =====================================================================================================        
 
 class VMs(APIView):
-    def get(self, request):
+    allowed_fields = {'vm_id': 'vm_id', 'vm_name': 'vm_name', 'creation_date': 'creation_date', 'version': 'version'}
+    filter_params = ('vm_id', 'vm_name', 'tag_name', 'scope', 'tag_key', 'created_after', 'created_before', 'tags_all', 'tags_any', 'tags_none', 'count_only')
+    # Related data a client may add with ?include=
+    allowed_includes = ('tags',)
+
+    def throttle_cost(self, request):
+        if request.method == 'GET' and not any(request.GET.get(param) for param in self.filter_params):
+            return cost_setting('UNFILTERED_LIST')
+        return 1
+
+    def get(self, request, vm_id=None):
         try:
+            columns = requested_columns(request, self.allowed_fields) or list(self.allowed_fields.values())
+            includes = requested_includes(request, self.allowed_includes)
+
+            vm_ids = lookups.param_values(request, 'vm_id', VM._meta.pk.to_python)
+            vm_names = lookups.param_values(request, 'vm_name', split=False)
             tag_name = request.GET.get('tag_name')
             scope = request.GET.get('scope')
+            tag_key = request.GET.get('tag_key')
+            tag_values = lookups.param_values(request, 'tag_value', split=False)
+            created_after = datetime_param(request, 'created_after')
+            created_before = datetime_param(request, 'created_before')
+            count_only = request.GET.get('count_only') in ('1', 'true')
+            count_mode = counts.count_mode(request)
+            page = page_params(request)
+            tag_sets = bitmaps.tag_set_params(request)
 
             queryset = VM.objects.all()
 
+            if vm_id is not None:
+                queryset = queryset.filter(vm_id=vm_id)
+
+            # Range scans on the creation_date index
+            if created_after is not None:
+                queryset = queryset.filter(creation_date__gte=created_after)
+
+            if created_before is not None:
+                queryset = queryset.filter(creation_date__lt=created_before)
+
+            key, values = ('vm_id', vm_ids) if vm_ids else ('vm_name', vm_names) if vm_names else (None, None)
+            if vm_names and key != 'vm_name':
+                queryset = queryset.filter(vm_name__in=vm_names)
+
+            # Tags of a deleted user stay in vms_tags until they are purged
             if tag_name:
-                queryset = queryset.filter(tags__tag_name=tag_name)
+                queryset = queryset.filter(tags__tag_name=tag_name, tags__deleted_at=None)
 
             if scope:
-                queryset = queryset.filter(tags__scope=scope)
+                queryset = queryset.filter(tags__scope_ref__name=scope, tags__deleted_at=None)
+
+            # tag_key alone: any value; with tag_value (repeatable): key=value
+            # or key IN (values). A subquery, so a VM matching twice is listed once
+            if tag_key:
+                matching = VMTag.objects.filter(tag__key=tag_key, tag__deleted_at=None)
+                if tag_values:
+                    matching = matching.filter(tag__value__in=tag_values)
+                queryset = queryset.filter(vm_id__in=matching.values('vm_id'))
+            elif tag_values:
+                raise ValidationError("tag_value needs a tag_key")
+
+            # tags_all / tags_any / tags_none: AND, OR and NOT over tag ids.
+            # The index's matches are read in chunks below, never as one IN
+            # list; a vm_id/vm_name lookup is short, so it takes the subqueries
+            matched_ids = None
+            if any(tag_sets):
+                if bitmaps.index_enabled() and key is None:
+                    index = bitmaps.get_index()
+                    matched_ids = sorted(index.vm_ids_for(index.match(*tag_sets)))
+                    # Nothing else filters the VMs: the matches are the answer
+                    whole = counts.unfiltered(queryset)
+                else:
+                    queryset = bitmaps.filter_queryset(queryset, *tag_sets)
+
+            if count_only:
+                if matched_ids is not None:
+                    count = len(matched_ids) if whole else lookups.count(queryset, 'vm_id', matched_ids)
+                else:
+                    count = lookups.count(queryset, key, values) if key else queryset.distinct().count()
+                data = {'status': 'success', 'error_code': 0, 'message': _("VMs counted successfully"), 'data': {'count': count}}
+                return JsonResponse(data)
 
-            vm_data = queryset.values()
-            vm_list_result = [entry for entry in vm_data]
+            if matched_ids is not None:
+                # Matches sorted by key and fetched chunk by chunk in key order
+                queryset = queryset.order_by('pk')
+                if whole:
+                    total = {'count': len(matched_ids), 'count_type': 'exact'} if count_mode != 'none' else {}
+                    # Every match is a row, so the page is cut before any SQL
+                    vm_list_result = lookups.fetch(queryset, 'vm_id', paginate(matched_ids, page), lambda chunk: self.serialize(chunk, columns, includes))
+                else:
+                    total = {'count': lookups.count(queryset, 'vm_id', matched_ids), 'count_type': 'exact'} if count_mode != 'none' else {}
+                    # Chunks stop once the page is full
+                    rows = lookups.fetch(queryset, 'vm_id', matched_ids, lambda chunk: self.serialize(chunk, columns, includes),
+                                         page[0] + page[1] if page else None)
+                    vm_list_result = paginate(rows, page)
+                missing = None
+            elif key is None:
+                total = counts.count(queryset, count_mode)
+                vm_list_result = self.serialize(paginate(queryset.order_by('pk'), page) if page else queryset, columns, includes)
+                missing = None
+            else:
+                # Chunked IN (...) lookups, answered in request order
+                key_columns = columns if key in columns else columns + [key]
+                rows = lookups.fetch(queryset, key, values, lambda chunk: self.serialize(chunk, key_columns, includes))
+                vm_list_result, missing = lookups.in_request_order(rows, key, values)
+                if key not in columns:
+                    for row in vm_list_result:
+                        del row[key]
+                total = {'count': len(vm_list_result), 'count_type': 'exact'} if count_mode != 'none' else {}
+                vm_list_result = paginate(vm_list_result, page)
 
             data = {'status': 'success', 'error_code': 0, 'message': _("VMs retrieved successfully"), 'data': vm_list_result}
-            return JsonResponse(data)
+            data.update(total)
+            if missing is not None:
+                data['missing'] = missing
+            return renderers.render(request, data)
         
+        except ValidationError as e:
+            data = {'status': 'error', 'error_code': 103, 'message': f"Error: {e}"}
+            return JsonResponse(data)
+
         except Exception as e:
             data = {'status': 'error', 'error_code': 101, 'message': f"Error: {e}"}
             return JsonResponse(data)
 
+    @staticmethod
+    def serialize(queryset, columns, includes):
+        if 'tags' in includes:
+            return tag_lists.serialize_with_tags(queryset, columns)
+        return serialize_rows(queryset, columns)
+
     def post(self, request):
         try:
-            form = VMForm(request.POST)
+            form = VMForm(request.data)
 
-            vm_name = request.POST.get('vm_name')
-            tag_name = request.POST.get('tags')
-            scope = request.POST.get('scope')
-            user_id = request.POST.get('user_id')
+            vm_name = request.data.get('vm_name')
+            tag_name = request.data.get('tags')
+            scope = request.data.get('scope')
+            user_id = request.data.get('user_id')
 
-            # Check if VM instance with the same name already exists
-            existing_vm = VM.objects.filter(vm_name=vm_name).exists()
+            # The VM, its tag and the assignment commit together, retried on deadlock
+            vm_instance = assignments.atomic_with_retry(create_vm, vm_name, tag_name, scope, user_id)
 
-            if existing_vm:
+            if vm_instance is None:
                 data = {'status': 'error', 'error_code': 102, 'message': _("This VM Already exist.")}
                 return JsonResponse(data)
 
-            # Get or create the VM instance
-            vm_instance = VM.objects.create(vm_name=vm_name)
-
-            if tag_name:
-                user_profile = get_object_or_404(UserProfile, user_id=user_id)
-
-                # Try to get the existing tag
-                tag_instance = TagsModel.objects.filter(tag_name=tag_name, scope=scope).first()
-
-                if tag_instance is None:
-                    tag_instance = TagsModel.objects.create(tag_name=tag_name, scope=scope, user_id=user_profile)
-
-                # Assign the tag to the VM instance
-                vm_instance.tags.add(tag_instance)
-
-            data = {'status': 'success', 'error_code': 0, 'message': _("VM added successfully."), 'data': ''}
+            data = {'status': 'success', 'error_code': 0, 'message': _("VM added successfully."), 'data': {'vm_id': vm_instance.vm_id}}
             return JsonResponse(data)
         
         except Exception as e:
@@ -248,35 +624,48 @@ class VMs(APIView):
         
         
 
-    def put(self, request):
+    def put(self, request, vm_id):
+        # Full replacement: `tags` is the complete new tag list
+        return self.update(request, vm_id, replace=tag_id_list(request, 'tags'))
 
-        try:
-            vm_instance = VM.objects.get(id=id)
-            form = VMForm(request.POST, instance=vm_instance)
+    def patch(self, request, vm_id):
+        # Partial update: rename and/or add_tags / remove_tags
+        return self.update(request, vm_id, add=tag_id_list(request, 'add_tags'), remove=tag_id_list(request, 'remove_tags'))
 
-            if form.is_valid():
-                # Save VM without committing to the database
-                updated_vm_instance = form.save(commit=False)
+    def update(self, request, vm_id, add=(), remove=(), replace=None):
+        try:
+            version = request.data.get('version')
+            version = int(version) if version not in (None, '') else None
+            vm_name = request.data.get('vm_name') or None
+            assigned_by = assigning_user(request) if (add or replace) else None
+            if set(add) & set(remove):
+                raise ValidationError("A tag cannot be both added and removed")
 
-                # Get tag IDs from the request
-                tag_ids = request.POST.getlist('tags')
+            vm = assignments.atomic_with_retry(update_vm, vm_id, vm_name, add, remove, replace, version, assigned_by)
 
-                # Assign tags to the updated VM instance
-                updated_vm_instance.tags.set(tag_ids)
+            data = {'status': 'success', 'error_code': 0, 'message': _("VM updated successfully"), 'data': {'vm_id': vm.vm_id, 'version': vm.version}}
+            return JsonResponse(data)
 
-                # Save the updated VM instance to the database
-                updated_vm_instance.save()
-
-                data = {'status': 'success', 'error_code': 0, 'message': _("VM updated successfully"), 'data': ''}
-                return JsonResponse(data)
-            else:
-                data = {'status': 'error', 'error_code': 103, 'message': f"Validation Error: {form.errors}"}
-                return JsonResponse(data)
+        except VersionConflict as e:
+            data = {'status': 'error', 'error_code': 111, 'message': _("VM was changed by another request, reload it and retry"), 'data': {'version': e.current}}
+            return JsonResponse(data, status=409)
 
         except VM.DoesNotExist:
             data = {'status': 'error', 'error_code': 100, 'message': _("VM not found")}
             return JsonResponse(data)
 
+        except TagsModel.DoesNotExist:
+            data = {'status': 'error', 'error_code': 100, 'message': _("Tag not found")}
+            return JsonResponse(data)
+
+        except (ValidationError, ValueError) as e:
+            data = {'status': 'error', 'error_code': 103, 'message': "error: {0} ".format(e)}
+            return JsonResponse(data)
+
+        except IntegrityError:
+            data = {'status': 'error', 'error_code': 102, 'message': _("This VM Already exist.")}
+            return JsonResponse(data)
+
         except Exception as e:
             data = {'status': 'error', 'error_code': 101, 'message': f"Error: {e}"}
             return JsonResponse(data)
@@ -284,9 +673,13 @@ class VMs(APIView):
     def delete(self, request, vm_id):
         try:
             vm = VM.objects.get(vm_id=vm_id)
-            vm.delete()
 
-            data = {'status': 'success', 'error_code': 0, 'message': _("VM deleted successfully")}
+            # Hidden now; its vms_tags rows are deleted in batches in the background
+            with transaction.atomic():
+                vm.soft_delete()
+                job = purge.schedule('purge_vm', {'vm_id': str(vm.vm_id)})
+
+            data = {'status': 'success', 'error_code': 0, 'message': _("VM deleted successfully"), 'data': {'job_id': job.job_id if job else None}}
             return JsonResponse(data)
 
         except VM.DoesNotExist:
@@ -300,11 +693,119 @@ class VMs(APIView):
 # ==============================================================================
         
 
+class VMHistogram(APIView):
+    """
+    VM creation counts per hour, day or week.
+
+    GET vms/histogram?interval=day&created_after=...&created_before=...
+    &tag_id=a,b (VMs carrying any of these tags) &per_tag=1 (one series per tag)
+    """
+
+    def get(self, request):
+        try:
+            interval = request.GET.get('interval', 'day')
+            if interval not in histograms.INTERVALS:
+                raise ValidationError("interval must be one of: {0}".format(', '.join(histograms.INTERVALS)))
+
+            created_after = datetime_param(request, 'created_after')
+            created_before = datetime_param(request, 'created_before')
+            tag_ids = lookups.param_values(request, 'tag_id', TagsModel._meta.pk.to_python)
+            per_tag = request.GET.get('per_tag') in ('1', 'true')
+
+            buckets = histograms.histogram(interval, created_after, created_before, tag_ids, per_tag)
+
+            data = {'status': 'success', 'error_code': 0, 'message': _("Histogram retrieved successfully"), 'data': {'interval': interval, 'buckets': buckets}}
+            return renderers.render(request, data)
+
+        except ValidationError as e:
+            data = {'status': 'error', 'error_code': 103, 'message': "error: {0} ".format(e)}
+            return JsonResponse(data)
+
+
+def get_from_body(view, request):
+    # Answer a lookup POSTed as JSON, for id lists too long for a URL: the
+    # body stands in for the query string of view.get()
+    try:
+        request._request.GET = lookups.body_query(request.data)
+    except ValidationError as e:
+        data = {'status': 'error', 'error_code': 103, 'message': "error: {0} ".format(e)}
+        return JsonResponse(data)
+    return view.get(request)
+
+
+class TagLookup(Tags):
+    # POST tags/lookup {"tag_id": [...], "fields": "tag_name"}
+    http_method_names = ['post', 'options']
+
+    def post(self, request):
+        return get_from_body(self, request)
+
+
+class VMLookup(VMs):
+    # POST vms/lookup {"vm_name": [...], "include": "tags"}
+    http_method_names = ['post', 'options']
+
+    def post(self, request):
+        return get_from_body(self, request)
+
+
 class Users(APIView):
     def get(self, request):
         
-        user_data = UserProfile.objects.all()
+        users = serialize_rows(UserProfile.objects.all(), ['user_id', 'user_name'])
+
+        return renderers.render(request, {'users': users})
+
+    def delete(self, request, user_id):
+        try:
+            user = UserProfile.objects.get(user_id=user_id)
+
+            # The user and their tags are hidden now and purged in the background
+            with transaction.atomic():
+                user.soft_delete()
+                job = purge.schedule('purge_user', {'user_id': user.user_id})
+
+            data = {'status': 'success', 'error_code': 0, 'message': _("User deleted successfully"), 'data': {'job_id': job.job_id if job else None}}
+            return JsonResponse(data)
+
+        except UserProfile.DoesNotExist:
+            data = {'status': 'error', 'error_code': 100, 'message': _("User not found")}
+            return JsonResponse(data)
+
+
+class Metrics(APIView):
+    def get(self, request):
+        data = {'status': 'success', 'error_code': 0, 'message': _("Metrics retrieved successfully"), 'data': metrics.snapshot()}
+        return JsonResponse(data)
+
+
+class Batch(APIView):
+    """
+    Run an ordered list of API calls in one request.
+
+    Body: {"atomic": bool, "operations": [{"id", "method", "path", "query",
+    "body"}, ...]}. Strings like "${tag.data.tag_id}" refer to the response
+    of an earlier operation by its id.
+    """
 
-        users = [{'user_id': user.user_id, 'user_name': user.user_name} for user in user_data]
+    def throttle_cost(self, request):
+        # Each operation is throttled again when it runs
+        return 1
+
+    def post(self, request):
+        try:
+            atomic = str(request.data.get('atomic', '')).lower() in ('1', 'true', 'yes')
+            results, ok = batch.run(request, request.data.get('operations'), atomic=atomic)
+
+            if ok:
+                data = {'status': 'success', 'error_code': 0, 'message': _("Batch completed successfully"), 'data': {'results': results}}
+            elif atomic:
+                data = {'status': 'error', 'error_code': 110, 'message': _("Batch failed and was rolled back"), 'data': {'results': results}}
+            else:
+                data = {'status': 'error', 'error_code': 110, 'message': _("Some batch operations failed"), 'data': {'results': results}}
+            return JsonResponse(data)
+
+        except ValidationError as e:
+            data = {'status': 'error', 'error_code': 103, 'message': "error: {0} ".format(e)}
+            return JsonResponse(data)
 
-        return JsonResponse({'users': users})
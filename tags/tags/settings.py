@@ -43,6 +43,9 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'tag_api.middleware.CompressionMiddleware',
+    'tag_api.middleware.ReplicaRoutingMiddleware',
+    'tag_api.middleware.CoalescingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -89,6 +92,22 @@ DATABASES = {
     }
 }
 
+# Read replicas: add each replica to DATABASES and list its alias here.
+# GET requests read from a healthy replica; writes, and reads from a client
+# for STICKY_SECONDS after it wrote, go to 'default'. The client is
+# recognised by the STICKY_COOKIE set on its write's response. Replicas more
+# than MAX_LAG seconds behind are skipped.
+
+DATABASE_ROUTERS = ['tag_api.routers.PrimaryReplicaRouter']
+
+TAG_DB_REPLICAS = {
+    'ALIASES': [],
+    'STICKY_SECONDS': 5,
+    'STICKY_COOKIE': 'tag_api_primary',
+    'MAX_LAG': 10,
+    'LAG_CHECK_INTERVAL': 5,
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -130,3 +149,181 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Django REST framework
+# Response formats are negotiated in tag_api/renderers.py
+
+REST_FRAMEWORK = {
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'tag_api.renderers.AcceptNegotiation',
+    'DEFAULT_THROTTLE_CLASSES': ['tag_api.throttling.TokenBucketThrottle'],
+}
+
+
+# Rate limiting (see tag_api/throttling.py). Buckets are (tokens per second,
+# burst). Set STORE to 'cache' and point CACHE at a shared cache (Redis,
+# memcached) so the limits hold across worker processes. Off by default:
+# enabling it means clients over these limits get 429 responses.
+
+TAG_RATE_LIMITS = {
+    'ENABLED': False,
+    'STORE': 'local',
+    'CACHE': 'default',
+    'BUCKETS': {
+        'global': (500, 1000),
+        'ip': (50, 100),
+        'user': (50, 100),
+        'endpoint': (20, 40),
+    },
+    'COSTS': {
+        'UNFILTERED_LIST': 10,
+        'VMS_PER_TOKEN': 100,
+    },
+}
+
+
+# JSON encoder used by tag_api/serializers.py: 'auto', 'stdlib' or 'simplejson'.
+# 'auto' picks simplejson's C extension when it is installed.
+
+TAG_JSON_ENCODER = 'auto'
+
+
+# Response compression (see tag_api/middleware.py)
+
+TAG_COMPRESSION = {
+    'MIN_SIZE': 1024,
+    'CONTENT_TYPES': (
+        'application/json',
+        'application/vnd.tags.columnar+json',
+        'text/csv',
+        'text/plain',
+    ),
+    'GZIP_LEVEL': 6,
+    'BROTLI_QUALITY': 4,
+}
+
+
+# In-memory tag -> VM bitmap index for tags_all/tags_any/tags_none queries
+# (see tag_api/bitmaps.py). MAX_AGE is the number of seconds before the
+# index is rebuilt from the database.
+
+TAG_BITMAP_INDEX = {
+    'ENABLED': False,
+    'MAX_AGE': 300,
+    # Compare the live index with vms_tags before each rebuild (one more
+    # scan of the table); drift is logged and counted in /metrics
+    'VERIFY_ON_REBUILD': True,
+}
+
+
+# In-memory trigram index over tag names for GET /tags/search
+# (see tag_api/search.py). MAX_AGE is the number of seconds before the
+# index is rebuilt from the database; with ENABLED False searches scan
+# the tags table instead.
+
+TAG_SEARCH_INDEX = {
+    'ENABLED': True,
+    'MAX_AGE': 300,
+    'MAX_PAGE_SIZE': 100,
+}
+
+
+# Denormalized [{tag_id, tag_name, scope}] list on each VM, so
+# GET /vms?include=tags reads only the vms table (see tag_api/tag_lists.py).
+# Run "manage.py rebuild_tag_lists" after enabling it.
+
+TAG_VM_TAG_LISTS = {
+    'ENABLED': False,
+    'BATCH_SIZE': 1000,
+}
+
+
+# Identical GETs running at the same time in one worker share a single
+# query and response (see tag_api/coalescing.py)
+
+TAG_COALESCING = {
+    'ENABLED': True,
+    'PATHS': ('/tags', '/tags/search', '/vms', '/vms/histogram', '/user'),
+    'TIMEOUT': 10,
+}
+
+
+# POST /batch limits (see tag_api/batch.py)
+
+TAG_BATCH = {
+    'MAX_OPERATIONS': 100,
+    'MAX_SECONDS': 10,
+}
+
+
+# Tag assignment writes (see tag_api/assignments.py): VMs per transaction
+# and retries after a deadlock or lock timeout
+
+TAG_ASSIGNMENTS = {
+    'CHUNK_SIZE': 500,
+    'RETRIES': 5,
+    'RETRY_BACKOFF': 0.05,
+}
+
+
+# List lookups such as GET /tags?tag_id=a,b,c and POST /vms/lookup (see
+# tag_api/lookups.py): values per list and per IN (...) query
+
+TAG_LOOKUPS = {
+    'MAX_VALUES': 1000,
+    'CHUNK_SIZE': 500,
+}
+
+
+# ?count=exact|estimated on GET /tags and /vms (see tag_api/counts.py):
+# seconds an exact count is reused, and the estimate below which counting
+# exactly is cheap enough
+
+TAG_COUNTS = {
+    'CACHE_TTL': 60,
+    'EXACT_BELOW': 1000,
+}
+
+
+# Background purge of soft-deleted VMs and users (see tag_api/purge.py);
+# "manage.py purge_deleted" picks up anything a lost job left behind
+
+TAG_PURGE = {
+    'BATCH_SIZE': 1000,
+    'BATCH_PAUSE': 0,
+}
+
+
+# GET /vms/histogram (see tag_api/histograms.py): seconds the closed buckets
+# are cached
+
+TAG_HISTOGRAMS = {
+    'CACHE_TTL': 86400,
+}
+
+
+# Opt-in group commit for small assign/unassign calls (see
+# tag_api/group_commit.py): queued calls are written together, every
+# MAX_DELAY seconds or MAX_OPERATIONS calls, and answered after the commit.
+# GET /metrics reports group_commit.* counters.
+
+TAG_GROUP_COMMIT = {
+    'ENABLED': False,
+    'MAX_DELAY': 0.005,
+    'MAX_OPERATIONS': 500,
+    'TIMEOUT': 10,
+}
+
+
+# Background jobs for bulk tag operations (see tag_api/jobs.py)
+
+TAG_JOBS = {
+    'MAX_WORKERS': 2,
+    'MAX_PENDING': 100,
+    'BATCH_SIZE': 1000,
+    'BATCH_PAUSE': 0,
+    'ASYNC_THRESHOLD': 5000,
+    # Seconds after which a queued or running job nobody updates is marked
+    # failed; its process died
+    'STALE_AFTER': 3600,
+}
@@ -0,0 +1,9 @@
+"""
+Settings for the test run (manage.py test picks them up by default).
+"""
+from .settings import *  # noqa: F401,F403
+
+# A stand-in replica: a mirror of the test database, so routing can be
+# checked without a second server. Nothing reads from it unless it is listed
+# in TAG_DB_REPLICAS['ALIASES'].
+DATABASES = dict(DATABASES, replica1=dict(DATABASES['default'], TEST={'MIRROR': 'default'}))